@@ -0,0 +1,184 @@
+# --- backfill_profiles.py ---
+# Re-derives user_profiles from stored chat history, e.g. after extraction rules change.
+#
+#   python backfill_profiles.py [--workers 4] [--users-per-chunk 500] [--dry-run] [--restart]
+#
+# Users are processed in user_id order, a chunk at a time: the chunk's user messages, the
+# archived ones (retention.py) followed by those still in chat_history, are read from the
+# database, run through extraction.extract_profile in a process pool and
+# upserted in one statement. Only the derived fields are written; a field with no mention
+# keeps its stored value, and pending_action is never touched. After every committed chunk
+# the last user_id goes to the checkpoint file, so an interrupted run resumes where it
+# stopped. Running servers see the new values once their profile cache entries expire
+# (PROFILE_CACHE_TTL).
+from collections import deque
+from itertools import groupby
+from operator import itemgetter
+from sqlalchemy import select, func, union
+from extraction import extract_profile
+from memory import run_sync, unpack_messages
+from models import ChatArchive, ChatHistory, UserProfile, SessionLocal, engine, init_db
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+DERIVED_FIELDS = ["region", "age", "income", "retirement_age", "risk_profile", "prsi_years"]
+
+def derive_chunk(users):
+    # Runs in a pool worker: [(user_id, [message, ...])] -> [(user_id, fields)]
+    return [(user_id, extract_profile(messages)) for user_id, messages in users]
+
+def history_users():
+    # Users who have written at least one message, hot or archived
+    return union(select(ChatHistory.user_id).where(ChatHistory.role == "user"),
+                 select(ChatArchive.user_id)).subquery()
+
+def user_windows(db, after, size):
+    # Keyset pagination over history_users()
+    users = history_users()
+    while True:
+        stmt = select(users.c.user_id).order_by(users.c.user_id).limit(size)
+        if after is not None:
+            stmt = stmt.where(users.c.user_id > after)
+        user_ids = db.execute(stmt).scalars().all()
+        if not user_ids:
+            return
+        yield user_ids
+        after = user_ids[-1]
+
+def load_window(db, user_ids, batch_size):
+    # Archived messages are older than every hot one, so they go first
+    messages = {user_id: [] for user_id in user_ids}
+    archives = select(ChatArchive.user_id, ChatArchive.payload)\
+        .where(ChatArchive.user_id.in_(user_ids))\
+        .order_by(ChatArchive.user_id, ChatArchive.last_message_id)\
+        .execution_options(yield_per=1)
+    for user_id, blob in db.execute(archives):
+        messages[user_id].extend(row.content for row in unpack_messages(blob) if row.role == "user" and row.content)
+    stmt = select(ChatHistory.user_id, ChatHistory.content)\
+        .where(ChatHistory.user_id.in_(user_ids), ChatHistory.role == "user")\
+        .order_by(ChatHistory.user_id, ChatHistory.timestamp, ChatHistory.id)\
+        .execution_options(yield_per=batch_size)
+    for user_id, rows in groupby(db.execute(stmt), key=itemgetter(0)):
+        messages[user_id].extend(content for _, content in rows if content)
+    return [(user_id, user_messages) for user_id, user_messages in messages.items() if user_messages]
+
+def upsert_profiles(conn, derived):
+    rows = [{"user_id": user_id, **{name: fields.get(name) for name in DERIVED_FIELDS}}
+            for user_id, fields in derived if fields]
+    if not rows:
+        return 0
+    table = UserProfile.__table__
+    if conn.dialect.name in ("sqlite", "postgresql"):
+        if conn.dialect.name == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(table)
+        # A field that was not derived (NULL here) keeps its stored value
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.user_id],
+            set_={**{name: func.coalesce(stmt.excluded[name], table.c[name]) for name in DERIVED_FIELDS},
+                  "version": table.c.version + 1},
+        )
+        conn.execute(stmt, rows)
+    else:
+        for row in rows:
+            changes = {name: value for name, value in row.items() if name != "user_id" and value is not None}
+            updated = conn.execute(table.update().where(table.c.user_id == row["user_id"])
+                                   .values(**changes, version=table.c.version + 1)).rowcount
+            if not updated:
+                conn.execute(table.insert().values(**row))
+    return len(rows)
+
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return {"last_user_id": None, "users": 0, "messages": 0, "updated": 0}
+    with open(path) as f:
+        return json.load(f)
+
+def write_checkpoint(path, state):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def backfill(args):
+    init_db()
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    state = read_checkpoint(args.checkpoint)
+    if state["last_user_id"] is not None:
+        print(f"Resuming after user_id {state['last_user_id']!r} ({state['users']} users done)")
+
+    db = SessionLocal()
+    try:
+        total = db.execute(select(func.count()).select_from(history_users())).scalar()
+        print(f"{total} users with chat history, {args.workers} workers, {args.users_per_chunk} users per chunk"
+              + (" (dry run)" if args.dry_run else ""))
+
+        started = time.monotonic()
+        session_users = session_messages = 0
+        pending = deque()
+
+        def commit_oldest():
+            nonlocal session_users, session_messages
+            last_user_id, user_count, message_count, result = pending.popleft()
+            derived = result.get()
+            if args.dry_run:
+                updated = sum(1 for _, fields in derived if fields)
+            else:
+                with engine.begin() as conn:
+                    updated = upsert_profiles(conn, derived)
+            state["last_user_id"] = last_user_id
+            state["users"] += user_count
+            state["messages"] += message_count
+            state["updated"] += updated
+            if not args.dry_run:
+                write_checkpoint(args.checkpoint, state)
+
+            session_users += user_count
+            session_messages += message_count
+            elapsed = time.monotonic() - started
+            rate = session_messages / elapsed if elapsed else 0.0
+            eta = max(total - state["users"], 0) * elapsed / session_users
+            print(f"{state['users']}/{total} users, {state['messages']} messages, "
+                  f"{state['updated']} profiles updated, {rate:,.0f} msg/s, ETA {eta:,.0f}s", flush=True)
+
+        # Chunks are submitted in order and committed in order, with at most two per worker
+        # in flight, so memory stays bounded and the checkpoint never skips a chunk
+        with multiprocessing.get_context("spawn").Pool(args.workers) as pool:
+            for user_ids in user_windows(db, state["last_user_id"], args.users_per_chunk):
+                users = load_window(db, user_ids, args.batch_size)
+                db.rollback()  # end the read transaction so SQLite checkpoints are not held back
+                message_count = sum(len(messages) for _, messages in users)
+                pending.append((user_ids[-1], len(user_ids), message_count,
+                                pool.apply_async(derive_chunk, (users,))))
+                while len(pending) >= args.workers * 2:
+                    commit_oldest()
+            while pending:
+                commit_oldest()
+    finally:
+        db.close()
+
+    print(f"✅ Backfill complete: {state['users']} users, {state['messages']} messages, "
+          f"{state['updated']} profiles updated.")
+    if not args.dry_run and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-derive user profiles from stored chat history")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--users-per-chunk", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=2000, help="rows fetched per database round trip")
+    parser.add_argument("--checkpoint", default="backfill_profiles.checkpoint")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument("--dry-run", action="store_true", help="extract and report without writing")
+    args = parser.parse_args()
+    run_sync(backfill, args)
+
+if __name__ == "__main__":
+    main()
+# --- End of backfill_profiles.py ---
@@ -0,0 +1,95 @@
+# --- conversation_summary.py ---
+# Rolling conversation summary. Every SUMMARY_EVERY_TURNS turns, a background task folds
+# the user's older messages into a short summary stored in conversation_summaries, off the
+# request path. Prompts then carry the summary plus only the unsummarized recent messages,
+# so their size stays flat however long the conversation gets.
+from memory import get_conversation_summary, get_messages_to_summarize, save_conversation_summary, run_db
+from metrics import timed
+import gpt_engine
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_EVERY_TURNS = int(os.getenv("SUMMARY_EVERY_TURNS", "6"))  # 0 disables summaries
+SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", "2"))  # newest messages always sent raw
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "250"))
+SUMMARY_BATCH_MESSAGES = int(os.getenv("SUMMARY_BATCH_MESSAGES", "40"))  # folded per update; the rest waits
+# Messages a chat turn loads so summary_due() sees the whole unsummarized backlog; prompts
+# still send only the newest CHAT_HISTORY_LIMIT of them
+SUMMARY_WINDOW = SUMMARY_EVERY_TURNS * 2 + SUMMARY_KEEP_RECENT if SUMMARY_EVERY_TURNS > 0 else 0
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a pension planning conversation between a user and "
+    "Pension Guru. Merge the new messages into the existing summary. Keep facts the user "
+    "stated (region, age, income, PRSI years, plans, concerns), figures already calculated, "
+    "advice already given and open questions. Drop greetings and repetition. Write at most "
+    f"{SUMMARY_MAX_TOKENS} tokens of plain prose."
+)
+
+SUMMARY_STATS = {"scheduled": 0, "updated": 0, "failed": 0}
+
+_in_flight = {}  # user_id -> task; one update per user at a time
+
+def summary_due(turn, new_messages):
+    # Loaded history plus this turn's messages that the summary does not cover yet. A turn only
+    # loads a window of history, so a window with nothing summarized in it is also due.
+    if SUMMARY_EVERY_TURNS <= 0:
+        return False
+    unsummarized = turn.unsummarized_history()
+    if len(unsummarized) + new_messages >= SUMMARY_EVERY_TURNS * 2 + SUMMARY_KEEP_RECENT:
+        return True
+    return bool(turn.history_limit) and len(unsummarized) == len(turn.history) >= turn.history_limit
+
+def maybe_schedule_summary(turn, new_messages=2):
+    if turn.user_id in _in_flight or not summary_due(turn, new_messages):
+        return None
+    SUMMARY_STATS["scheduled"] += 1
+    task = asyncio.get_running_loop().create_task(update_summary(turn.user_id))
+    _in_flight[turn.user_id] = task
+    task.add_done_callback(lambda _: _in_flight.pop(turn.user_id, None))
+    return task
+
+@timed("summary_update")
+async def update_summary(user_id):
+    try:
+        current = await run_db(get_conversation_summary, user_id)
+        rows = await run_db(get_messages_to_summarize, user_id, current.last_message_id if current else None,
+                            SUMMARY_KEEP_RECENT, SUMMARY_BATCH_MESSAGES)
+        if not rows:
+            return
+
+        counter = gpt_engine.token_counter
+        transcript = "\n".join(
+            f"{'User' if role == 'user' else 'Pension Guru'}: "
+            f"{counter.truncate(content or '', gpt_engine.HISTORY_MESSAGE_TOKEN_LIMIT)}"
+            for _, role, content in rows
+        )
+        messages = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Existing summary:\n{current.text if current else '(none)'}\n\n"
+                                        f"New messages:\n{transcript}"},
+        ]
+        response = await gpt_engine.llm.complete(messages, model=gpt_engine.OPENAI_MODEL, temperature=0.2,
+                                                 max_tokens=SUMMARY_MAX_TOKENS)
+        text = (response.choices[0].message.content or "").strip()
+        if not text:
+            return
+        text = counter.truncate(text, SUMMARY_MAX_TOKENS)
+        last_message_id = max(row[0] for row in rows)
+        if await run_db(save_conversation_summary, user_id, text, last_message_id):
+            SUMMARY_STATS["updated"] += 1
+            logger.info(f"Conversation summary updated for user_id: {user_id} through message {last_message_id}")
+    except Exception as e:
+        # Non-fatal: prompts keep using raw recent history and the next due turn retries
+        SUMMARY_STATS["failed"] += 1
+        logger.error(f"Failed to update conversation summary for user_id {user_id}: {e}", exc_info=True)
+
+async def drain_summaries(timeout=10):
+    if _in_flight:
+        await asyncio.wait(list(_in_flight.values()), timeout=timeout)
+
+def summary_stats():
+    return {**SUMMARY_STATS, "in_flight": len(_in_flight), "every_turns": SUMMARY_EVERY_TURNS}
+# --- End of conversation_summary.py ---
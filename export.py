@@ -0,0 +1,115 @@
+# --- export.py ---
+# Chat history export renderers. Everything here is a generator over (already filtered)
+# history rows, so an export is produced piece by piece and never held as one string.
+# Rows come from memory.iter_chat_history in batches; the PDF worker joins the HTML output.
+from collections import namedtuple
+from html import escape
+from itertools import chain
+import json
+import os
+
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", str(64 * 1024)))  # streamed response piece size
+EXPORT_PDF_MAX_MESSAGES = int(os.getenv("EXPORT_PDF_MAX_MESSAGES", "2000"))  # newest N when no last_n is given
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "html": "text/html; charset=utf-8",
+    "pdf": "application/pdf",
+}
+
+PROFILE_FIELDS = ["region", "age", "income", "retirement_age", "risk_profile", "prsi_years", "pending_action"]
+
+REPORT_HEADER = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>Pension Plan Summary</title></head>
+<body>
+    <h1>Pension Plan Summary</h1>
+    <h2>User Info</h2>
+    <ul>
+      <li>Region: {region}</li>
+      <li>Age: {age}</li>
+      <li>Income: {income}</li>
+      <li>Retirement Age: {retirement_age}</li>
+      <li>Risk Profile: {risk_profile}</li>
+      <li>PRSI Years: {prsi_years}</li>
+      <li>Pending Action: {pending_action}</li>
+    </ul>
+<h2>Chat History</h2><ul>
+"""
+REPORT_MESSAGE = "<li><strong>{role}:</strong> {content}</li>\n"
+REPORT_EMPTY = "<li>No chat history found.</li>\n"
+REPORT_FOOTER = "</ul>\n</body>\n</html>\n"
+
+# Plain, picklable row for handing history to the PDF worker processes
+ExportRow = namedtuple("ExportRow", ["id", "role", "content", "timestamp"])
+
+ROLE_LABELS = {"user": "You"}
+DEFAULT_ROLE_LABEL = "Pension Guru"
+
+def _display(value, default="—"):
+    return escape(str(value)) if value is not None else default
+
+def _income(profile):
+    income = profile.get("income")
+    if income is None:
+        return "—"
+    currency = '£' if profile.get("region") == 'UK' else '€'
+    try:
+        return escape(f"{currency}{income:,}")
+    except (TypeError, ValueError):
+        return escape(f"{currency}{income}")
+
+def iter_html(profile, rows):
+    # profile: dict of UserProfile fields; rows: iterable of rows with .role/.content, oldest first
+    values = {name: _display(profile.get(name)) for name in PROFILE_FIELDS}
+    values["income"] = _income(profile)
+    yield REPORT_HEADER.format(**values)
+    empty = True
+    for row in rows:
+        empty = False
+        yield REPORT_MESSAGE.format(role=ROLE_LABELS.get(row.role, DEFAULT_ROLE_LABEL),
+                                    content=escape(row.content or ""))
+    if empty:
+        yield REPORT_EMPTY
+    yield REPORT_FOOTER
+
+def iter_ndjson(profile, rows):
+    # One profile record, then one record per message
+    yield json.dumps({"type": "profile", **{name: profile.get(name) for name in PROFILE_FIELDS}},
+                     ensure_ascii=False) + "\n"
+    for row in rows:
+        yield json.dumps({
+            "type": "message",
+            "id": row.id,
+            "role": row.role,
+            "content": row.content,
+            "timestamp": row.timestamp.isoformat() if row.timestamp else None,
+        }, ensure_ascii=False) + "\n"
+
+RENDERERS = {
+    "ndjson": iter_ndjson,
+    "html": iter_html,
+}
+
+def render_html(profile, rows):
+    return "".join(iter_html(profile, rows))
+
+def _chunked(pieces, size):
+    # Joins small pieces so each send (and each DB-thread hop) carries a useful amount
+    buffer, length = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield "".join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+def export_stream(fmt, profile, batches, chunk_size=EXPORT_CHUNK_BYTES):
+    # batches: generator of row lists holding an open DB cursor; closed however the stream ends
+    try:
+        yield from _chunked(RENDERERS[fmt](profile, chain.from_iterable(batches)), chunk_size)
+    finally:
+        batches.close()
+# --- End of export.py ---
@@ -0,0 +1,160 @@
+# --- extraction.py ---
+# Profile extraction from chat messages. One precompiled scanner finds every candidate
+# (region, age, income, retirement age, risk level, PRSI years) in a single pass over the
+# lowercased message and returns a structured result; nothing here touches the database.
+# main.extract_user_data applies results to a ChatTurn; backfills use extract_profile().
+from dataclasses import dataclass, field
+from typing import Dict, Tuple
+import re
+
+AGE_RANGE = (18, 100)
+RETIREMENT_AGE_RANGE = (50, 80)
+PRSI_YEARS_RANGE = (0, 60)
+
+# Alternatives are tried left to right at each position, so the specific number forms
+# (age, PRSI years) claim their digits before the bare two-digit number used for
+# retirement age. The whole message is scanned once with finditer; the leading lookahead
+# rejects positions that cannot start any token (a digit, a currency sign or the start of
+# a keyword) before the alternation is tried, which roughly doubles scan speed on prose.
+_SCANNER = re.compile(
+    r"(?=[0-9€£]|(?<![a-z])[riulhm])(?:"
+    r"(?P<age>(?P<age_value>\b\d{1,2})\s*(?P<age_years>years?)?\s*old\b)"
+    r"|(?P<prsi>(?P<prsi_value>\b\d{1,2})\s+(?:years?|yrs?)\s+(?:of\s+)?(?:prsi|contributions?))"
+    r"|(?P<income>[€£]\s?(?P<income_value>\d{1,3}(?:,\d{3})+|\d+)\s?(?P<thousands>k)?\b)"
+    r"|\b(?P<retire>retire(?:ment)?)\b"
+    r"|\b(?P<number>\d{2})\b"
+    r"|\b(?P<region>ireland|united kingdom|uk)\b"
+    r"|(?P<risk>risk)"
+    r"|\b(?P<level>low|high|medium|moderate)\b"
+    r")"
+)
+_BARE_NUMBER = re.compile(r"\s*(\d{1,2})\s*")
+# Cheap gate: messages with none of these cannot yield a field and skip the scanner
+_CANDIDATE = re.compile(r"[0-9€£]|ireland|kingdom|\buk\b|risk|retire")
+
+REGIONS = {"ireland": "Ireland", "united kingdom": "UK", "uk": "UK"}
+RISK_LEVELS = {"low": "Low", "high": "High", "medium": "Medium", "moderate": "Medium"}
+RISK_PRIORITY = ["Low", "High", "Medium"]  # when a message names several levels
+
+@dataclass(frozen=True, slots=True)
+class ExtractionResult:
+    fields: Dict[str, object] = field(default_factory=dict)
+    confidence: Dict[str, float] = field(default_factory=dict)
+    rejected: Tuple[Tuple[str, int], ...] = ()  # (field, value) pairs outside the valid range
+
+    def __bool__(self):
+        return bool(self.fields)
+
+_EMPTY = ExtractionResult()
+
+def _in_range(value, bounds):
+    return bounds[0] <= value <= bounds[1]
+
+def extract(msg):
+    text = msg.lower()
+    if not _CANDIDATE.search(text):
+        return _EMPTY
+    fields = {}
+    confidence = {}
+    rejected = []
+    seen = set()  # like the old per-field re.search, only a field's first mention counts
+    regions = set()
+    levels = set()
+    mentions_risk = False
+    after_retire = False
+
+    for match in _SCANNER.finditer(text):
+        kind = match.lastgroup  # outer group of the alternative that matched
+        if kind in seen:
+            continue
+
+        if kind == "age":
+            seen.add(kind)
+            age = int(match.group("age_value"))
+            if _in_range(age, AGE_RANGE):
+                fields["age"] = age
+                confidence["age"] = 0.95 if match.group("age_years") else 0.75
+            else:
+                rejected.append(("age", age))
+        elif kind == "prsi":
+            seen.add(kind)
+            fields["prsi_years"] = int(match.group("prsi_value"))
+            confidence["prsi_years"] = 0.95
+        elif kind == "income":
+            seen.add(kind)
+            income = int(match.group("income_value").replace(",", ""))
+            if match.group("thousands"):
+                income *= 1000
+            fields["income"] = income
+            confidence["income"] = 0.9
+        elif kind == "retire":
+            after_retire = True
+        elif kind == "number":
+            # The first two-digit number after "retire"/"retirement" is the candidate
+            if after_retire:
+                seen.add(kind)
+                ret_age = int(match.group("number"))
+                if _in_range(ret_age, RETIREMENT_AGE_RANGE):
+                    fields["retirement_age"] = ret_age
+                    confidence["retirement_age"] = 0.8
+                else:
+                    rejected.append(("retirement_age", ret_age))
+        elif kind == "region":
+            regions.add(REGIONS[match.group("region")])
+        elif kind == "risk":
+            mentions_risk = True
+        elif kind == "level":
+            levels.add(RISK_LEVELS[match.group("level")])
+
+    if regions:
+        # Ireland wins when both are named, as the app is Ireland-first
+        fields["region"] = "Ireland" if "Ireland" in regions else "UK"
+        confidence["region"] = 0.9 if len(regions) == 1 else 0.5
+    if mentions_risk and levels:
+        fields["risk_profile"] = next(level for level in RISK_PRIORITY if level in levels)
+        confidence["risk_profile"] = 0.8 if len(levels) == 1 else 0.5
+
+    if "prsi" not in seen:
+        # A bare number is usually the reply to "how many years of PRSI contributions?"
+        bare = _BARE_NUMBER.fullmatch(msg)
+        if bare:
+            years = int(bare.group(1))
+            if _in_range(years, PRSI_YEARS_RANGE):
+                fields["prsi_years"] = years
+                confidence["prsi_years"] = 0.6
+            else:
+                rejected.append(("prsi_years", years))
+
+    return ExtractionResult(fields, confidence, tuple(rejected))
+
+def extract_batch(messages):
+    # Chat logs repeat short replies ("yes please", "thanks", bare numbers) a lot, so each
+    # distinct message is scanned once per batch. Results are shared: treat them as read-only.
+    seen = {}
+    results = []
+    for msg in messages:
+        result = seen.get(msg)
+        if result is None:
+            result = seen[msg] = extract(msg)
+        results.append(result)
+    return results
+
+def merge(profile, result):
+    # Region is only set once; every other field takes the latest mention
+    merged = dict(profile)
+    for name, value in result.fields.items():
+        if name == "region" and merged.get("region"):
+            continue
+        merged[name] = value
+    return merged
+
+def extract_profile(messages, profile=None):
+    # Folds a user's messages (oldest first) into the profile fields they imply,
+    # exactly as applying extract() turn by turn would have
+    merged = dict(profile or {})
+    for msg in messages:
+        result = extract(msg)
+        if result:
+            merged = merge(merged, result)
+    return merged
+# --- End of extraction.py ---
@@ -0,0 +1,133 @@
+# --- fake_openai.py ---
+# Local stand-in for the OpenAI chat completions endpoint, for load tests and failure drills
+# without an API key. Replies are canned; latency, slow tails and error bursts are set by
+# flags or, at runtime, by POST /fake/config with the same field names.
+#
+#   python fake_openai.py --port 8001 --latency 0.3 --error-rate 0.1 --error-status 429
+#   OPENAI_BASE_URL=http://127.0.0.1:8001/v1 uvicorn main:app
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+FAKE_CONFIG = {
+    "latency": 0.2,          # seconds before the reply (streams: before the first token)
+    "slow_fraction": 0.0,    # share of requests that take slow_latency instead
+    "slow_latency": 2.0,
+    "error_rate": 0.0,       # share of requests answered with error_status
+    "error_status": 429,
+    "fail_next": 0,          # the next N requests fail with error_status regardless of error_rate
+    "retry_after": None,     # seconds sent in a Retry-After header on errors
+    "reply_tokens": 40,
+    "reply_suffix": "",      # appended to every reply, e.g. an offer the app reacts to
+    "token_delay": 0.0,      # seconds between streamed tokens
+}
+
+FAKE_STATS = {"requests": 0, "errors": 0, "streams": 0, "in_flight": 0, "max_in_flight": 0, "prompt_chars": 0}
+
+_random = random.Random(7)
+
+app = FastAPI(title="Fake OpenAI")
+
+def reply_words(messages):
+    last = messages[-1]["content"] if messages else ""
+    words = [f"word{i} " for i in range(FAKE_CONFIG["reply_tokens"])]
+    words[0] = f"Fake reply to: {last[:40]} "
+    if FAKE_CONFIG["reply_suffix"]:
+        words.append(FAKE_CONFIG["reply_suffix"])
+    return words
+
+def error_response():
+    status = FAKE_CONFIG["error_status"]
+    FAKE_STATS["errors"] += 1
+    headers = {"retry-after": str(FAKE_CONFIG["retry_after"])} if FAKE_CONFIG["retry_after"] is not None else {}
+    kind = "rate_limit_exceeded" if status == 429 else "server_error"
+    return JSONResponse({"error": {"message": f"Fake {status}", "type": kind, "code": kind}},
+                        status_code=status, headers=headers)
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    messages = body.get("messages", [])
+    FAKE_STATS["requests"] += 1
+    FAKE_STATS["prompt_chars"] += sum(len(m.get("content") or "") for m in messages)
+    FAKE_STATS["in_flight"] += 1
+    FAKE_STATS["max_in_flight"] = max(FAKE_STATS["max_in_flight"], FAKE_STATS["in_flight"])
+    try:
+        if FAKE_CONFIG["fail_next"] > 0:
+            FAKE_CONFIG["fail_next"] -= 1
+            return error_response()
+        if _random.random() < FAKE_CONFIG["error_rate"]:
+            return error_response()
+        slow = _random.random() < FAKE_CONFIG["slow_fraction"]
+        await asyncio.sleep(FAKE_CONFIG["slow_latency"] if slow else FAKE_CONFIG["latency"])
+
+        words = reply_words(messages)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        model = body.get("model", "gpt-3.5-turbo")
+        if body.get("stream"):
+            FAKE_STATS["streams"] += 1
+            return StreamingResponse(stream_chunks(completion_id, created, model, words), media_type="text/event-stream")
+
+        await asyncio.sleep(FAKE_CONFIG["token_delay"] * len(words))
+        prompt_tokens = sum(len(m.get("content") or "") for m in messages) // 4
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                      "total_tokens": prompt_tokens + len(words)},
+        }
+    finally:
+        FAKE_STATS["in_flight"] -= 1
+
+async def stream_chunks(completion_id, created, model, words):
+    for index, word in enumerate(words):
+        delta = {"role": "assistant", "content": word} if index == 0 else {"content": word}
+        chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                 "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+        yield f"data: {json.dumps(chunk)}\n\n"
+        if FAKE_CONFIG["token_delay"]:
+            await asyncio.sleep(FAKE_CONFIG["token_delay"])
+    done = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+    yield f"data: {json.dumps(done)}\n\n"
+    yield "data: [DONE]\n\n"
+
+@app.post("/fake/config")
+async def update_config(request: Request):
+    changes = await request.json()
+    FAKE_CONFIG.update({name: value for name, value in changes.items() if name in FAKE_CONFIG})
+    return FAKE_CONFIG
+
+@app.get("/fake/stats")
+async def stats():
+    return FAKE_STATS
+
+def reset():
+    FAKE_STATS.update({name: 0 for name in FAKE_STATS})
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Fake OpenAI chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    for name, default in FAKE_CONFIG.items():
+        kind = type(default) if isinstance(default, (int, str)) else float
+        parser.add_argument(f"--{name.replace('_', '-')}", type=kind, default=default)
+    args = parser.parse_args()
+    FAKE_CONFIG.update({name: getattr(args, name) for name in FAKE_CONFIG})
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
+# --- End of fake_openai.py ---
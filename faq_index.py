@@ -0,0 +1,334 @@
+# --- faq_index.py ---
+# Retrieval index over curated pension Q&A (faq.json), so the handful of questions users ask
+# most (pension age, PRSI/NI credits, voluntary contributions, qualifying years) need no
+# OpenAI call. Every paraphrase in faq.json is a document; terms are words plus adjacent word
+# pairs, weighted by TF-IDF and L2-normalized, so a lookup is a cosine score over the
+# inverted lists of the query's terms.
+#
+#   score >= FAQ_ANSWER_THRESHOLD  and clearly ahead of other entries: answered directly
+#   score >= FAQ_CONTEXT_THRESHOLD the matching answers go into the system prompt as context
+#
+# Entries are per region; users with a region only match their own and "any". The index is
+# built offline into one flat binary file that is memory-mapped at startup:
+#
+#   python faq_index.py build [--source faq.json] [--out faq.idx]
+#   python faq_index.py query "when can I get my state pension" [--region Ireland]
+#
+# The file records a hash of its source; a missing or stale index is rebuilt on load.
+from collections import Counter, namedtuple
+from metrics import timed
+import argparse
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FAQ_SOURCE = os.getenv("FAQ_SOURCE", os.path.join(BASE_DIR, "faq.json"))
+FAQ_INDEX_PATH = os.getenv("FAQ_INDEX_PATH", os.path.join(BASE_DIR, "faq.idx"))
+FAQ_ENABLED = os.getenv("FAQ_ENABLED", "1") == "1"
+FAQ_ANSWER_THRESHOLD = float(os.getenv("FAQ_ANSWER_THRESHOLD", "0.6"))
+FAQ_CONTEXT_THRESHOLD = float(os.getenv("FAQ_CONTEXT_THRESHOLD", "0.3"))
+FAQ_MARGIN = 0.1  # a direct answer must beat the next entry by this much
+FAQ_CONTEXT_ENTRIES = 2
+
+REGIONS = ["any", "Ireland", "UK"]  # stored as the index into this list
+
+# Layout: header, section offset table, then the sections in SECTIONS order, each 4-byte
+# aligned. Term strings are sorted so lookups binary-search the mapped file directly.
+MAGIC = b"FAQX"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIIII32s")  # magic, version, sections, terms, docs, entries, postings, source sha256
+SECTIONS = [
+    ("term_offsets", "I"),   # terms + 1 offsets into term_blob
+    ("term_blob", "B"),      # UTF-8 terms, sorted
+    ("posting_starts", "I"), # terms + 1 offsets into the posting arrays
+    ("posting_docs", "I"),   # document per posting
+    ("posting_weights", "f"),# normalized TF-IDF weight of the term in that document
+    ("idf", "f"),            # per term
+    ("doc_entries", "H"),    # entry per document
+    ("entry_regions", "B"),  # index into REGIONS per entry
+    ("text_offsets", "I"),   # 2 * entries + 1 offsets into text_blob: id, answer, id, answer...
+    ("text_blob", "B"),
+]
+
+STOPWORDS = frozenset(
+    "a an and are as at be can could do does for from have how i im if in is it me my of on or "
+    "the there this to what when where which will with would you your".split()
+)
+
+_WORD = re.compile(r"[a-z0-9]+")
+# A question that names a country (or its system) is about that country, whatever the profile says
+_MENTIONS = [("UK", re.compile(r"\b(?:uk|united kingdom|britain|british|national insurance|ni|gov\.uk)\b")),
+             ("Ireland", re.compile(r"\b(?:ireland|irish|prsi)\b"))]
+
+FaqMatch = namedtuple("FaqMatch", ["entry_id", "answer", "score", "region"])
+FaqResult = namedtuple("FaqResult", ["answer", "context"])  # answer: a FaqMatch or None
+
+NO_MATCH = FaqResult(None, [])
+
+FAQ_STATS = {"lookups": 0, "answered": 0, "grounded": 0, "misses": 0, "lookup_seconds": 0.0}
+
+def terms(text):
+    # Words minus stopwords with a plural "s" stripped, plus adjacent pairs of those words
+    words = []
+    for word in _WORD.findall(text.lower().replace("'", "")):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        words.append(word)
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+def mentioned_region(text):
+    lowered = text.lower()
+    named = [region for region, pattern in _MENTIONS if pattern.search(lowered)]
+    return named[0] if len(named) == 1 else None
+
+def _weights(counts, idf):
+    vector = {term: (1 + math.log(count)) * idf[term] for term, count in counts.items() if term in idf}
+    norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+    return {term: weight / norm for term, weight in vector.items()}
+
+def source_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).digest()
+
+def build(source=FAQ_SOURCE, out=FAQ_INDEX_PATH):
+    with open(source, encoding="utf-8") as f:
+        entries = json.load(f)
+    docs = []  # (entry index, term counts)
+    for number, entry in enumerate(entries):
+        if entry.get("region", "any") not in REGIONS:
+            raise ValueError(f"FAQ entry {entry['id']}: unknown region {entry['region']!r}")
+        for question in entry["questions"]:
+            docs.append((number, Counter(terms(question))))
+
+    frequency = Counter(term for _, counts in docs for term in counts)
+    vocabulary = sorted(frequency, key=lambda term: term.encode())
+    idf = {term: math.log((1 + len(docs)) / (1 + frequency[term])) + 1 for term in vocabulary}
+    postings = {term: [] for term in vocabulary}
+    for doc, (_, counts) in enumerate(docs):
+        for term, weight in _weights(counts, idf).items():
+            postings[term].append((doc, weight))
+
+    term_bytes = [term.encode() for term in vocabulary]
+    texts = [value.encode() for entry in entries for value in (entry["id"], entry["answer"])]
+    flat = [posting for term in vocabulary for posting in postings[term]]
+    sections = {
+        "term_offsets": _offsets(term_bytes),
+        "term_blob": b"".join(term_bytes),
+        "posting_starts": _offsets([postings[term] for term in vocabulary]),
+        "posting_docs": [doc for doc, _ in flat],
+        "posting_weights": [weight for _, weight in flat],
+        "idf": [idf[term] for term in vocabulary],
+        "doc_entries": [number for number, _ in docs],
+        "entry_regions": [REGIONS.index(entry.get("region", "any")) for entry in entries],
+        "text_offsets": _offsets(texts),
+        "text_blob": b"".join(texts),
+    }
+
+    body = bytearray()
+    offsets = []
+    start = HEADER.size + 8 * len(SECTIONS)
+    for name, code in SECTIONS:
+        data = sections[name]
+        raw = bytes(data) if code == "B" else struct.pack(f"<{len(data)}{code}", *data)
+        offsets += [start + len(body), len(raw)]
+        body += raw + b"\0" * (-len(raw) % 4)
+    header = HEADER.pack(MAGIC, VERSION, len(SECTIONS), len(vocabulary), len(docs), len(entries), len(flat),
+                         source_hash(source))
+    # Written aside and renamed, so a running server never maps a half-written file
+    partial = f"{out}.{os.getpid()}.tmp"
+    with open(partial, "wb") as f:
+        f.write(header + struct.pack(f"<{2 * len(SECTIONS)}I", *offsets) + body)
+    os.replace(partial, out)
+    logger.info(f"Built FAQ index {out}: {len(entries)} entries, {len(docs)} questions, {len(vocabulary)} terms")
+    return {"entries": len(entries), "questions": len(docs), "terms": len(vocabulary), "bytes": os.path.getsize(out)}
+
+def _offsets(items):
+    offsets = [0]
+    for item in items:
+        offsets.append(offsets[-1] + len(item))
+    return offsets
+
+class FaqIndex:
+    def __init__(self, path=FAQ_INDEX_PATH, source=FAQ_SOURCE):
+        self.path = path
+        self.source = source
+        self._file = None
+        self._map = None
+        self.sections = None
+        self.entries = 0
+        self.load_seconds = None
+        self.unavailable = False
+
+    @property
+    def loaded(self):
+        return self.sections is not None
+
+    def load(self):
+        # Rebuilds first when the index is missing or was built from a different faq.json
+        started = time.perf_counter()
+        self.close()
+        if os.path.exists(self.source) and not self._current():
+            logger.warning(f"FAQ index {self.path} is missing or out of date; rebuilding from {self.source}")
+            build(self.source, self.path)
+        self._file = open(self.path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        magic, version, count, _, _, self.entries, _, _ = HEADER.unpack_from(view)
+        if magic != MAGIC or version != VERSION or count != len(SECTIONS):
+            raise ValueError(f"{self.path} is not a version {VERSION} FAQ index")
+        offsets = struct.unpack_from(f"<{2 * count}I", view, HEADER.size)
+        self.sections = {name: view[offsets[2 * i]:offsets[2 * i] + offsets[2 * i + 1]].cast(code)
+                         for i, (name, code) in enumerate(SECTIONS)}
+        self.load_seconds = time.perf_counter() - started
+        return self
+
+    def _current(self):
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "rb") as f:
+            header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return False
+        magic, version, *_, digest = HEADER.unpack(header)
+        return magic == MAGIC and version == VERSION and digest == source_hash(self.source)
+
+    def close(self):
+        # Views into the map must go before the map itself can close
+        if self.sections is not None:
+            for section in self.sections.values():
+                section.release()
+            self.sections = None
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = self._file = None
+
+    def _term_id(self, term):
+        offsets, blob = self.sections["term_offsets"], self.sections["term_blob"]
+        key = term.encode()
+        low, high = 0, len(offsets) - 1
+        while low < high:
+            middle = (low + high) // 2
+            candidate = blob[offsets[middle]:offsets[middle + 1]].tobytes()
+            if candidate < key:
+                low = middle + 1
+            elif candidate > key:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def _text(self, index):
+        offsets = self.sections["text_offsets"]
+        return self.sections["text_blob"][offsets[index]:offsets[index + 1]].tobytes().decode()
+
+    def search(self, question, region=None, limit=FAQ_CONTEXT_ENTRIES + 1):
+        # Best-scoring entries first: FaqMatch per entry, its best paraphrase's cosine score
+        counts = Counter()
+        for term in terms(question):
+            term_id = self._term_id(term)
+            if term_id is not None:
+                counts[term_id] += 1
+        if not counts:
+            return []
+        idf = self.sections["idf"]
+        norm = math.sqrt(sum(((1 + math.log(count)) * idf[term_id]) ** 2 for term_id, count in counts.items()))
+        starts, docs, weights = (self.sections[name] for name in ("posting_starts", "posting_docs", "posting_weights"))
+        scores = Counter()
+        for term_id, count in counts.items():
+            query_weight = (1 + math.log(count)) * idf[term_id] / norm
+            for posting in range(starts[term_id], starts[term_id + 1]):
+                scores[docs[posting]] += query_weight * weights[posting]
+
+        doc_entries, entry_regions = self.sections["doc_entries"], self.sections["entry_regions"]
+        allowed = {0, REGIONS.index(region)} if region in REGIONS else None
+        best = {}
+        for doc, score in scores.items():
+            entry = doc_entries[doc]
+            if allowed is not None and entry_regions[entry] not in allowed:
+                continue
+            if score > best.get(entry, 0.0):
+                best[entry] = score
+        ranked = sorted(best.items(), key=lambda item: -item[1])[:limit]
+        return [FaqMatch(self._text(2 * entry), self._text(2 * entry + 1), round(score, 4),
+                         REGIONS[entry_regions[entry]]) for entry, score in ranked]
+
+    @timed("faq.lookup")
+    def lookup(self, question, region=None, direct=True):
+        # A direct answer (only when `direct`), grounding context, or neither; counted in FAQ_STATS
+        if not self.loaded:
+            if self.unavailable:
+                return NO_MATCH
+            try:
+                self.load()
+            except (OSError, ValueError) as e:
+                # Chat keeps working without it, every question just goes to the LLM
+                logger.error(f"FAQ index unavailable, answering everything with the LLM: {e}")
+                self.unavailable = True
+                return NO_MATCH
+        started = time.perf_counter()
+        matches = self.search(question, mentioned_region(question) or region)
+        FAQ_STATS["lookups"] += 1
+        answer = None
+        if direct and matches and matches[0].score >= FAQ_ANSWER_THRESHOLD and (
+                len(matches) == 1 or matches[0].score - matches[1].score >= FAQ_MARGIN):
+            answer = matches[0]
+            FAQ_STATS["answered"] += 1
+        context = [match for match in matches[:FAQ_CONTEXT_ENTRIES] if match.score >= FAQ_CONTEXT_THRESHOLD]
+        if answer is None:
+            FAQ_STATS["grounded" if context else "misses"] += 1
+        FAQ_STATS["lookup_seconds"] += time.perf_counter() - started
+        return FaqResult(answer, context)
+
+faq_index = FaqIndex()
+
+def format_context(matches):
+    # Appended to the system prompt for matches below the direct-answer threshold
+    lines = "\n".join(f"- {match.answer}" for match in matches)
+    return f"Reference information that may help (use only if relevant to the question):\n{lines}"
+
+def faq_stats():
+    lookups = FAQ_STATS["lookups"]
+    return {
+        **FAQ_STATS,
+        "enabled": FAQ_ENABLED,
+        "entries": faq_index.entries,
+        "hit_rate": round(FAQ_STATS["answered"] / lookups, 3) if lookups else 0.0,
+        "avg_lookup_us": round(FAQ_STATS["lookup_seconds"] / lookups * 1e6, 1) if lookups else 0.0,
+        "load_ms": round(faq_index.load_seconds * 1000, 2) if faq_index.load_seconds is not None else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the FAQ retrieval index")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build_cmd = sub.add_parser("build", help="compile faq.json into the memory-mapped index")
+    build_cmd.add_argument("--source", default=FAQ_SOURCE)
+    build_cmd.add_argument("--out", default=FAQ_INDEX_PATH)
+    query_cmd = sub.add_parser("query", help="show the best matches for a question")
+    query_cmd.add_argument("question")
+    query_cmd.add_argument("--region", choices=REGIONS[1:])
+    args = parser.parse_args()
+
+    if args.command == "build":
+        report = build(args.source, args.out)
+        print(f"✅ Built {args.out}: {report['entries']} entries, {report['questions']} questions, "
+              f"{report['terms']} terms, {report['bytes']:,} bytes.")
+        return
+    index = faq_index.load()
+    for match in index.search(args.question, args.region):
+        print(f"{match.score:.3f}  {match.entry_id} ({match.region})")
+
+if __name__ == "__main__":
+    main()
+# --- End of faq_index.py ---
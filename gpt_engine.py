@@ -1,9 +1,14 @@
 # --- gpt_engine.py ---
-from openai import OpenAI
-from memory import get_user_profile, get_chat_history
-from models import SessionLocal, User
+from llm_client import ResilientLLM, is_overload
+from memory import load_chat_turn, run_db
+from llm_cache import completion_cache, cache_key
+from tokens import TokenCounter, MESSAGE_OVERHEAD_TOKENS, REPLY_PRIMING_TOKENS
+from metrics import timed, stage, observe_stage, LLM_TOKENS, LLM_ERRORS
+from faq_index import faq_index, format_context, FAQ_ENABLED, NO_MATCH
+from collections import namedtuple
 import os
 import logging
+import time
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -16,7 +21,9 @@ load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
 if not api_key:
     logger.critical("OPENAI_API_KEY environment variable not set!")
-client = OpenAI(api_key=api_key)
+# Pooled client with deadlines, retries, a concurrency cap and a circuit breaker (llm_client.py).
+# The SDK client itself is built on the first call, or by llm.warm_up().
+llm = ResilientLLM(api_key=api_key)
 
 SYSTEM_PROMPT = """
 You are **Pension Guru**, a proactive, friendly financial guide for retirement planning in the UK and Ireland. Act autonomously to complete tasks, following instructions precisely.
@@ -55,6 +62,54 @@ You could expect €101.26/week by 2025. Would you like tips to boost your pensi
 """
 
 CHAT_HISTORY_LIMIT = 5  # Reduced to focus on recent context
+OPENAI_MODEL = "gpt-3.5-turbo"  # Change to "gpt-4.1" if available
+
+TONE_INSTRUCTIONS = {
+    "7": "Use very simple language, short sentences, and relatable examples a 7-year-old could understand.",
+    "14": "Explain ideas like you're talking to a 14-year-old. Be clear and concrete, avoid jargon.",
+    "adult": "Use plain English suitable for an average adult. Assume no special knowledge.",
+    "pro": "Use financial terminology and industry language for a professional audience.",
+    "genius": "Use technical depth and precision appropriate for a professor. Do not simplify.",
+}
+
+# Rendered once at startup; unknown tones get the prompt with no tone instruction
+SYSTEM_PROMPTS = {
+    tone: SYSTEM_PROMPT.replace("{{tone_instruction}}", instruction)
+    for tone, instruction in {"": "", **TONE_INSTRUCTIONS}.items()
+}
+
+# Token budget for everything sent per call: system prompt, profile, history and input.
+# History is filled newest first until the budget runs out; long messages are trimmed.
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+INPUT_TOKEN_LIMIT = int(os.getenv("INPUT_TOKEN_LIMIT", "1000"))  # the current user message
+HISTORY_MESSAGE_TOKEN_LIMIT = int(os.getenv("HISTORY_MESSAGE_TOKEN_LIMIT", "400"))
+
+token_counter = TokenCounter(OPENAI_MODEL)
+_SYSTEM_PROMPT_TOKENS = {}  # tone -> token count, filled on first use so import stays cheap
+
+def system_prompt_tokens(tone):
+    count = _SYSTEM_PROMPT_TOKENS.get(tone)
+    if count is None:
+        count = _SYSTEM_PROMPT_TOKENS[tone] = token_counter.count(SYSTEM_PROMPTS[tone])
+    return count
+
+TOKEN_STATS = {
+    "calls": 0,
+    "prompt_tokens": 0,
+    "completion_tokens": 0,
+    "max_prompt_tokens": 0,
+    "trimmed_messages": 0,
+    "dropped_messages": 0,
+}
+
+GPT_ERROR_REPLY = "I'm sorry, but I encountered a technical difficulty while processing your request. Please try again in a few moments."
+GPT_BUSY_REPLY = "I'm getting a lot of questions right now and couldn't answer in time. Please try again in a minute."
+
+def error_reply(error):
+    # Overload (rate limits, open breaker, deadline) gets a "busy" reply; anything else is a fault
+    if is_overload(error):
+        return GPT_BUSY_REPLY
+    return GPT_ERROR_REPLY
 
 def format_user_context(profile):
     if not profile:
@@ -75,13 +130,23 @@ def format_user_context(profile):
 
     return "User Profile Summary: " + "; ".join(parts)
 
-def get_gpt_response(user_input, user_id, tone=""):
+# FAQ answers are written for a general adult reader; these tones only get them as context
+FAQ_DIRECT_TONES = {"", "adult"}
+FAQ_MAX_CHARS = 300  # longer messages are not FAQ lookups
+
+def faq_lookup(user_input, profile, tone=""):
+    if not FAQ_ENABLED or len(user_input) > FAQ_MAX_CHARS:
+        return NO_MATCH
+    region = profile.region if profile else None
+    return faq_index.lookup(user_input, region, direct=tone in FAQ_DIRECT_TONES)
+
+@timed("get_gpt_response")
+async def get_gpt_response(user_input, user_id, tone="", turn=None):
     logger.info(f"get_gpt_response called for user_id: {user_id}")
-    profile = get_user_profile(user_id)
-    db = SessionLocal()
-    user = db.query(User).filter(User.id == user_id).first()
-    db.close()
-    name = user.name if user and user.name else "there"
+    if turn is None:
+        turn = await run_db(load_chat_turn, user_id, CHAT_HISTORY_LIMIT)
+    profile = turn.profile
+    name = turn.user_name or "there"
 
     if user_input.strip() == "__INIT__":
         logger.info(f"Handling __INIT__ message for user_id: {user_id}")
@@ -95,48 +160,138 @@ def get_gpt_response(user_input, user_id, tone=""):
             )
 
     logger.info(f"Processing regular message for user_id: {user_id}")
-    history = get_chat_history(user_id, limit=CHAT_HISTORY_LIMIT)
-    logger.debug(f"Retrieved {len(history)} messages from history for user_id: {user_id}")
-
-    profile_summary = format_user_context(profile)
-    tone_instruction = ""
-    if tone == "7":
-        tone_instruction = "Use very simple language, short sentences, and relatable examples a 7-year-old could understand."
-    elif tone == "14":
-        tone_instruction = "Explain ideas like you're talking to a 14-year-old. Be clear and concrete, avoid jargon."
-    elif tone == "adult":
-        tone_instruction = "Use plain English suitable for an average adult. Assume no special knowledge."
-    elif tone == "pro":
-        tone_instruction = "Use financial terminology and industry language for a professional audience."
-    elif tone == "genius":
-        tone_instruction = "Use technical depth and precision appropriate for a professor. Do not simplify."
-
-    system_message = SYSTEM_PROMPT.replace("{{tone_instruction}}", tone_instruction) + "\n\n" + profile_summary
-
-    logger.debug(f"Formatted profile summary: {profile_summary}")
-
-    messages = [{"role": "system", "content": system_message}]
-    for msg in history:
-        if msg["role"] in ['user', 'assistant']:
-            messages.append(msg)
-        else:
-            logger.warning(f"Skipping history message with invalid role '{msg['role']}' for user_id: {user_id}")
-
-    messages.append({"role": "user", "content": user_input})
+    faq = faq_lookup(user_input, profile, tone)
+    if faq.answer is not None:
+        logger.info(f"Answered from FAQ entry {faq.answer.entry_id} (score {faq.answer.score}) for user_id: {user_id}")
+        return faq.answer.answer
+    prompt = build_prompt(user_input, turn, tone, faq.context)
+    cached = await completion_cache.aget(prompt.key)
+    if cached is not None:
+        logger.info(f"Completion cache hit for user_id: {user_id}")
+        return cached
 
     try:
         logger.info(f"Calling OpenAI API for user_id: {user_id}...")
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",  # Change to "gpt-4.1" if available
-            messages=messages,
-            temperature=0.7
-        )
+        with stage("openai"):
+            response = await llm.complete(prompt.messages, model=OPENAI_MODEL, temperature=0.7)
         reply = response.choices[0].message.content
+        usage = getattr(response, "usage", None)
+        record_tokens(prompt, usage.completion_tokens if usage else token_counter.count(reply))
         logger.info(f"OpenAI API call successful for user_id: {user_id}")
         logger.debug(f"OpenAI Response: {reply}")
+        if reply:
+            await completion_cache.aset(prompt.key, reply)
     except Exception as e:
         logger.error(f"Error calling OpenAI API for user_id {user_id}: {e}", exc_info=True)
-        reply = "I'm sorry, but I encountered a technical difficulty while processing your request. Please try again in a few moments."
+        LLM_ERRORS.inc(1, e.__class__.__name__)
+        reply = error_reply(e)
 
     return reply
+
+async def stream_gpt_response(user_input, user_id, tone="", turn=None):
+    # Yields reply text deltas as they arrive; the caller assembles and persists the full reply
+    logger.info(f"stream_gpt_response called for user_id: {user_id}")
+    if turn is None:
+        turn = await run_db(load_chat_turn, user_id, CHAT_HISTORY_LIMIT)
+    faq = faq_lookup(user_input, turn.profile, tone)
+    if faq.answer is not None:
+        logger.info(f"Answered from FAQ entry {faq.answer.entry_id} (score {faq.answer.score}) for user_id: {user_id}")
+        yield faq.answer.answer
+        return
+    prompt = build_prompt(user_input, turn, tone, faq.context)
+    cached = await completion_cache.aget(prompt.key)
+    if cached is not None:
+        logger.info(f"Completion cache hit for user_id: {user_id}")
+        yield cached
+        return
+
+    received = False
+    parts = []
+    try:
+        started = time.perf_counter()
+        async for delta in llm.stream(prompt.messages, model=OPENAI_MODEL, temperature=0.7):
+            if not received:
+                observe_stage("openai_first_token", time.perf_counter() - started)
+            received = True
+            parts.append(delta)
+            yield delta
+        logger.info(f"OpenAI streaming call finished for user_id: {user_id}")
+        record_tokens(prompt, token_counter.count("".join(parts)))
+        if parts:
+            await completion_cache.aset(prompt.key, "".join(parts))
+    except Exception as e:
+        logger.error(f"Error streaming from OpenAI API for user_id {user_id}: {e}", exc_info=True)
+        LLM_ERRORS.inc(1, e.__class__.__name__)
+        if received:
+            raise
+        yield error_reply(e)
+
+Prompt = namedtuple("Prompt", ["messages", "key", "tokens", "trimmed", "dropped"])
+
+@timed("build_prompt")
+def build_prompt(user_input, turn, tone="", context=()):
+    user_id = turn.user_id
+    profile_summary = format_user_context(turn.profile)
+    logger.debug(f"Formatted profile summary: {profile_summary}")
+    if tone not in SYSTEM_PROMPTS:
+        tone = ""
+    summary = getattr(turn, "summary", None)
+    if summary is not None:
+        # The rolling summary stands in for everything older than the unsummarized messages
+        profile_summary += f"\n\nConversation summary so far: {summary.text}"
+    if context:
+        # Curated FAQ answers close to the question (faq_index.py)
+        profile_summary += "\n\n" + format_context(context)
+    system_message = SYSTEM_PROMPTS[tone] + "\n\n" + profile_summary
+
+    trimmed = 0
+    if token_counter.count(user_input) > INPUT_TOKEN_LIMIT:
+        user_input = token_counter.truncate(user_input, INPUT_TOKEN_LIMIT)
+        trimmed += 1
+    used = (system_prompt_tokens(tone) + token_counter.count(profile_summary) + token_counter.count(user_input)
+            + 2 * MESSAGE_OVERHEAD_TOKENS + REPLY_PRIMING_TOKENS)
+
+    # Newest history first, so the budget always keeps the most recent context
+    history = []
+    recent = turn.unsummarized_history()[-CHAT_HISTORY_LIMIT:]
+    for index in range(len(recent) - 1, -1, -1):
+        msg = recent[index]
+        if msg["role"] not in ['user', 'assistant']:
+            logger.warning(f"Skipping history message with invalid role '{msg['role']}' for user_id: {user_id}")
+            continue
+        content = msg["content"]
+        if token_counter.count(content) > HISTORY_MESSAGE_TOKEN_LIMIT:
+            content = token_counter.truncate(content, HISTORY_MESSAGE_TOKEN_LIMIT)
+            trimmed += 1
+        cost = token_counter.count(content) + MESSAGE_OVERHEAD_TOKENS
+        if used + cost > PROMPT_TOKEN_BUDGET:
+            break
+        used += cost
+        history.append({"role": msg["role"], "content": content})
+    history.reverse()
+    dropped = sum(1 for m in recent if m["role"] in ['user', 'assistant']) - len(history)
+    logger.debug(f"Using {len(history)} messages from history ({used} tokens) for user_id: {user_id}")
+
+    messages = [{"role": "system", "content": system_message}, *history, {"role": "user", "content": user_input}]
+    key = cache_key(OPENAI_MODEL, tone, profile_summary, history, user_input)
+    return Prompt(messages, key, used, trimmed, dropped)
+
+def record_tokens(prompt, completion_tokens):
+    TOKEN_STATS["calls"] += 1
+    LLM_TOKENS.inc(prompt.tokens, "prompt")
+    LLM_TOKENS.inc(completion_tokens or 0, "completion")
+    TOKEN_STATS["prompt_tokens"] += prompt.tokens
+    TOKEN_STATS["completion_tokens"] += completion_tokens or 0
+    TOKEN_STATS["max_prompt_tokens"] = max(TOKEN_STATS["max_prompt_tokens"], prompt.tokens)
+    TOKEN_STATS["trimmed_messages"] += prompt.trimmed
+    TOKEN_STATS["dropped_messages"] += prompt.dropped
+
+def token_stats():
+    calls = TOKEN_STATS["calls"]
+    return {
+        **TOKEN_STATS,
+        "avg_prompt_tokens": round(TOKEN_STATS["prompt_tokens"] / calls, 1) if calls else 0.0,
+        "budget": PROMPT_TOKEN_BUDGET,
+        "exact_tokenizer": token_counter.exact,
+    }
 # --- End of gpt_engine.py ---
\ No newline at end of file
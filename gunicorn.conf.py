@@ -0,0 +1,52 @@
+# --- gunicorn.conf.py ---
+# Multi-worker deployment: gunicorn supervising uvicorn worker processes.
+#
+#   gunicorn main:app -c gunicorn.conf.py
+#   WEB_CONCURRENCY=4 DATABASE_URL=postgres://... gunicorn main:app -c gunicorn.conf.py
+#
+# Every worker has its own event loop, DB pool, caches and PDF process pool, so with more
+# than one:
+#   - the database must be PostgreSQL, or SQLite in WAL mode on a local disk (storage.py
+#     enables WAL) with every worker on the same host;
+#   - chat turns are serialized per user through the turn_leases table (TURN_LOCK=db,
+#     set below) instead of only in process;
+#   - PDF_CACHE_DIR must be shared by the workers, which the default temp dir is on one host;
+#   - rate-limit buckets live in the rate_buckets table (RATE_LIMIT_BACKEND=db, set below).
+# `uvicorn main:app --workers N` works too, with TURN_LOCK=db and RATE_LIMIT_BACKEND=db set by hand.
+# Behind a proxy, FORWARDED_ALLOW_IPS lists the proxy addresses or CIDRs trusted for
+# X-Forwarded-For; the client IP, which the per-IP rate limit keys on, is then the rightmost
+# hop not in that list. "*" trusts every hop, so any client can pick its own IP.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", str(min(multiprocessing.cpu_count() * 2, 8))))
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))  # a worker whose loop is stuck this long is restarted
+graceful_timeout = 30  # in-flight turns and summary updates finish before a worker exits
+keepalive = 5
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "0"))  # recycle workers after N requests; 0 never
+max_requests_jitter = max_requests // 10
+preload_app = False  # engines, HTTP clients and thread pools are built in each worker, after the fork
+
+if workers > 1:
+    os.environ.setdefault("TURN_LOCK", "db")
+    os.environ.setdefault("RATE_LIMIT_BACKEND", "db")
+    # Each worker runs its own PDF pool; keep the total number of renderers modest
+    os.environ.setdefault("PDF_WORKERS", "1")
+
+def on_starting(server):
+    url = os.getenv("DATABASE_URL", "sqlite:///memory.db")
+    if workers > 1 and url.startswith("sqlite"):
+        if ":memory:" in url or url.split("://", 1)[1] in ("", "/"):
+            raise RuntimeError("In-memory SQLite cannot be shared by several workers; use a database file or PostgreSQL")
+        server.log.warning(f"{workers} workers on SQLite: supported on a single host in WAL mode; "
+                           f"use PostgreSQL to scale beyond that")
+    if workers > 1 and os.environ["TURN_LOCK"] != "db":
+        server.log.warning(f"TURN_LOCK={os.environ['TURN_LOCK']}: turns for one user can overlap across workers")
+    if os.getenv("FORWARDED_ALLOW_IPS", "").strip() == "*":
+        server.log.warning("FORWARDED_ALLOW_IPS=*: clients can set their own IP in X-Forwarded-For and "
+                           "bypass the per-IP rate limit; list the proxy's addresses or CIDR instead")
+    if workers > 1 and os.getenv("HISTORY_WRITE_BEHIND") == "1":
+        server.log.warning("HISTORY_WRITE_BEHIND=1 is ignored with several workers: chat history is written synchronously")
+# --- End of gunicorn.conf.py ---
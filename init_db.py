@@ -1,4 +1,5 @@
 from models import init_db
+from memory import run_sync
 
-init_db()
+run_sync(init_db)
 print("✅ Local database initialized.")
@@ -0,0 +1,209 @@
+# --- intents.py ---
+# Rule-based intent router for turns that need no LLM: accepting or declining a tips offer,
+# thanks, greetings, a bare region, PRSI years given in answer to the PRSI question and
+# "calculate my pension". Every rule's pattern is compiled into one alternation and the
+# normalized message is matched once; the winning rule then decides from the turn's profile
+# state (pending_action, region, prsi_years), never from the text of earlier messages.
+#
+# pending_action records what the last reply asked for, so the next turn can be routed:
+#   offer_tips       the reply offered tips ("Would you like tips to boost your pension?")
+#   ask_prsi_years   the reply asked "How many years of PRSI contributions ...?"
+# main.finish_standard_turn derives it from every reply with pending_action_after().
+#
+# Replies are templates per tone register; tones without their own variant use the default.
+from collections import Counter
+from pension_calculator import format_calculation, MAX_PRSI_YEARS
+import re
+
+AFFIRMATIVE = r"(?:yes|yeah|yep|sure|ok|okay|fine|please|go on|go ahead)(?: please| thanks| sure)?"
+NEGATIVE = r"(?:no|nope|nah|not now|no thanks|no thank you|not really|maybe later)(?: thanks)?"
+THANKS = r"(?:(?:ok(?:ay)? |great |perfect |brilliant )?(?:thanks|thank you|thx|cheers|ta)(?: so much| very much| a lot)?)"
+GREETING = r"(?:hi|hello|hey|hiya|good (?:morning|afternoon|evening))(?: there)?"
+REGION = r"(?:(?:i'?m|i am|i live|i'?m based|i am based|based|living)\s+)?(?:in\s+|from\s+)?(?:the\s+)?(?P<region_name>ireland|uk|united kingdom)"
+YEARS = r"(?P<years>\d{1,2})(?:\s+years?)?"
+# An explicit request ("can you calculate my state pension"), optionally with the PRSI years
+# spelled out as such; any other wording, an age or a time horizon goes to the LLM
+CALCULATE_PRSI_YEARS = r"(?P<calc_years>\d{1,2})\s+(?:prsi\s+(?:years?|yrs?)|(?:years?|yrs?)\s+of\s+(?:prsi\s+)?(?:prsi|contributions?))"
+CALCULATE = (r"(?:(?:please|can you|could you|would you|will you)\s+)?(?:please\s+)?calculate\s+(?:my\s+)?(?:state\s+)?pension"
+             rf"(?:\s+(?:for|with|using|on|based on)\s+{CALCULATE_PRSI_YEARS})?(?:\s+please)?")
+
+# Order matters only where patterns overlap: the first alternative that matches wins
+RULES = [
+    ("empty", r""),
+    ("affirmative", AFFIRMATIVE),
+    ("negative", NEGATIVE),
+    ("thanks", THANKS),
+    ("greeting", GREETING),
+    ("region", REGION),
+    ("prsi_years", YEARS),
+    ("calculate", CALCULATE),
+]
+
+_ROUTER = re.compile("|".join(f"(?P<{name}>{pattern})" for name, pattern in RULES))
+_TRAILING = re.compile(r"[\s.!?,]+$")
+_SPACES = re.compile(r"\s+")
+
+OFFER_PATTERN = re.compile(r"would you like tips|(?:improve|boost|increase) your pension.*\?")
+PRSI_QUESTION_PATTERN = re.compile(r"how many years of prsi contributions")
+
+# Tone register per request tone; anything else gets the default templates
+TONE_REGISTERS = {"7": "simple", "14": "simple", "pro": "expert", "genius": "expert"}
+
+TEMPLATES = {
+    "tips": {
+        "": (
+            "Great! Here are a few ways to boost your State Pension in Ireland:\n\n"
+            "1. **Keep Contributing**: Work and pay PRSI for up to 40 years to maximize your pension.\n"
+            "2. **Voluntary Contributions**: Check gaps in your record on MyWelfare.ie and make voluntary contributions if eligible.\n"
+            "3. **Credits**: You may qualify for credits for periods like childcare or unemployment.\n\n"
+            "Does that make sense? Check MyWelfare.ie or consult a financial advisor for personalized advice."
+        ),
+        "simple": (
+            "Great! Here are three ways to get a bigger State Pension later:\n\n"
+            "1. **Keep working and paying PRSI**: every year you pay counts, up to 40 years.\n"
+            "2. **Fill the gaps**: if some years are missing, you might be able to pay for them yourself.\n"
+            "3. **Credits**: some years when you're not working, like minding children, can still count.\n\n"
+            "Does that make sense? A grown-up can check your record on MyWelfare.ie."
+        ),
+        "expert": (
+            "Here are the main levers for the State Pension (Contributory):\n\n"
+            "1. **Contribution record**: the Total Contributions Approach pays a full rate at 2,080 paid or credited weeks (40 years).\n"
+            "2. **Voluntary contributions**: after leaving compulsory insurance, PRSI Class V (or A/S rates) can close gaps, subject to the application deadlines.\n"
+            "3. **Credits and HomeCaring Periods**: credited contributions and up to 20 years of HomeCaring Periods count towards the 40-year total.\n\n"
+            "Does that make sense? Verify your record on MyWelfare.ie and take regulated advice before acting."
+        ),
+    },
+    "decline": {
+        "": "No problem. Is there anything else about your pension you'd like to look at?",
+        "simple": "That's okay! Is there anything else about pensions you'd like to know?",
+        "expert": "Understood. Is there another aspect of your retirement planning you'd like to review?",
+    },
+    "thanks": {
+        "": "You're welcome, {name}! Is there anything else about your pension I can help with?",
+        "simple": "You're welcome, {name}! Ask me anything else about pensions whenever you like.",
+        "expert": "You're welcome, {name}. Let me know if you'd like to go through anything else in your plan.",
+    },
+    "greeting": {
+        "": "Hi {name}! What would you like to know about your pension today?",
+        "simple": "Hi {name}! What would you like to know about pensions today?",
+        "expert": "Hello {name}. Which part of your retirement planning would you like to look at?",
+    },
+    # For users who have not signed in, so have no name
+    "thanks_anonymous": {
+        "": "You're welcome! Is there anything else about your pension I can help with?",
+        "simple": "You're welcome! Ask me anything else about pensions whenever you like.",
+        "expert": "You're welcome. Let me know if you'd like to go through anything else in your plan.",
+    },
+    "greeting_anonymous": {
+        "": "Hi! What would you like to know about your pension today?",
+        "simple": "Hi! What would you like to know about pensions today?",
+        "expert": "Hello. Which part of your retirement planning would you like to look at?",
+    },
+    "region_ireland": {
+        "": "Great, you're in Ireland. To estimate your State Pension, how many years of PRSI contributions do you have?",
+        "simple": "Great, you live in Ireland! How many years of PRSI contributions do you have? That's how many years you've paid in at work.",
+        "expert": "Noted: Ireland. How many years of PRSI contributions (paid or credited) do you have? I'll estimate your State Pension (Contributory) from that.",
+    },
+    "region_known": {
+        "": "Thanks, I've noted that you're in {region}. What would you like to know about your pension?",
+        "simple": "Thanks! I've written down that you live in {region}. What would you like to know?",
+        "expert": "Noted: {region}. Which part of your retirement planning would you like to review?",
+    },
+}
+
+TIPS_REPLY = TEMPLATES["tips"][""]
+
+ROUTER_STATS = Counter()  # "turns", "fallthrough" and one count per intent served
+
+def normalize(message):
+    return _SPACES.sub(" ", _TRAILING.sub("", message.strip().lower()))
+
+def render(template, tone, **values):
+    variants = TEMPLATES[template]
+    text = variants.get(TONE_REGISTERS.get(tone, ""), variants[""])
+    return text.format(**values) if values else text
+
+def pending_action_after(reply):
+    # The state a reply leaves the conversation in; see the module comment
+    reply_lower = reply.lower() if reply else ""
+    if OFFER_PATTERN.search(reply_lower):
+        return "offer_tips"
+    if PRSI_QUESTION_PATTERN.search(reply_lower):
+        return "ask_prsi_years"
+    return None
+
+def _calculation(profile):
+    # Pure arithmetic once prsi_years is known (Irish State Pension only)
+    if profile is None or profile.prsi_years is None or profile.region == "UK":
+        return None
+    if not 0 <= profile.prsi_years <= MAX_PRSI_YEARS:
+        return None
+    return format_calculation(profile.prsi_years)
+
+def _calculation_for(turn, years):
+    # Years from this message win over the stored ones; the turn's commit() saves them
+    if not 0 <= years <= MAX_PRSI_YEARS:
+        return None
+    if turn.profile is None or turn.profile.prsi_years != years:
+        turn.set_profile_field("prsi_years", years)
+    return _calculation(turn.profile)
+
+def route(turn, message, tone=""):
+    # Returns (intent, reply) for a turn answered locally, or None to fall through to the LLM.
+    # Runs after extraction, so the turn's profile already holds fields from this message.
+    ROUTER_STATS["turns"] += 1
+    match = _ROUTER.fullmatch(normalize(message))
+    routed = _dispatch(turn, match, tone) if match else None
+    ROUTER_STATS[routed[0] if routed else "fallthrough"] += 1
+    return routed
+
+def _dispatch(turn, match, tone):
+    intent = match.lastgroup
+    profile = turn.profile
+    pending = profile.pending_action if profile else None
+
+    if intent == "empty":
+        # Pressing send on an empty box after a question means "go on"
+        if pending == "offer_tips":
+            return "tips", render("tips", tone)
+        if pending == "ask_prsi_years":
+            reply = _calculation(profile)
+            return ("calculation", reply) if reply else None
+        return None
+    if intent == "affirmative":
+        return ("tips", render("tips", tone)) if pending == "offer_tips" else None
+    if intent == "negative":
+        return ("decline", render("decline", tone)) if pending == "offer_tips" else None
+    if intent in ("thanks", "greeting"):
+        if turn.user_name:
+            return intent, render(intent, tone, name=turn.user_name)
+        return intent, render(f"{intent}_anonymous", tone)
+    if intent == "region":
+        # Only when extraction agreed: region is set once, so "UK" after "Ireland" goes to the LLM
+        named = "Ireland" if match.group("region_name") == "ireland" else "UK"
+        if profile is None or profile.region != named:
+            return None
+        if named == "Ireland" and profile.prsi_years is None:
+            return "region", render("region_ireland", tone)
+        return "region", render("region_known", tone, region="the UK" if named == "UK" else named)
+    if intent == "prsi_years":
+        if pending != "ask_prsi_years":
+            return None
+        reply = _calculation_for(turn, int(match.group("years")))
+        return ("calculation", reply) if reply else None
+    if intent == "calculate":
+        years = match.group("calc_years")
+        reply = _calculation_for(turn, int(years)) if years else _calculation(profile)
+        return ("calculation", reply) if reply else None
+    return None
+
+def router_stats():
+    turns = ROUTER_STATS["turns"]
+    served = turns - ROUTER_STATS["fallthrough"]
+    return {
+        "turns": turns,
+        "served_locally": served,
+        "hit_rate": round(served / turns, 3) if turns else 0.0,
+        "intents": {name: count for name, count in ROUTER_STATS.items() if name not in ("turns", "fallthrough")},
+    }
+# --- End of intents.py ---
@@ -0,0 +1,127 @@
+# --- llm_cache.py ---
+# Completion cache in front of the OpenAI call. Keys hash the normalized prompt context
+# (model, tone, profile summary, trimmed history, user input). An in-process LRU with TTL
+# answers most hits; setting LLM_CACHE_DB adds a SQLite tier that survives restarts.
+from memory import run_blocking
+from ttl_cache import TTLCache, MISS
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))  # 0 disables the in-process tier
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "3600"))  # seconds
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB")  # e.g. "llm_cache.db"; unset disables the persistent tier
+LLM_CACHE_PURGE_INTERVAL = float(os.getenv("LLM_CACHE_PURGE_INTERVAL", "600"))  # seconds between sweeps of the SQLite tier
+
+def _normalize(text):
+    return " ".join((text or "").lower().split())
+
+def cache_key(model, tone, profile_summary, history, user_input):
+    context = {
+        "model": model,
+        "tone": tone or "",
+        "profile": _normalize(profile_summary),
+        "history": [[m["role"], _normalize(m["content"])] for m in history],
+        "input": _normalize(user_input).rstrip("?!. "),
+    }
+    payload = json.dumps(context, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class CompletionCache:
+    def __init__(self, max_entries=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL, db_path=None):
+        self.ttl = ttl
+        self._memory = TTLCache(max_entries, ttl)
+        self._lock = threading.Lock()  # guards the shared SQLite connection
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.purged = 0
+        self._next_purge = 0.0
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS completion_cache ("
+                "key TEXT PRIMARY KEY, reply TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.commit()
+            logger.info(f"Persistent completion cache enabled at {db_path}")
+
+    def get(self, key):
+        reply = self._memory.get(key)
+        if reply is not MISS:
+            self.hits += 1
+            return reply
+        if self._db is not None:
+            now = time.time()
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT reply, expires_at FROM completion_cache WHERE key = ?", (key,)
+                ).fetchone()
+            if row and row[1] > now:
+                self._memory.set(key, row[0], ttl=row[1] - now)
+                self.hits += 1
+                self.disk_hits += 1
+                return row[0]
+            if row:
+                with self._lock:
+                    self._db.execute("DELETE FROM completion_cache WHERE key = ? AND expires_at <= ?", (key, now))
+                    self._db.commit()
+        self.misses += 1
+        return None
+
+    def set(self, key, reply):
+        self._memory.set(key, reply)
+        if self._db is not None:
+            now = time.time()
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO completion_cache (key, reply, expires_at) VALUES (?, ?, ?)",
+                    (key, reply, now + self.ttl)
+                )
+                self._db.commit()
+            # Entries that are never read again would otherwise stay on disk for good
+            if now >= self._next_purge:
+                self._next_purge = now + LLM_CACHE_PURGE_INTERVAL
+                self.purge_expired()
+
+    # The SQLite tier does file I/O, so async callers hand it to the thread pool
+    async def aget(self, key):
+        if self._db is None:
+            return self.get(key)
+        return await run_blocking(self.get, key)
+
+    async def aset(self, key, reply):
+        if self._db is None:
+            return self.set(key, reply)
+        return await run_blocking(self.set, key, reply)
+
+    def purge_expired(self):
+        # Both tiers; set() calls it every LLM_CACHE_PURGE_INTERVAL seconds
+        self._memory.purge_expired()
+        if self._db is not None:
+            with self._lock:
+                self.purged += self._db.execute("DELETE FROM completion_cache WHERE expires_at <= ?", (time.time(),)).rowcount
+                self._db.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "purged": self.purged,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": len(self._memory),
+            "persistent": self._db is not None,
+        }
+
+completion_cache = CompletionCache(db_path=LLM_CACHE_DB)
+# --- End of llm_cache.py ---
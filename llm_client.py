@@ -0,0 +1,355 @@
+# --- llm_client.py ---
+# Resilient wrapper around the OpenAI chat completions API, shared by every caller in the
+# process: one pooled HTTP client, a global concurrency cap, per-call deadlines, jittered
+# exponential retry on 429/5xx/connection errors, optional hedging of slow calls after the
+# observed p95, and a circuit breaker that fails fast while the API is down.
+#
+#   OPENAI_BASE_URL       point at another endpoint, e.g. fake_openai.py (python fake_openai.py)
+#   LLM_DEADLINE          seconds for a whole call including retries (streams: to the first token)
+#   LLM_HEDGE=1           send a second copy of a call still running after the p95 latency
+#
+# The openai SDK and its HTTP client are imported and built on first use (or by warm_up),
+# not at import: they are about half of the app's import time.
+from collections import deque
+import asyncio
+import logging
+import math
+import os
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))  # in-flight calls per process
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "30"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))  # seconds, doubled per attempt
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1"))  # never hedge sooner than this
+LLM_HEDGE_MIN_SAMPLES = 50  # latencies needed before p95 is trusted
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))  # consecutive failed calls
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))  # seconds open before a trial call
+LATENCY_WINDOW = 500
+
+class CircuitOpenError(Exception):
+    pass
+
+class LLMDeadlineError(Exception):
+    pass
+
+def is_retryable(error):
+    import openai
+
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+def is_overload(error):
+    # Errors that mean "busy, try later" rather than a fault
+    import openai
+
+    return isinstance(error, (CircuitOpenError, LLMDeadlineError, openai.RateLimitError))
+
+def retry_after(error):
+    # Seconds the server asked us to wait, if it said so
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+class CircuitBreaker:
+    # closed -> open after `failures` consecutive failed calls; after `cooldown` seconds one
+    # trial call is let through (half-open) and its outcome closes or reopens the circuit
+    def __init__(self, failures=LLM_BREAKER_FAILURES, cooldown=LLM_BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.consecutive = 0
+        self.opened_at = None
+        self.trial = False
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.trial:
+            self.trial = True
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self):
+        self.consecutive = 0
+        self.opened_at = None
+        self.trial = False
+
+    def release(self):
+        # The trial ended without a verdict (cancelled, or a stream closed early): the next
+        # call becomes the trial instead of the circuit staying half-open for good
+        self.trial = False
+
+    def failure(self):
+        self.consecutive += 1
+        if self.trial or (self.opened_at is None and self.failures and self.consecutive >= self.failures):
+            self.opened += 1
+            self.opened_at = time.monotonic()
+            self.trial = False
+            logger.warning(f"OpenAI circuit breaker open for {self.cooldown}s after {self.consecutive} failures")
+
+class RateLimiter:
+    # Caps calls in flight and paces their starts to `rate` per second (0: unpaced). One
+    # instance is shared by every caller that should count against the same budget.
+    def __init__(self, rate, concurrency):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self._next_start = 0.0
+        self.stats = {"calls": 0, "paced": 0, "waited_seconds": 0.0}
+
+    async def __aenter__(self):
+        started = time.monotonic()
+        await self.semaphore.acquire()
+        try:
+            if self.interval:
+                now = time.monotonic()
+                start_at = max(now, self._next_start)
+                self._next_start = start_at + self.interval
+                if start_at > now:
+                    self.stats["paced"] += 1
+                    await asyncio.sleep(start_at - now)
+        except BaseException:
+            self.semaphore.release()
+            raise
+        self.stats["calls"] += 1
+        self.stats["waited_seconds"] += time.monotonic() - started
+        return self
+
+    async def __aexit__(self, *exc):
+        self.semaphore.release()
+
+class LatencyTracker:
+    def __init__(self, window=LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+        self._p95 = None
+        self._stale = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self._stale += 1
+
+    def percentile(self, pct):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+    def p95(self):
+        # Re-sorted every 20 samples, not per call
+        if len(self.samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        if self._p95 is None or self._stale >= 20:
+            self._p95 = self.percentile(95)
+            self._stale = 0
+        return self._p95
+
+class ResilientLLM:
+    def __init__(self, api_key=None, base_url=None, max_concurrency=LLM_MAX_CONCURRENCY, deadline=LLM_DEADLINE,
+                 max_retries=LLM_MAX_RETRIES, backoff_base=LLM_BACKOFF_BASE, backoff_max=LLM_BACKOFF_MAX,
+                 hedge=LLM_HEDGE, hedge_min_delay=LLM_HEDGE_MIN_DELAY, breaker=None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self._client = None
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = LatencyTracker()
+        self.stats = {"calls": 0, "failures": 0, "retries": 0, "deadline_exceeded": 0, "hedges": 0, "hedge_wins": 0}
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import AsyncOpenAI, DefaultAsyncHttpxClient, Timeout
+            import httpx
+
+            # Keep-alive connections sized to the concurrency cap; the SDK's own retries are
+            # off because retry, deadline and breaker policy live here
+            http_client = DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=self.max_concurrency * 2,
+                                    max_keepalive_connections=self.max_concurrency),
+                timeout=Timeout(self.deadline, connect=LLM_CONNECT_TIMEOUT),
+            )
+            base_url = self.base_url or os.getenv("OPENAI_BASE_URL") or None
+            self._client = AsyncOpenAI(api_key=self.api_key, base_url=base_url, max_retries=0, http_client=http_client)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        # Lets benchmarks swap in a stub without building the real client
+        self._client = client
+
+    def warm_up(self):
+        return self.client
+
+    def _backoff(self, attempt, error):
+        # Full jitter: uniform in [0, base * 2^attempt], capped; Retry-After wins when larger
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        hinted = retry_after(error)
+        return max(delay, min(hinted, self.backoff_max)) if hinted is not None else delay
+
+    async def _call(self, ends_at, **params):
+        remaining = ends_at - time.monotonic()
+        if remaining <= 0:
+            raise LLMDeadlineError("OpenAI call deadline exceeded")
+        try:
+            return await asyncio.wait_for(self.client.chat.completions.create(timeout=remaining, **params), remaining)
+        except asyncio.TimeoutError:
+            raise LLMDeadlineError("OpenAI call deadline exceeded") from None
+
+    async def _hedged(self, ends_at, **params):
+        # Starts a second copy when the first is slower than p95 and a concurrency slot is
+        # free; the first to succeed wins and the other is cancelled
+        delay = self.latency.p95() if self.hedge else None
+        if delay is None:
+            return await self._call(ends_at, **params)
+        first = asyncio.ensure_future(self._call(ends_at, **params))
+        pending = {first}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=max(delay, self.hedge_min_delay))
+            if done or self.semaphore.locked():
+                return await first
+            async with self.semaphore:
+                self.stats["hedges"] += 1
+                second = asyncio.ensure_future(self._call(ends_at, **params))
+                pending.add(second)
+                error = None
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is None:
+                            if task is second:
+                                self.stats["hedge_wins"] += 1
+                            return task.result()
+                        error = task.exception()
+                raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def complete(self, messages, deadline=None, **params):
+        # Returns the completion response; raises CircuitOpenError, LLMDeadlineError or the
+        # last API error once retries or the deadline run out
+        self.stats["calls"] += 1
+        trial = self.breaker.state == "half-open"
+        if not self.breaker.allow():
+            raise CircuitOpenError("OpenAI circuit breaker is open")
+        try:
+            ends_at = time.monotonic() + (deadline or self.deadline)
+            attempt = 0
+            async with self.semaphore:
+                while True:
+                    started = time.monotonic()
+                    try:
+                        response = await self._hedged(ends_at, messages=messages, **params)
+                    except Exception as e:
+                        pause = self._backoff(attempt, e) if is_retryable(e) else None
+                        if pause is None or attempt >= self.max_retries or time.monotonic() + pause >= ends_at:
+                            self._failed(e)
+                            raise
+                        attempt += 1
+                        self.stats["retries"] += 1
+                        logger.warning(f"OpenAI call failed ({e.__class__.__name__}), retry {attempt} in {pause:.2f}s")
+                        await asyncio.sleep(pause)
+                        continue
+                    self.latency.add(time.monotonic() - started)
+                    self.breaker.success()
+                    return response
+        finally:
+            if trial:
+                self.breaker.release()
+
+    async def stream(self, messages, deadline=None, **params):
+        # Async generator of text deltas. Retries only happen before the first chunk; once
+        # text has been yielded a failure is raised to the caller.
+        self.stats["calls"] += 1
+        trial = self.breaker.state == "half-open"
+        if not self.breaker.allow():
+            raise CircuitOpenError("OpenAI circuit breaker is open")
+        try:
+            ends_at = time.monotonic() + (deadline or self.deadline)
+            attempt = 0
+            async with self.semaphore:
+                while True:
+                    started = time.monotonic()
+                    received = False
+                    try:
+                        remaining = ends_at - time.monotonic()
+                        if remaining <= 0:
+                            raise LLMDeadlineError("OpenAI call deadline exceeded")
+                        # The deadline bounds the wait for the first chunk; later chunks are
+                        # bounded by the HTTP read timeout
+                        stream = await asyncio.wait_for(
+                            self.client.chat.completions.create(messages=messages, stream=True, **params), remaining)
+                        async for chunk in stream:
+                            delta = chunk.choices[0].delta.content if chunk.choices else None
+                            if delta:
+                                if not received:
+                                    self.latency.add(time.monotonic() - started)
+                                received = True
+                                yield delta
+                    except Exception as e:
+                        if isinstance(e, asyncio.TimeoutError):
+                            e = LLMDeadlineError("OpenAI call deadline exceeded")
+                        pause = self._backoff(attempt, e) if is_retryable(e) and not received else None
+                        if pause is None or attempt >= self.max_retries or time.monotonic() + pause >= ends_at:
+                            self._failed(e)
+                            raise e
+                        attempt += 1
+                        self.stats["retries"] += 1
+                        logger.warning(f"OpenAI stream failed ({e.__class__.__name__}), retry {attempt} in {pause:.2f}s")
+                        await asyncio.sleep(pause)
+                        continue
+                    self.breaker.success()
+                    return
+        finally:
+            if trial:
+                self.breaker.release()
+
+    def _failed(self, error):
+        self.stats["failures"] += 1
+        if isinstance(error, LLMDeadlineError):
+            self.stats["deadline_exceeded"] += 1
+        # Rate limits are throttling, and client errors (bad request, auth) say nothing
+        # about the API's health; neither counts towards opening the circuit
+        if isinstance(error, LLMDeadlineError) or (is_retryable(error) and not is_overload(error)):
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            "breaker": self.breaker.state,
+            "breaker_opened": self.breaker.opened,
+            "breaker_rejected": self.breaker.rejected,
+            "p50_seconds": self.latency.percentile(50),
+            "p95_seconds": self.latency.percentile(95),
+            "hedging": self.hedge,
+        }
+# --- End of llm_client.py ---
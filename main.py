@@ -1,28 +1,92 @@
 # --- main.py ---
 from fastapi import FastAPI
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
-from gpt_engine import get_gpt_response
-from memory import get_user_profile, save_user_profile, save_chat_message, get_chat_history
-from models import init_db, User, SessionLocal, UserProfile, ChatHistory
+from gpt_engine import get_gpt_response, stream_gpt_response, token_stats, llm, token_counter, CHAT_HISTORY_LIMIT
+from llm_cache import completion_cache
+from memory import get_user_profile, forget_user, profile_cache_stats, ChatTurn, load_chat_turn, load_chat_turns, commit_chat_turns, get_keyed_reply, history_queue, history_stats, run_db, run_blocking, upsert_google_user, get_latest_message_id, iter_chat_history, iterate_db
+from export import EXPORT_FORMATS, EXPORT_PDF_MAX_MESSAGES, ExportRow, export_stream
+from pdf_worker import pdf_renderer, artifact_key, PdfQueueFull
+from extraction import extract, extract_batch
+from llm_client import RateLimiter
+from faq_index import FAQ_ENABLED, faq_index, faq_stats
+from intents import pending_action_after, route as route_intent, router_stats
+from pension_calculator import weekly_pensions, MAX_PRSI_YEARS, WEEKS_PER_YEAR
+from models import init_db
+from conversation_summary import maybe_schedule_summary, drain_summaries, summary_stats, SUMMARY_WINDOW
+from metrics import METRICS_ENABLED, MetricsMiddleware, collector, render as render_metrics, timed
+from turn_lock import MULTI_WORKER, TurnBusy, turn_lock, turn_lock_stats
+from rate_limit import FlightAborted, RateLimited, chat_flights, check_rate_limit, client_ip, follow, rate_limit_stats
+from retention import RETENTION_DAYS, retention_loop, retention_stats
+from models import DB_STATS
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse
-from weasyprint import HTML
-from io import BytesIO
-import re
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse, FileResponse, PlainTextResponse, JSONResponse
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+from datetime import datetime, timezone
+import json
+import math
 import logging
 import os
-from typing import Optional
+import time
+import asyncio
+from typing import Optional, List
 
 os.environ["G_MESSAGES_DEBUG"] = ""
 
-# Configure logging
-logging.basicConfig(level=logging.WARNING)
+# Configure logging; LOG_LEVEL=INFO shows the per-request logger.info trail
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
 logger = logging.getLogger(__name__)
 
 load_dotenv()
-app = FastAPI()
+
+# The OpenAI SDK, tokenizer and PDF workers load on first use. STARTUP_WARMUP loads them in
+# the background right after startup instead: "llm", "pdf", "llm,pdf" or "all".
+STARTUP_WARMUP = {part.strip() for part in os.getenv("STARTUP_WARMUP", "").lower().split(",") if part.strip()}
+
+async def warm_up(parts):
+    started = time.perf_counter()
+    try:
+        if parts & {"llm", "all"}:
+            # Off the loop: importing the SDK takes a few hundred ms
+            await run_blocking(llm.warm_up)
+            await run_blocking(token_counter.count, "warm up")
+        if parts & {"pdf", "all"}:
+            for future in pdf_renderer.warm_up():
+                error = await asyncio.wrap_future(future)
+                if error:
+                    logger.warning(f"PDF worker warm-up could not load WeasyPrint: {error}")
+        logger.info(f"Warm-up of {', '.join(sorted(parts))} finished in {time.perf_counter() - started:.2f}s")
+    except Exception as e:
+        logger.warning(f"Warm-up failed, subsystems will load on first use: {e}", exc_info=True)
+
+@asynccontextmanager
+async def lifespan(app):
+    # Create DB table(s). Runs through run_db so async drivers get their greenlet context.
+    logger.info("Initializing database...")
+    await run_db(init_db)
+    logger.info("Database initialized.")
+    history_queue.start()
+    if FAQ_ENABLED:
+        try:
+            # Maps the FAQ index (building it first if faq.json changed); milliseconds
+            await run_blocking(faq_index.load)
+        except (OSError, ValueError) as e:
+            logger.error(f"FAQ index could not be loaded, FAQ questions go to the LLM: {e}")
+            faq_index.unavailable = True
+    warmup = asyncio.create_task(warm_up(STARTUP_WARMUP)) if STARTUP_WARMUP else None
+    retention = asyncio.create_task(retention_loop()) if RETENTION_DAYS > 0 else None
+    yield
+    for task in (warmup, retention):
+        if task is not None:
+            task.cancel()
+    await history_queue.close()
+    await drain_summaries()
+    pdf_renderer.shutdown()
+    faq_index.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # Allow CORS so frontend can connect
 app.add_middleware(
@@ -32,204 +96,410 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(TurnBusy)
+async def turn_busy_handler(request, exc):
+    logger.warning(str(exc))
+    return JSONResponse(status_code=409, headers={"Retry-After": "1"},
+                        content={"detail": "A previous message from this user is still being processed."})
+
+@app.exception_handler(RateLimited)
+async def rate_limited_handler(request, exc):
+    return JSONResponse(status_code=429, headers={"Retry-After": str(math.ceil(exc.retry_after))},
+                        content={"detail": str(exc)})
+
+@app.exception_handler(FlightAborted)
+async def flight_aborted_handler(request, exc):
+    return JSONResponse(status_code=503, headers={"Retry-After": "1"},
+                        content={"detail": "An identical request did not complete, please retry."})
 
-# Create DB table(s)
-logger.info("Initializing database...")
-init_db()
-logger.info("Database initialized.")
 
 class ChatRequest(BaseModel):
     user_id: str
     message: str
     tone: str = ""
+    # Client-chosen id for this message; a retry with the same id gets the stored reply
+    message_id: Optional[str] = Field(None, max_length=128)
 
-# Set of affirmative responses for state checking
-affirmative_responses = {"sure", "yes", "ok", "okay", "fine", "yep", "please", "yes please"}
+GPT_ERROR_REPLY = "I'm sorry, I encountered a technical issue trying to process that. Could you try rephrasing?"
+# History loaded per turn: the prompt's window, or the summary backlog if that is longer
+HISTORY_WINDOW = max(CHAT_HISTORY_LIMIT, SUMMARY_WINDOW)
 
 @app.post("/chat")
-async def chat(req: ChatRequest):
+async def chat(req: ChatRequest, request: Request):
     user_id = req.user_id
     user_message = req.message.strip()
-    user_message_lower = user_message.lower()
     logger.info(f"Received chat request from user_id: {user_id}, message: '{user_message}'")
 
-    # --- Handle __INIT__ separately ---
-    if user_message == "__INIT__":
-        logger.info(f"Handling __INIT__ command for user_id: {user_id}")
-        reply = get_gpt_response(user_message, user_id, tone=req.tone)
+    # A repeat of a message still in flight shares its reply instead of running a second turn
+    key = (user_id, user_message, req.tone)
+    leader = chat_flights.join(key)
+    if leader is not None:
+        logger.info(f"Coalescing duplicate chat request from user_id: {user_id}")
+        return {"response": await follow(leader)}
+
+    # Led before the rate check, which can await the database, so duplicates see it at once
+    flight = chat_flights.lead(key)
+    reply, error = None, None
+    try:
+        await check_rate_limit(user_id, client_ip(request))
+        reply = await run_chat_turn(req, user_id, user_message)
         return {"response": reply}
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        chat_flights.done(key, flight, reply, error)
+
+async def run_chat_turn(req, user_id, user_message):
+    # One turn per user at a time, from load to commit
+    async with turn_lock(user_id):
+        turn = await run_db(load_chat_turn, user_id, HISTORY_WINDOW, MULTI_WORKER)
+        reply = await handle_direct_turn(req, turn, user_message)
+        if reply is not None:
+            return reply
+
+        # --- Standard Chat Flow ---
+        reply = prepare_standard_turn(turn, user_message, req.tone)
+        if reply is None:
+            try:
+                reply = await get_gpt_response(user_message, user_id, tone=req.tone, turn=turn)
+                logger.info(f"GPT response generated successfully for user_id: {user_id}")
+            except Exception as e:
+                logger.error(f"Error getting GPT response for user_id: {user_id}: {e}", exc_info=True)
+                reply = GPT_ERROR_REPLY
+
+        await finish_standard_turn(turn, user_message, reply, req.message_id)
+        return reply
+
+# Stop proxies (Render, nginx) from buffering the event stream
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def sse_event(data, event=None):
+    payload = json.dumps(data, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
+
+async def single_event(reply):
+    yield sse_event({"token": reply})
+    yield sse_event({"response": reply}, event="done")
+
+async def releasing(events, lock, key, flight):
+    # Streamed turns commit at the end of the stream, so the user's lock is held until then.
+    # A stream that ends without resolving its flight (client gone) aborts the followers.
+    try:
+        async for event in events:
+            yield event
+    finally:
+        chat_flights.done(key, flight)
+        await lock.release()
 
-    # --- Handle Empty Input ---
-    if not user_message:
-        logger.warning(f"Received empty message from user_id: {user_id}")
-        profile = get_user_profile(user_id)
-        history = get_chat_history(user_id, limit=2)
-        if (profile and hasattr(profile, 'pending_action') and profile.pending_action == "offer_tips" or
-                (history and len(history) >= 2 and any(keyword in history[-2]["content"].lower() for keyword in [
-                    "would you like tips", "boost your pension", "improve your pension", "increase your pension"]))):
-            logger.info(f"Empty input after tips offer for user {user_id}. Delivering tips.")
-            save_user_profile(user_id, "pending_action", None)  # Clear pending action
-            reply = (
-                "Great! Here are a few ways to boost your State Pension in Ireland:\n\n"
-                "1. **Keep Contributing**: Work and pay PRSI for up to 40 years to maximize your pension.\n"
-                "2. **Voluntary Contributions**: Check gaps in your record on MyWelfare.ie and make voluntary contributions if eligible.\n"
-                "3. **Credits**: You may qualify for credits for periods like childcare or unemployment.\n\n"
-                "Does that make sense? Check MyWelfare.ie or consult a financial advisor for personalized advice."
-            )
-            save_chat_message(user_id, 'assistant', reply)
-            return {"response": reply}
-        elif (profile and hasattr(profile, 'prsi_years') and profile.prsi_years is not None and
-                history and len(history) >= 2 and "how many years of prsi contributions" in history[-2]["content"].lower()):
-            logger.info(f"Empty input after PRSI question for user {user_id}. Using profile PRSI years: {profile.prsi_years}")
-            reply = get_gpt_response(f"Calculate pension for {profile.prsi_years} PRSI years", user_id, tone=req.tone)
-            save_chat_message(user_id, 'assistant', reply)
-            return {"response": reply}
-        raise HTTPException(status_code=400, detail="Message cannot be empty")
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest, request: Request):
+    user_id = req.user_id
+    user_message = req.message.strip()
+    logger.info(f"Received streaming chat request from user_id: {user_id}, message: '{user_message}'")
 
-    # --- State Handling Logic ---
-    profile = get_user_profile(user_id)
-    give_tips_directly = False
-    if profile and hasattr(profile, 'pending_action') and profile.pending_action == "offer_tips":
-        logger.info(f"User {user_id} has pending_action 'offer_tips'. Checking response: '{user_message_lower}'")
-        if user_message_lower in affirmative_responses:
-            logger.info(f"User {user_id} confirmed wanting tips. Delivering tips.")
-            give_tips_directly = True
-        else:
-            logger.info(f"User {user_id} did not confirm tips. Clearing pending_action to reset state.")
-            save_user_profile(user_id, "pending_action", None)  # Clear if non-affirmative to avoid looping
-    elif profile:  # Only check history if no pending_action to avoid redundant checks
-        history = get_chat_history(user_id, limit=2)
-        if (history and len(history) >= 2 and
-                any(keyword in history[-2]["content"].lower() for keyword in [
-                    "would you like tips", "boost your pension", "improve your pension", "increase your pension"]) and
-                user_message_lower in affirmative_responses):
-            logger.info(f"Detected affirmative response to tips offer in history for user {user_id}")
-            give_tips_directly = True
-
-    # --- Direct Tips Response ---
-    if give_tips_directly:
-        reply = (
-            "Great! Here are a few ways to boost your State Pension in Ireland:\n\n"
-            "1. **Keep Contributing**: Work and pay PRSI for up to 40 years to maximize your pension.\n"
-            "2. **Voluntary Contributions**: Check gaps in your record on MyWelfare.ie and make voluntary contributions if eligible.\n"
-            "3. **Credits**: You may qualify for credits for periods like childcare or unemployment.\n\n"
-            "Does that make sense? Check MyWelfare.ie or consult a financial advisor for personalized advice."
-        )
-        logger.info(f"Generated predefined tips for user {user_id}")
-        save_user_profile(user_id, "pending_action", None)  # Clear after delivering tips
-        save_chat_message(user_id, 'user', user_message)
-        save_chat_message(user_id, 'assistant', reply)
-        return {"response": reply}
+    # Duplicates of an in-flight message get the finished reply as a single event
+    key = (user_id, user_message, req.tone)
+    leader = chat_flights.join(key)
+    if leader is not None:
+        logger.info(f"Coalescing duplicate streaming request from user_id: {user_id}")
+        reply = await follow(leader)
+        return StreamingResponse(single_event(reply), media_type="text/event-stream", headers=SSE_HEADERS)
 
-    # --- Standard Chat Flow ---
-    logger.info(f"Proceeding with standard chat flow for user {user_id}")
+    flight = chat_flights.lead(key)
     try:
-        extract_user_data(user_id, user_message)
-        profile = get_user_profile(user_id)
-    except Exception as e:
-        logger.error(f"Error extracting data for user {user_id}: {e}", exc_info=True)
-
-    reply = ""
+        await check_rate_limit(user_id, client_ip(request))
+        lock = await turn_lock(user_id).acquire()
+    except BaseException as e:
+        chat_flights.done(key, flight, error=e)
+        raise
+    try:
+        # The __INIT__ greeting and replayed replies store nothing, so they go out as a single event
+        turn = await run_db(load_chat_turn, user_id, HISTORY_WINDOW, MULTI_WORKER)
+        reply = await handle_direct_turn(req, turn, user_message)
+        if reply is not None:
+            await lock.release()
+            chat_flights.done(key, flight, reply)
+            return StreamingResponse(single_event(reply), media_type="text/event-stream", headers=SSE_HEADERS)
+        reply = prepare_standard_turn(turn, user_message, req.tone)
+    except BaseException as e:
+        await lock.release()
+        chat_flights.done(key, flight, error=e)
+        raise
+
+    if reply is not None:
+        async def local_event():
+            await finish_standard_turn(turn, user_message, reply, req.message_id)
+            chat_flights.done(key, flight, reply)
+            async for event in single_event(reply):
+                yield event
+        return StreamingResponse(releasing(local_event(), lock, key, flight), media_type="text/event-stream",
+                                 headers=SSE_HEADERS)
+
+    async def token_events():
+        parts = []
+        try:
+            async for token in stream_gpt_response(user_message, user_id, tone=req.tone, turn=turn):
+                parts.append(token)
+                yield sse_event({"token": token})
+        except Exception as e:
+            logger.error(f"Error streaming GPT response for user_id: {user_id}: {e}", exc_info=True)
+            if not parts:
+                parts.append(GPT_ERROR_REPLY)
+                yield sse_event({"token": GPT_ERROR_REPLY})
+        reply = "".join(parts)
+        await finish_standard_turn(turn, user_message, reply, req.message_id)
+        chat_flights.done(key, flight, reply)
+        yield sse_event({"response": reply}, event="done")
+
+    return StreamingResponse(releasing(token_events(), lock, key, flight), media_type="text/event-stream",
+                             headers=SSE_HEADERS)
+
+# --- Batch Chat ---
+# Many users' messages in one request, e.g. an adviser uploading client answers. Each user's
+# messages run in order under that user's turn lock; different users run concurrently.
+# Extraction runs once over the whole batch, turns are loaded in one session and committed
+# in shared transactions, and OpenAI calls from all batches share one rate limit so bulk
+# traffic cannot crowd out /chat. Results stream back as NDJSON lines as they complete.
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "8"))  # process-wide, all batches
+BATCH_LLM_RATE = float(os.getenv("BATCH_LLM_RATE", "20"))  # OpenAI calls started per second, 0 for no pacing
+
+batch_limiter = RateLimiter(BATCH_LLM_RATE, BATCH_LLM_CONCURRENCY)
+BATCH_STATS = {"batches": 0, "items": 0, "failed": 0, "commits": 0}
+_batch_tasks = set()
+
+class ChatBatchRequest(BaseModel):
+    items: List[ChatRequest]
+
+@app.post("/chat/batch")
+async def chat_batch(req: ChatBatchRequest, request: Request):
+    if not req.items:
+        raise HTTPException(status_code=400, detail="Batch has no items")
+    if len(req.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch has {len(req.items)} items, the limit is {BATCH_MAX_ITEMS}")
+    # Batches are paced by batch_limiter; the per-user buckets are meant for interactive chat
+    await check_rate_limit(ip=client_ip(request))
+    logger.info(f"Received chat batch of {len(req.items)} items")
+
+    # Runs as its own task so a client that disconnects mid-stream does not abort the writes
+    results = asyncio.Queue()
+    task = asyncio.get_running_loop().create_task(run_chat_batch(req.items, results))
+    _batch_tasks.add(task)
+    task.add_done_callback(_batch_tasks.discard)
+
+    async def lines():
+        while True:
+            record = await results.get()
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+            if record["type"] == "done":
+                return
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+async def run_chat_batch(items, results):
+    started = time.perf_counter()
+    groups = {}
+    for index, item in enumerate(items):
+        groups.setdefault(item.user_id, []).append(index)
+    messages = [item.message.strip() for item in items]
+    extracted = extract_batch(messages)
+    reported = set()
+    failed = []
+
+    def report(index, **record):
+        reported.add(index)
+        results.put_nowait({"index": index, "user_id": items[index].user_id, **record})
+
+    def fail(index, status, detail):
+        failed.append(index)
+        report(index, type="error", status=status, detail=detail)
+
+    async def answer(turn, index):
+        item, message = items[index], messages[index]
+        reply = await handle_direct_turn(item, turn, message)
+        if reply is not None:
+            return reply, 0
+        reply = prepare_standard_turn(turn, message, item.tone, extracted[index])
+        if reply is None:
+            try:
+                async with batch_limiter:
+                    reply = await get_gpt_response(message, turn.user_id, tone=item.tone, turn=turn)
+            except Exception as e:
+                logger.error(f"Error getting GPT response for user_id: {turn.user_id}: {e}", exc_info=True)
+                reply = GPT_ERROR_REPLY
+        record_turn(turn, message, reply, item.message_id)
+        # The user's next message in this batch sees this exchange in its prompt
+        exchange = [(role, content) for role, content in (("user", message), ("assistant", reply)) if content]
+        turn.extend_history(exchange)
+        return reply, len(exchange)
+
+    locks = {user_id: turn_lock(user_id) for user_id in groups}
+    finished = asyncio.Queue()  # (turn, lock, new messages) per user, waiting to be committed
     try:
-        reply = get_gpt_response(user_message, user_id, tone=req.tone)
-        logger.info(f"GPT response generated successfully for user_id: {user_id}")
+        acquired = await asyncio.gather(*(lock.acquire() for lock in locks.values()), return_exceptions=True)
+        ready = []
+        for user_id, outcome in zip(groups, acquired):
+            if isinstance(outcome, TurnBusy):
+                for index in groups[user_id]:
+                    fail(index, 409, "A previous message from this user is still being processed.")
+            elif isinstance(outcome, BaseException):
+                raise outcome
+            else:
+                ready.append(user_id)
+        turns = await run_db(load_chat_turns, ready, HISTORY_WINDOW, MULTI_WORKER)
+
+        async def user_turns(user_id):
+            turn = turns[user_id]
+            new_messages = 0
+            try:
+                for index in groups[user_id]:
+                    try:
+                        reply, added = await answer(turn, index)
+                    except HTTPException as e:
+                        fail(index, e.status_code, e.detail)
+                        continue
+                    except Exception as e:
+                        logger.error(f"Error in chat batch item {index} for user_id: {user_id}: {e}", exc_info=True)
+                        fail(index, 500, "Could not process this message")
+                        continue
+                    new_messages += added
+                    report(index, type="result", response=reply)
+            finally:
+                finished.put_nowait((turn, locks[user_id], new_messages))
+
+        async def committer():
+            # Commits every user that finished since the last commit in one transaction, then
+            # releases their locks: a user's next turn only starts once this one is durable
+            remaining = len(ready)
+            while remaining:
+                done = [await finished.get()]
+                while not finished.empty():
+                    done.append(finished.get_nowait())
+                remaining -= len(done)
+                await run_db(commit_chat_turns, [turn for turn, _, _ in done])
+                BATCH_STATS["commits"] += 1
+                for turn, lock, new_messages in done:
+                    await lock.release()
+                    maybe_schedule_summary(turn, new_messages=new_messages)
+
+        await asyncio.gather(committer(), *(user_turns(user_id) for user_id in ready))
     except Exception as e:
-        logger.error(f"Error getting GPT response for user_id: {user_id}: {e}", exc_info=True)
-        reply = "I'm sorry, I encountered a technical issue trying to process that. Could you try rephrasing?"
-
-    save_chat_message(user_id, 'user', user_message)
+        logger.error(f"Chat batch failed: {e}", exc_info=True)
+        for index in range(len(items)):
+            if index not in reported:
+                fail(index, 500, "Batch processing failed")
+    finally:
+        for lock in locks.values():
+            await lock.release()
+        BATCH_STATS["batches"] += 1
+        BATCH_STATS["items"] += len(items)
+        BATCH_STATS["failed"] += len(failed)
+        results.put_nowait({"type": "done", "items": len(items), "failed": len(failed),
+                            "seconds": round(time.perf_counter() - started, 3)})
+
+def batch_stats():
+    return {**BATCH_STATS, "llm": dict(batch_limiter.stats)}
+
+async def handle_direct_turn(req, turn, user_message):
+    # Returns a reply for turns answered without the standard flow, or None
+    if user_message == "__INIT__":
+        logger.info(f"Handling __INIT__ command for user_id: {turn.user_id}")
+        return await get_gpt_response(user_message, turn.user_id, tone=req.tone, turn=turn)
+    if req.message_id:
+        reply = await run_db(get_keyed_reply, turn.user_id, req.message_id)
+        if reply is not None:
+            logger.info(f"Replaying the stored reply to message {req.message_id!r} for user_id: {turn.user_id}")
+            return reply
+    return None
+
+def prepare_standard_turn(turn, user_message, tone="", extracted=None):
+    # Extraction only touches the in-memory turn, so it is cheap enough to run inline.
+    # Returns a reply from the intent router when the turn needs no LLM, otherwise None.
+    if user_message:
+        try:
+            extract_user_data(turn.user_id, user_message, turn=turn, result=extracted)
+        except Exception as e:
+            logger.error(f"Error extracting data for user {turn.user_id}: {e}", exc_info=True)
+    routed = route_intent(turn, user_message, tone)
+    if routed:
+        intent, reply = routed
+        logger.info(f"Answering '{intent}' turn locally for user {turn.user_id}")
+        return reply
+    if not user_message:
+        logger.warning(f"Received empty message from user_id: {turn.user_id}")
+        raise HTTPException(status_code=400, detail="Message cannot be empty")
+    logger.info(f"Proceeding with standard chat flow for user {turn.user_id}")
+    return None
+
+async def finish_standard_turn(turn, user_message, reply, message_id=None):
+    record_turn(turn, user_message, reply, message_id)
+    await run_db(turn.commit)
+    # Scheduled after the commit so the background update sees this turn's messages
+    maybe_schedule_summary(turn, new_messages=bool(user_message) + bool(reply))
+
+def record_turn(turn, user_message, reply, message_id=None):
+    # Buffers the exchange and the state it leaves behind on the turn; the caller commits
+    user_id = turn.user_id
+    profile = turn.profile
+    if user_message:
+        turn.add_message('user', user_message, key=f"{message_id}:user" if message_id else None)
     if reply:
-        save_chat_message(user_id, 'assistant', reply)
+        turn.add_message('assistant', reply, key=f"{message_id}:assistant" if message_id else None)
 
     # --- State Setting Logic ---
-    if profile and hasattr(profile, 'pending_action'):
-        offer_patterns = [
-            r"would you like tips",
-            r"improve your pension\?",
-            r"boost your pension.*\?",
-            r"increase your pension\?"
-        ]
-        reply_lower = reply.lower() if reply else ""
-        if any(re.search(pattern, reply_lower) for pattern in offer_patterns):
-            logger.info(f"Bot offered tips to user {user_id}. Setting pending_action='offer_tips'.")
-            save_user_profile(user_id, "pending_action", "offer_tips")
-    elif profile and not hasattr(profile, 'pending_action'):
-        logger.warning(f"Profile for user {user_id} exists but missing 'pending_action' attribute. Cannot set state.")
-
-    return {"response": reply}
-
-def extract_user_data(user_id, msg):
+    # What this reply asked for decides how the intent router reads the next message
+    if profile:
+        pending_action = pending_action_after(reply)
+        if profile.pending_action != pending_action:
+            logger.info(f"Setting pending_action={pending_action!r} for user {user_id}")
+            turn.set_profile_field("pending_action", pending_action)
+
+@timed("extract_user_data")
+def extract_user_data(user_id, msg, turn=None, result=None):
+    # Applies extracted fields to `turn`; without one, loads and commits its own.
+    # `result` is the message's extract() output when the caller already has it.
     logger.debug(f"Extracting data from message for user_id: {user_id}")
-    msg_lower = msg.lower()
-    profile_updated = False
-
-    profile = get_user_profile(user_id)
-    if not profile or not profile.region:
-        if "ireland" in msg_lower:
-            save_user_profile(user_id, "region", "Ireland")
-            logger.debug(f"Saved region 'Ireland' for user_id: {user_id}")
-            profile_updated = True
-        elif "uk" in msg_lower or "united kingdom" in msg_lower:
-            save_user_profile(user_id, "region", "UK")
-            logger.debug(f"Saved region 'UK' for user_id: {user_id}")
-            profile_updated = True
-
-    age_match = re.search(r"\b(\d{1,2})\s*(?:years?)?\s*old\b", msg_lower)
-    if age_match:
-        age = int(age_match.group(1))
-        if 18 <= age <= 100:
-            save_user_profile(user_id, "age", age)
-            logger.debug(f"Saved age '{age}' for user_id: {user_id}")
-            profile_updated = True
-
-    income_match = re.search(r"\b(?:€|£)\s?(\d{1,3}(?:,\d{3})*|\d+)\s?([kK]?)\b", msg.replace(",", ""))
-    if income_match:
-        income_val = int(income_match.group(1))
-        if income_match.group(2).lower() == 'k':
-            income_val *= 1000
-        save_user_profile(user_id, "income", income_val)
-        logger.debug(f"Saved income '{income_val}' for user_id: {user_id}")
-        profile_updated = True
-
-    retirement_match = re.search(r"\b(?:retire|retirement)\b.*?\b(\d{2})\b", msg_lower)
-    if retirement_match:
-        ret_age = int(retirement_match.group(1))
-        if 50 <= ret_age <= 80:
-            save_user_profile(user_id, "retirement_age", ret_age)
-            logger.debug(f"Saved retirement age '{ret_age}' for user_id: {user_id}")
-            profile_updated = True
-
-    if "risk" in msg_lower:
-        if "low" in msg_lower:
-            save_user_profile(user_id, "risk_profile", "Low")
-            logger.debug(f"Saved risk profile 'Low' for user_id: {user_id}")
-            profile_updated = True
-        elif "high" in msg_lower:
-            save_user_profile(user_id, "risk_profile", "High")
-            logger.debug(f"Saved risk profile 'High' for user_id: {user_id}")
-            profile_updated = True
-        elif "medium" in msg_lower or "moderate" in msg_lower:
-            save_user_profile(user_id, "risk_profile", "Medium")
-            logger.debug(f"Saved risk profile 'Medium' for user_id: {user_id}")
-            profile_updated = True
-
-    prsi_match = re.search(r"(\d{1,2})\s+(?:years?|yrs?)\s+(?:of\s+)?(?:prsi|contributions?)", msg_lower)
-    if prsi_match:
-        prsi_years = int(prsi_match.group(1))
-        save_user_profile(user_id, "prsi_years", prsi_years)
-        logger.debug(f"Saved PRSI years '{prsi_years}' from detailed message for user_id: {user_id}")
-        profile_updated = True
-    elif re.fullmatch(r"\s*\d{1,2}\s*", msg):  # Handle whitespace
-        potential_years = int(msg.strip())
-        if 0 <= potential_years <= 60:
-            save_user_profile(user_id, "prsi_years", potential_years)
-            logger.debug(f"Saved PRSI years '{potential_years}' from simple number reply for user_id: {user_id}")
-            profile_updated = True
-        else:
-            logger.warning(f"Invalid PRSI years '{potential_years}' for user_id: {user_id}")
-
-    if profile_updated:
-        logger.info(f"Profile data updated for user_id: {user_id}")
+    if result is None:
+        result = extract(msg)
+    for field, value in result.rejected:
+        logger.warning(f"Invalid {field} '{value}' for user_id: {user_id}")
+    if not result:
+        return result
+
+    standalone = turn is None
+    if standalone:
+        turn = ChatTurn(user_id, history_limit=0).load()
+
+    # Same rules as extraction.merge: region is only set once
+    profile = turn.profile
+    for field, value in result.fields.items():
+        if field == "region" and profile and profile.region:
+            continue
+        turn.set_profile_field(field, value)
+        logger.debug(f"Saved {field} '{value}' (confidence {result.confidence[field]}) for user_id: {user_id}")
+
+    logger.info(f"Profile data updated for user_id: {user_id}")
+    if standalone:
+        turn.commit()
+    return result
+
+class PensionCalculationRequest(BaseModel):
+    prsi_years: List[int]
+
+@app.post("/pension/calculate")
+async def calculate_pension(req: PensionCalculationRequest):
+    if any(not 0 <= years <= MAX_PRSI_YEARS for years in req.prsi_years):
+        raise HTTPException(status_code=400, detail=f"PRSI years must be between 0 and {MAX_PRSI_YEARS}")
+    return {"results": [
+        {"prsi_years": years, "contributions": years * WEEKS_PER_YEAR, "weekly_pension": weekly}
+        for years, weekly in zip(req.prsi_years, weekly_pensions(req.prsi_years))
+    ]}
 
 @app.post("/auth/google")
 async def auth_google(user_data: dict):
@@ -239,39 +509,11 @@ async def auth_google(user_data: dict):
 
     user_id = user_data["sub"]
     logger.info(f"Processing Google auth for user_id: {user_id}")
-    db = SessionLocal()
     try:
-        user = db.query(User).filter(User.id == user_id).first()
-        profile = db.query(UserProfile).filter(UserProfile.user_id == user_id).first()
-
-        if not user:
-            logger.info(f"New user detected, creating user and profile entry for user_id: {user_id}")
-            user = User(
-                id=user_id,
-                name=user_data.get("name", "Unknown User"),
-                email=user_data.get("email")
-            )
-            db.add(user)
-            if not profile:
-                profile = UserProfile(user_id=user_id)
-                db.add(profile)
-            db.commit()
-            db.refresh(user)
-            logger.info(f"Successfully created user and profile entry for user_id: {user_id}")
-        else:
-            logger.info(f"Existing user found for user_id: {user_id}")
-            if not profile:
-                logger.warning(f"Existing user {user_id} found, but profile missing. Creating profile.")
-                profile = UserProfile(user_id=user_id)
-                db.add(profile)
-                db.commit()
-
+        await run_db(upsert_google_user, user_id, user_data.get("name", "Unknown User"), user_data.get("email"))
     except Exception as e:
-        db.rollback()
         logger.error(f"Database error during auth for user_id {user_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Database operation failed")
-    finally:
-        db.close()
 
     return {"status": "ok", "user_id": user_id}
 
@@ -279,78 +521,176 @@ async def auth_google(user_data: dict):
 async def root():
     return {"message": "Pension Planner API is running"}
 
-@app.get("/export-pdf")
-async def export_pdf(user_id: str):
-    profile = get_user_profile(user_id)
-
+@app.get("/stats")
+async def stats():
+    return {"llm_cache": completion_cache.stats(), "profile_cache": profile_cache_stats(), "pdf": pdf_renderer.stats(),
+            "tokens": token_stats(), "summaries": summary_stats(), "llm": llm.snapshot(), "turn_locks": turn_lock_stats(),
+            "retention": retention_stats(), "router": router_stats(), "batch": batch_stats(), "faq": faq_stats(),
+            "rate_limit": rate_limit_stats(), "history": history_stats()}
+
+@app.get("/metrics")
+async def metrics():
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled (METRICS_ENABLED=0).")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@collector
+def app_metrics():
+    # Counted elsewhere already; exported as read at scrape time
+    cache = completion_cache.stats()
+    client = llm.snapshot()
+    pdf = pdf_renderer.stats()
+    locks = turn_lock_stats()
+    retained = retention_stats()
+    routed = router_stats()
+    batched = batch_stats()
+    faq = faq_stats()
+    limited = rate_limit_stats()
+    history = history_stats()
+    return [
+        ("pension_db_queries_total", "counter", "SQL statements executed", [({}, DB_STATS["queries"])]),
+        ("pension_db_commits_total", "counter", "Database commits", [({}, DB_STATS["commits"])]),
+        ("pension_llm_calls_total", "counter", "OpenAI calls by outcome",
+         [({"outcome": "call"}, client["calls"]), ({"outcome": "retry"}, client["retries"]),
+          ({"outcome": "failure"}, client["failures"]), ({"outcome": "hedge"}, client["hedges"])]),
+        ("pension_llm_breaker_open", "gauge", "1 while the OpenAI circuit breaker rejects calls",
+         [({}, int(client["breaker"] == "open"))]),
+        ("pension_completion_cache_total", "counter", "Completion cache lookups by result",
+         [({"result": "hit"}, cache["hits"]), ({"result": "miss"}, cache["misses"])]),
+        ("pension_pdf_exports_total", "counter", "PDF exports by result",
+         [({"result": "rendered"}, pdf["renders"]), ({"result": "cached"}, pdf["cache_hits"]),
+          ({"result": "failed"}, pdf["failures"]), ({"result": "rejected"}, pdf["rejected"])]),
+        ("pension_pdf_queue", "gauge", "PDF renders queued or running", [({}, pdf["queued"])]),
+        ("pension_turn_lock_total", "counter", "Per-user chat turn locks by outcome",
+         [({"outcome": "acquired"}, locks["acquired"]), ({"outcome": "waited"}, locks["waited"]),
+          ({"outcome": "timeout"}, locks["timeouts"]), ({"outcome": "conflict"}, locks["conflicts"])]),
+        ("pension_archived_messages_total", "counter", "Chat messages moved to the archive tier by retention",
+         [({}, retained["archived_messages"])]),
+        ("pension_router_turns_total", "counter", "Chat turns by intent answered locally, 'fallthrough' for the LLM",
+         [({"intent": intent}, count) for intent, count in routed["intents"].items()] +
+         [({"intent": "fallthrough"}, routed["turns"] - routed["served_locally"])]),
+        ("pension_batch_items_total", "counter", "/chat/batch items by outcome",
+         [({"outcome": "ok"}, batched["items"] - batched["failed"]), ({"outcome": "failed"}, batched["failed"])]),
+        ("pension_faq_lookups_total", "counter", "FAQ index lookups by result",
+         [({"result": "answered"}, faq["answered"]), ({"result": "grounded"}, faq["grounded"]),
+          ({"result": "miss"}, faq["misses"])]),
+        ("pension_rate_limit_total", "counter", "Chat requests by admission outcome",
+         [({"outcome": "allowed"}, limited["allowed"]), ({"outcome": "limited_user"}, limited["limited_user"]),
+          ({"outcome": "limited_ip"}, limited["limited_ip"]), ({"outcome": "coalesced"}, limited["coalesced"]),
+          ({"outcome": "aborted"}, limited["aborted"])]),
+        ("pension_history_queue", "gauge", "Chat messages waiting on the write-behind queue", [({}, history["pending"])]),
+        ("pension_history_flushed_total", "counter", "Chat messages written by write-behind flushes",
+         [({}, history["flushed"])]),
+    ]
+
+def export_filters(since, until, last_n):
+    # Stored timestamps are naive UTC
+    since, until = (
+        value.astimezone(timezone.utc).replace(tzinfo=None) if value and value.tzinfo else value
+        for value in (since, until)
+    )
+    if since and until and since >= until:
+        raise HTTPException(status_code=400, detail="'since' must be earlier than 'until'.")
+    return {"since": since, "until": until, "last_n": last_n}
+
+async def load_export_profile(user_id):
+    profile = await run_db(get_user_profile, user_id, MULTI_WORKER)
     if not profile:
-        raise HTTPException(status_code=404, detail="No profile found for PDF export.")
+        raise HTTPException(status_code=404, detail="No profile found for export.")
+    return asdict(profile)
+
+async def start_pdf_export(user_id, filters):
+    profile_fields = await load_export_profile(user_id)
+    # PDFs are rendered in one piece, so they are capped unless the caller asks for a window
+    if filters["last_n"] is None:
+        filters = {**filters, "last_n": EXPORT_PDF_MAX_MESSAGES}
+
+    # Queued chat messages are written first so the report includes them
+    await history_queue.flush_now()
+    # Only the cache key is read up front; the history itself is streamed on a cache miss
+    latest_id = await run_db(get_latest_message_id, user_id)
+    key = artifact_key(user_id, latest_id, profile_fields, filters)
+    job = pdf_renderer.lookup(user_id, key)
+    if job is not None:
+        return job
 
-    db = SessionLocal()
     messages = []
-    try:
-        messages = (
-            db.query(ChatHistory)
-            .filter(ChatHistory.user_id == user_id)
-            .order_by(ChatHistory.timestamp)
-            .all()
-        )
-    except Exception as e:
-        logger.error(f"Failed to retrieve chat history for PDF export for user {user_id}: {e}")
-    finally:
-        db.close()
-
-    def safe_get(obj, attr, default="—"):
-        val = getattr(obj, attr, None)
-        return val if val is not None else default
-
-    income_str = "—"
-    if hasattr(profile, 'income') and profile.income is not None:
-        region = getattr(profile, 'region', None)
-        currency = '£' if region == 'UK' else '€'
+    if latest_id is not None:
         try:
-            income_str = f"{currency}{profile.income:,}"
-        except (TypeError, ValueError):
-            income_str = f"{currency}{profile.income}"
-
-    profile_text = f"""
-    <h1>Pension Plan Summary</h1>
-    <h2>User Info</h2>
-    <ul>
-      <li>Region: {safe_get(profile, 'region')}</li>
-      <li>Age: {safe_get(profile, 'age')}</li>
-      <li>Income: {income_str}</li>
-      <li>Retirement Age: {safe_get(profile, 'retirement_age')}</li>
-      <li>Risk Profile: {safe_get(profile, 'risk_profile')}</li>
-      <li>PRSI Years: {safe_get(profile, 'prsi_years')}</li>
-      <li>Pending Action: {safe_get(profile, 'pending_action')}</li>
-    </ul>
-    """
-
-    chat_log = "<h2>Chat History</h2><ul>"
-    if messages:
-        for m in messages:
-            role = "You" if m.role == "user" else "Pension Guru"
-            content = getattr(m, 'content', '') or ''
-            content_escaped = content.replace("&", "&").replace("<", "<").replace(">", ">")
-            chat_log += f"<li><strong>{role}:</strong> {content_escaped}</li>"
-    else:
-        chat_log += "<li>No chat history found.</li>"
-    chat_log += "</ul>"
-
-    pdf_buffer = BytesIO()
-    try:
-        html = HTML(string=profile_text + chat_log)
-        html.write_pdf(pdf_buffer)
-        pdf_buffer.seek(0)
-    except Exception as e:
-        logger.error(f"Error generating PDF for user {user_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail="Failed to generate PDF report.")
+            async for batch in iterate_db(iter_chat_history(user_id, max_id=latest_id, **filters)):
+                messages.extend(ExportRow(*row) for row in batch)
+        except Exception as e:
+            # A PDF of part of the history would be cached and served until the next message
+            logger.error(f"Failed to retrieve chat history for PDF export for user {user_id}: {e}", exc_info=True)
+            raise HTTPException(status_code=500, detail="Failed to read chat history for the PDF export")
 
-    return StreamingResponse(pdf_buffer, media_type="application/pdf", headers={
-        "Content-Disposition": f"attachment; filename=retirement_plan_{user_id}.pdf"
+    try:
+        return pdf_renderer.submit(user_id, key, profile_fields, messages)
+    except PdfQueueFull:
+        raise HTTPException(status_code=503, detail="PDF export queue is full, please retry shortly.",
+                            headers={"Retry-After": "5"})
+
+def pdf_file_response(job):
+    # Jobs found through another worker's files do not know their user
+    filename = f"retirement_plan_{job.user_id}.pdf" if job.user_id else "retirement_plan.pdf"
+    return FileResponse(job.path, media_type="application/pdf", filename=filename)
+
+async def pdf_export_response(user_id, filters):
+    job = await pdf_renderer.wait(await start_pdf_export(user_id, filters))
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    return pdf_file_response(job)
+
+@app.get("/export")
+async def export_history(user_id: str, format: str = "ndjson", since: Optional[datetime] = None,
+                         until: Optional[datetime] = None, last_n: Optional[int] = Query(None, ge=1)):
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format, use one of: {', '.join(EXPORT_FORMATS)}")
+    filters = export_filters(since, until, last_n)
+    if format == "pdf":
+        return await pdf_export_response(user_id, filters)
+
+    profile_fields = await load_export_profile(user_id)
+    await history_queue.flush_now()
+    body = iterate_db(export_stream(format, profile_fields, iter_chat_history(user_id, **filters)))
+    return StreamingResponse(body, media_type=EXPORT_FORMATS[format], headers={
+        "Content-Disposition": f"attachment; filename=chat_history_{user_id}.{format}"
     })
 
+@app.get("/export-pdf")
+@timed("export_pdf")
+async def export_pdf(user_id: str, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                     last_n: Optional[int] = Query(None, ge=1)):
+    return await pdf_export_response(user_id, export_filters(since, until, last_n))
+
+@app.post("/export-pdf/jobs", status_code=202)
+async def submit_pdf_export(user_id: str, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                            last_n: Optional[int] = Query(None, ge=1)):
+    job = await start_pdf_export(user_id, export_filters(since, until, last_n))
+    return {
+        **job.to_dict(),
+        "status_url": f"/export-pdf/jobs/{job.job_id}",
+        "download_url": f"/export-pdf/jobs/{job.job_id}/download",
+    }
+
+@app.get("/export-pdf/jobs/{job_id}")
+async def pdf_export_status(job_id: str):
+    job = pdf_renderer.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired export job.")
+    return job.to_dict()
+
+@app.get("/export-pdf/jobs/{job_id}/download")
+async def download_pdf_export(job_id: str):
+    job = pdf_renderer.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired export job.")
+    if job.status == "pending":
+        raise HTTPException(status_code=409, detail="Export is still rendering.")
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    return pdf_file_response(job)
+
 @app.post("/chat/forget")
 async def forget_chat_history(request: Request):
     data = await request.json()
@@ -358,20 +698,14 @@ async def forget_chat_history(request: Request):
     if not user_id:
         raise HTTPException(status_code=400, detail="Missing user_id")
 
-    db = SessionLocal()
     try:
-        deleted_chats = db.query(ChatHistory).filter(ChatHistory.user_id == user_id).delete(synchronize_session=False)
-        logger.info(f"Deleted {deleted_chats} chat messages for user_id: {user_id}")
-        deleted_profile = db.query(UserProfile).filter(UserProfile.user_id == user_id).delete(synchronize_session=False)
-        logger.info(f"Deleted {deleted_profile} profile entries for user_id: {user_id}")
-        db.commit()
-        logger.info(f"Successfully cleared chat history and profile for user_id: {user_id}")
+        # The history flusher waits, so none of this user's queued messages is stored after the delete
+        async with history_queue.flush_lock:
+            await run_db(forget_user, user_id)
+        await run_blocking(pdf_renderer.discard_user, user_id)
     except Exception as e:
-        db.rollback()
         logger.error(f"Error deleting data for user {user_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Failed to clear history")
-    finally:
-        db.close()
 
     return {"status": "ok", "message": "Chat history and profile cleared."}
 # --- End of main.py ---
\ No newline at end of file
@@ -1,17 +1,228 @@
 # --- memory.py ---
-from models import UserProfile, ChatHistory, SessionLocal
-from sqlalchemy import desc
+from models import UserProfile, ChatHistory, ChatArchive, User, ConversationSummary, TurnLease, RateBucket, SessionLocal, ASYNC_BACKEND, async_engine
+from export import ExportRow
+from ttl_cache import TTLCache, MISS
+from metrics import timed
+from sqlalchemy import case, desc, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.util import greenlet_spawn
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Optional
+import asyncio
+import json
 import logging
+import os
+import threading
+import time
+import uuid
+import zlib
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-def get_user_profile(user_id):
-    db = SessionLocal()
-    profile = db.query(UserProfile).filter(UserProfile.user_id == user_id).first()
-    db.close()
+# Blocking SQLAlchemy calls run on a bounded pool so they never stall the event loop.
+# Keep this at or below DB_POOL_SIZE + DB_MAX_OVERFLOW (see storage.py).
+DB_MAX_WORKERS = int(os.getenv("DB_MAX_WORKERS", "8"))
+_db_executor = ThreadPoolExecutor(max_workers=DB_MAX_WORKERS, thread_name_prefix="db")
+
+async def run_db(fn, *args, **kwargs):
+    if ASYNC_BACKEND:
+        # Async drivers (asyncpg, aiosqlite) run the same sync ORM code on the event loop
+        # through SQLAlchemy's greenlet bridge; every I/O wait yields to other requests
+        return await greenlet_spawn(fn, *args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, partial(fn, *args, **kwargs))
+
+_DONE = object()
+
+async def iterate_db(gen):
+    # Drives a sync generator that holds a DB cursor one step per run_db call, so results
+    # stream out without blocking the event loop on either kind of driver
+    try:
+        while True:
+            item = await run_db(next, gen, _DONE)
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        await run_db(gen.close)
+
+async def run_blocking(fn, *args, **kwargs):
+    # Non-database blocking work (file I/O, CPU) always goes to the thread pool
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, partial(fn, *args, **kwargs))
+
+def run_sync(fn, *args, **kwargs):
+    # Entry point for scripts that run outside an event loop (init_db.py and friends)
+    if not ASYNC_BACKEND:
+        return fn(*args, **kwargs)
+
+    async def runner():
+        try:
+            return await greenlet_spawn(fn, *args, **kwargs)
+        finally:
+            await async_engine.dispose()
+    return asyncio.run(runner())
+
+# Lightweight, immutable copies of the rows that every turn reads. Unlike detached ORM
+# instances they are safe to share between requests and threads.
+@dataclass(frozen=True, slots=True)
+class ProfileSnapshot:
+    user_id: str
+    region: Optional[str] = None
+    age: Optional[int] = None
+    income: Optional[int] = None
+    retirement_age: Optional[int] = None
+    risk_profile: Optional[str] = None
+    prsi_years: Optional[int] = None
+    pending_action: Optional[str] = None
+    version: int = 0
+
+    @classmethod
+    def from_row(cls, profile):
+        return cls(
+            user_id=profile.user_id,
+            region=profile.region,
+            age=profile.age,
+            income=profile.income,
+            retirement_age=profile.retirement_age,
+            risk_profile=profile.risk_profile,
+            prsi_years=profile.prsi_years,
+            pending_action=profile.pending_action,
+            version=profile.version or 0,
+        )
+
+@dataclass(frozen=True, slots=True)
+class UserSnapshot:
+    id: str
+    name: Optional[str] = None
+    email: Optional[str] = None
+
+@dataclass(frozen=True, slots=True)
+class SummarySnapshot:
+    text: str
+    last_message_id: int
+
+# Read-through caches keyed on user_id. A cached None means "no row", so first-time
+# users do not hit the database on every turn either. Writes go through the helpers
+# below, which update or invalidate the entry.
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "300"))  # seconds
+_profile_cache = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+_user_cache = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+_summary_cache = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+def invalidate_user_cache(user_id):
+    _profile_cache.delete(user_id)
+    _user_cache.delete(user_id)
+    _summary_cache.delete(user_id)
+
+def profile_cache_stats():
+    return {
+        "profile_hits": _profile_cache.hits,
+        "profile_misses": _profile_cache.misses,
+        "user_hits": _user_cache.hits,
+        "user_misses": _user_cache.misses,
+        "entries": len(_profile_cache) + len(_user_cache),
+    }
+
+def _load_profile(user_id, db=None):
+    profile = _profile_cache.get(user_id)
+    if profile is MISS:
+        session = db or SessionLocal()
+        try:
+            row = session.query(UserProfile).filter(UserProfile.user_id == user_id).first()
+            profile = ProfileSnapshot.from_row(row) if row else None
+        finally:
+            if db is None:
+                session.close()
+        _profile_cache.set(user_id, profile)
     return profile
 
+def _load_user(user_id, db=None):
+    user = _user_cache.get(user_id)
+    if user is MISS:
+        session = db or SessionLocal()
+        try:
+            row = session.query(User).filter(User.id == user_id).first()
+            user = UserSnapshot(id=row.id, name=row.name, email=row.email) if row else None
+        finally:
+            if db is None:
+                session.close()
+        _user_cache.set(user_id, user)
+    return user
+
+def _load_summary(user_id, db=None):
+    summary = _summary_cache.get(user_id)
+    if summary is MISS:
+        session = db or SessionLocal()
+        try:
+            row = session.query(ConversationSummary).filter(ConversationSummary.user_id == user_id).first()
+            summary = SummarySnapshot(row.summary, row.last_message_id) if row and row.summary else None
+        finally:
+            if db is None:
+                session.close()
+        _summary_cache.set(user_id, summary)
+    return summary
+
+@timed("memory.get_conversation_summary")
+def get_conversation_summary(user_id):
+    return _load_summary(user_id)
+
+@timed("memory.get_messages_to_summarize")
+def get_messages_to_summarize(user_id, after_id, keep_recent, limit):
+    # Oldest unsummarized messages, leaving the newest keep_recent to be replayed raw
+    db = SessionLocal()
+    try:
+        query = db.query(ChatHistory.id, ChatHistory.role, ChatHistory.content)\
+                  .filter(ChatHistory.user_id == user_id)
+        if after_id is not None:
+            query = query.filter(ChatHistory.id > after_id)
+        if keep_recent:
+            recent = db.query(ChatHistory.id).filter(ChatHistory.user_id == user_id)\
+                       .order_by(desc(ChatHistory.timestamp), desc(ChatHistory.id)).limit(keep_recent)
+            query = query.filter(ChatHistory.id.notin_(recent.scalar_subquery()))
+        return query.order_by(ChatHistory.timestamp, ChatHistory.id).limit(limit).all()
+    finally:
+        db.close()
+
+@timed("memory.save_conversation_summary")
+def save_conversation_summary(user_id, text, last_message_id):
+    db = SessionLocal()
+    try:
+        row = db.query(ConversationSummary).filter(ConversationSummary.user_id == user_id).with_for_update().first()
+        if row is None:
+            db.add(ConversationSummary(user_id=user_id, summary=text, last_message_id=last_message_id))
+        elif (row.last_message_id or 0) < last_message_id:
+            row.summary, row.last_message_id = text, last_message_id
+        else:
+            return False  # a concurrent update already covered these messages
+        db.commit()
+        _summary_cache.set(user_id, SummarySnapshot(text, last_message_id))
+        return True
+    except Exception:
+        db.rollback()
+        _summary_cache.delete(user_id)
+        raise
+    finally:
+        db.close()
+
+@timed("memory.get_user_profile")
+def get_user_profile(user_id, fresh=False):
+    if fresh:
+        _profile_cache.delete(user_id)
+    return _load_profile(user_id)
+
+@timed("memory.get_user_name")
+def get_user_name(user_id):
+    user = _load_user(user_id)
+    return user.name if user else None
+
+@timed("memory.save_user_profile")
 def save_user_profile(user_id, field, value):
     db = SessionLocal()
     profile = db.query(UserProfile).filter(UserProfile.user_id == user_id).first()
@@ -20,12 +231,12 @@ def save_user_profile(user_id, field, value):
         profile = UserProfile(user_id=user_id)
         db.add(profile)
 
-    if value is not None:
-        if not hasattr(profile, field):
-            logger.error(f"Field '{field}' does not exist in UserProfile for user {user_id}")
-            db.close()
-            return
-        setattr(profile, field, value)
+    if not hasattr(profile, field):
+        logger.error(f"Field '{field}' does not exist in UserProfile for user {user_id}")
+        db.close()
+        return
+    setattr(profile, field, value)  # None clears the field, e.g. pending_action
+    profile.version = (profile.version or 0) + 1
 
     try:
         db.commit()
@@ -34,42 +245,645 @@ def save_user_profile(user_id, field, value):
         logger.error(f"Database error saving profile for {user_id}: {e}", exc_info=True)
         db.rollback()
     finally:
+        _profile_cache.delete(user_id)
         db.close()
 
-def save_chat_message(user_id, role, content):
-    if not user_id or not role or not content:
-        logger.warning(f"Attempted to save incomplete chat message for user {user_id}. Role: {role}, Content: '{content}'")
-        return
+# Write-behind chat history (HISTORY_WRITE_BEHIND=1): committed turns put their messages on
+# an in-memory queue instead of inserting them in the request, and a background task writes
+# the queue in one executemany every HISTORY_FLUSH_INTERVAL seconds, or as soon as
+# HISTORY_FLUSH_SIZE messages are waiting. Profile changes are still committed in the request.
+#
+# Recent-history reads merge in the user's queued messages, so the next turn sees them
+# before they are stored. Every queued message has an idempotency key, so neither a retried
+# flush nor a client retry (same message_id) stores a message twice. The lifespan flushes
+# the queue on shutdown; messages queued when a worker is killed outright are lost.
+# Only for a single worker process: other workers cannot read this one's queue.
+HISTORY_WRITE_BEHIND = os.getenv("HISTORY_WRITE_BEHIND", "0") == "1"
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.5"))  # seconds
+HISTORY_FLUSH_SIZE = int(os.getenv("HISTORY_FLUSH_SIZE", "200"))  # queued messages that trigger a flush
+HISTORY_QUEUE_MAX = int(os.getenv("HISTORY_QUEUE_MAX", "20000"))  # beyond this, turns write synchronously
+HISTORY_SHUTDOWN_ATTEMPTS = 5  # flushes tried at shutdown, a second apart, before giving up
+
+if HISTORY_WRITE_BEHIND and os.getenv("TURN_LOCK", "local").lower() == "db":
+    logger.warning("HISTORY_WRITE_BEHIND=1 needs a single worker process, but TURN_LOCK=db is set; "
+                   "writing chat history synchronously")
+    HISTORY_WRITE_BEHIND = False
+
+HISTORY_STATS = {"queued": 0, "duplicates": 0, "flushes": 0, "flushed": 0, "failures": 0}
+
+def _dialect_insert(db, model):
+    # INSERT with the dialect's ON CONFLICT clauses; None on databases without them
+    if db.bind.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    elif db.bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        return None
+    return insert(model.__table__)
+
+def _insert_messages(db, rows):
+    # One executemany; a row whose (user_id, idempotency_key) is already stored is skipped
+    stmt = _dialect_insert(db, ChatHistory)
+    if stmt is None:
+        stmt = ChatHistory.__table__.insert()
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=["user_id", "idempotency_key"])
+    db.execute(stmt, rows)
+
+class HistoryQueue:
+    def __init__(self):
+        self.running = False
+        self.flush_lock = asyncio.Lock()  # one flush at a time; /chat/forget holds it while deleting
+        self._lock = threading.Lock()  # guards the lists below, never held across I/O
+        self._rows = []  # queued, oldest first
+        self._flushing = []  # taken by the flush in progress, still read as pending
+        self._keys = set()  # (user_id, idempotency_key) of every row in both
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    def accepting(self):
+        return self.running and len(self._rows) < HISTORY_QUEUE_MAX
+
+    def put(self, rows):
+        with self._lock:
+            for row in rows:
+                key = (row["user_id"], row["idempotency_key"])
+                if key in self._keys:
+                    HISTORY_STATS["duplicates"] += 1
+                    continue
+                self._keys.add(key)
+                self._rows.append(row)
+                HISTORY_STATS["queued"] += 1
+            full = len(self._rows) >= HISTORY_FLUSH_SIZE
+        if full and self._loop is not None:
+            # Called from DB threads as well as the event loop
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def pending(self, user_id):
+        with self._lock:
+            return [row for row in self._flushing + self._rows if row["user_id"] == user_id]
+
+    def discard_user(self, user_id):
+        with self._lock:
+            dropped = [row for row in self._rows if row["user_id"] == user_id]
+            self._rows = [row for row in self._rows if row["user_id"] != user_id]
+            self._keys.difference_update((row["user_id"], row["idempotency_key"]) for row in dropped)
+
+    def __len__(self):
+        return len(self._rows) + len(self._flushing)
+
+    def flush(self):
+        # Through run_db, under flush_lock. Rows go back on the queue if the insert fails.
+        with self._lock:
+            batch, self._rows = self._rows, []
+            self._flushing = batch
+        if not batch:
+            return 0
+        db = SessionLocal()
+        try:
+            _insert_messages(db, batch)
+            db.commit()
+        except Exception:
+            db.rollback()
+            HISTORY_STATS["failures"] += 1
+            with self._lock:
+                self._rows = batch + self._rows
+                self._flushing = []
+            raise
+        finally:
+            db.close()
+        with self._lock:
+            self._flushing = []
+            self._keys.difference_update((row["user_id"], row["idempotency_key"]) for row in batch)
+        HISTORY_STATS["flushes"] += 1
+        HISTORY_STATS["flushed"] += len(batch)
+        return len(batch)
+
+    async def flush_now(self):
+        # Writes everything queued so far; failures are logged and the rows stay queued
+        async with self.flush_lock:
+            if not self._rows:
+                return 0
+            try:
+                return await run_db(self.flush)
+            except Exception as e:
+                logger.error(f"Chat history flush failed, {len(self)} messages stay queued: {e}", exc_info=True)
+                return 0
+
+    def start(self):
+        if not HISTORY_WRITE_BEHIND:
+            return None
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self.running = True
+        self._task = self._loop.create_task(self._run())
+        logger.info(f"Chat history write-behind on: flush every {HISTORY_FLUSH_INTERVAL}s "
+                    f"or {HISTORY_FLUSH_SIZE} messages")
+        return self._task
+
+    async def _run(self):
+        while self.running:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), HISTORY_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush_now()
+
+    async def close(self):
+        # Turns committed from here on write synchronously; the queue is flushed, retrying a
+        # failing database a few times
+        if self._task is None:
+            return
+        self.running = False
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        for attempt in range(HISTORY_SHUTDOWN_ATTEMPTS):
+            await self.flush_now()
+            if not self._rows:
+                return
+            await asyncio.sleep(1)
+        logger.error(f"Shutting down with {len(self._rows)} chat messages that could not be written")
 
+history_queue = HistoryQueue()
+
+def history_stats():
+    return {"write_behind": HISTORY_WRITE_BEHIND, "pending": len(history_queue), **HISTORY_STATS}
+
+@timed("memory.get_chat_history")
+def get_chat_history(user_id, limit=10):
+    if not user_id:
+        return []
     db = SessionLocal()
-    message = ChatHistory(
-        user_id=user_id,
-        role=role,
-        content=content
-    )
-    db.add(message)
     try:
-        db.commit()
+        history = _recent_history(db, user_id, limit)
     except Exception as e:
-        logger.error(f"Database error saving chat message for {user_id}: {e}", exc_info=True)
+        logger.error(f"Database error retrieving chat history for {user_id}: {e}", exc_info=True)
+        history = []
+    finally:
+        db.close()
+    return history
+
+def _recent_history(db, user_id, limit):
+    # Messages written in one commit can share a timestamp, so id breaks the tie. Messages
+    # still on the write-behind queue are newer than every stored one and come last; the
+    # queue is read first, so rows a flush stores in between are recognized by their key.
+    pending = history_queue.pending(user_id)
+    rows = db.query(ChatHistory.id, ChatHistory.role, ChatHistory.content, ChatHistory.idempotency_key)\
+             .filter(ChatHistory.user_id == user_id)\
+             .order_by(desc(ChatHistory.timestamp), desc(ChatHistory.id))\
+             .limit(limit + len(pending))\
+             .all()
+    history = [{"role": role, "content": content, "id": message_id} for message_id, role, content, _ in rows[::-1]]
+    if pending:
+        stored = {key for *_, key in rows}
+        history += [{"role": row["role"], "content": row["content"], "id": None}
+                    for row in pending if row["idempotency_key"] not in stored]
+    return history[-limit:]
+
+@timed("memory.get_keyed_reply")
+def get_keyed_reply(user_id, message_id):
+    # The reply already given to the client message `message_id`, stored or queued, or None
+    key = f"{message_id}:assistant"
+    for row in history_queue.pending(user_id):
+        if row["idempotency_key"] == key:
+            return row["content"]
+    db = SessionLocal()
+    try:
+        return db.query(ChatHistory.content)\
+                 .filter(ChatHistory.user_id == user_id, ChatHistory.idempotency_key == key).scalar()
+    finally:
+        db.close()
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))
+
+def pack_messages(rows):
+    # rows: (id, role, content, timestamp) oldest first -> compressed chat_archive payload
+    payload = [[message_id, role, content, timestamp.isoformat() if timestamp else None]
+               for message_id, role, content, timestamp in rows]
+    return zlib.compress(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 6)
+
+def unpack_messages(blob):
+    return [ExportRow(message_id, role, content, datetime.fromisoformat(timestamp) if timestamp else None)
+            for message_id, role, content, timestamp in json.loads(zlib.decompress(blob))]
+
+def _archived_rows(db, user_id, since, until, max_id, keep_last):
+    # Archived messages matching the export filters, oldest first, one blob in memory at a
+    # time; with keep_last only the newest keep_last of them
+    conditions = [ChatArchive.user_id == user_id]
+    if since is not None:
+        conditions.append(ChatArchive.last_timestamp >= since)
+    if until is not None:
+        conditions.append(ChatArchive.first_timestamp < until)
+    if max_id is not None:
+        conditions.append(ChatArchive.first_message_id <= max_id)
+    archive_ids = db.execute(select(ChatArchive.id).where(*conditions)
+                             .order_by(ChatArchive.last_message_id)).scalars().all()
+    tail = deque(maxlen=keep_last) if keep_last is not None else None
+    for archive_id in archive_ids:
+        blob = db.execute(select(ChatArchive.payload).where(ChatArchive.id == archive_id)).scalar()
+        for row in unpack_messages(blob):
+            if ((since is not None and row.timestamp < since) or (until is not None and row.timestamp >= until)
+                    or (max_id is not None and row.id > max_id)):
+                continue
+            if tail is None:
+                yield row
+            else:
+                tail.append(row)
+    if tail:
+        yield from tail
+
+def iter_chat_history(user_id, since=None, until=None, last_n=None, max_id=None, batch_size=EXPORT_BATCH_SIZE):
+    # Yields lists of at most batch_size rows (id, role, content, timestamp), oldest first:
+    # archived messages (retention.py) first, then chat_history. yield_per streams from the
+    # cursor, so memory stays flat however long the history is.
+    conditions = [ChatHistory.user_id == user_id]
+    if since is not None:
+        conditions.append(ChatHistory.timestamp >= since)
+    if until is not None:
+        conditions.append(ChatHistory.timestamp < until)
+    if max_id is not None:
+        conditions.append(ChatHistory.id <= max_id)
+    hot_conditions = list(conditions)
+    if last_n is not None:
+        newest = select(ChatHistory.id).where(*conditions)\
+            .order_by(desc(ChatHistory.timestamp), desc(ChatHistory.id)).limit(last_n)
+        hot_conditions.append(ChatHistory.id.in_(newest))
+
+    stmt = select(ChatHistory.id, ChatHistory.role, ChatHistory.content, ChatHistory.timestamp)\
+        .where(*hot_conditions)\
+        .order_by(ChatHistory.timestamp, ChatHistory.id)\
+        .execution_options(yield_per=batch_size)
+    db = SessionLocal()
+    try:
+        if db.execute(select(ChatArchive.id).where(ChatArchive.user_id == user_id).limit(1)).first():
+            keep_last = None
+            if last_n is not None:
+                hot = db.execute(select(func.count()).select_from(newest.subquery())).scalar()
+                keep_last = last_n - hot
+            if keep_last is None or keep_last > 0:
+                batch = []
+                for row in _archived_rows(db, user_id, since, until, max_id, keep_last):
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+                if batch:
+                    yield batch
+        for partition in db.execute(stmt).partitions():
+            yield partition
+    finally:
+        db.close()
+
+@timed("memory.get_latest_message_id")
+def get_latest_message_id(user_id):
+    # Changes whenever the conversation does, so it versions exported reports
+    db = SessionLocal()
+    try:
+        latest = db.query(func.max(ChatHistory.id)).filter(ChatHistory.user_id == user_id).scalar()
+        if latest is None:
+            # Everything may have been archived
+            latest = db.query(func.max(ChatArchive.last_message_id)).filter(ChatArchive.user_id == user_id).scalar()
+        return latest
+    finally:
+        db.close()
+
+@timed("memory.upsert_google_user")
+def upsert_google_user(user_id, name, email):
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.id == user_id).first()
+        profile = db.query(UserProfile).filter(UserProfile.user_id == user_id).first()
+
+        if not user:
+            logger.info(f"New user detected, creating user and profile entry for user_id: {user_id}")
+            user = User(id=user_id, name=name, email=email)
+            db.add(user)
+            if not profile:
+                profile = UserProfile(user_id=user_id)
+                db.add(profile)
+            db.commit()
+            logger.info(f"Successfully created user and profile entry for user_id: {user_id}")
+        else:
+            logger.info(f"Existing user found for user_id: {user_id}")
+            if not profile:
+                logger.warning(f"Existing user {user_id} found, but profile missing. Creating profile.")
+                profile = UserProfile(user_id=user_id)
+                db.add(profile)
+                db.commit()
+    except Exception:
         db.rollback()
+        raise
     finally:
+        invalidate_user_cache(user_id)
         db.close()
 
-def get_chat_history(user_id, limit=10):
-    if not user_id:
-        return []
+@timed("memory.forget_user")
+def forget_user(user_id):
+    # Callers hold history_queue.flush_lock, so no queued message is stored after the delete
+    history_queue.discard_user(user_id)
     db = SessionLocal()
     try:
-        history = db.query(ChatHistory)\
-                    .filter(ChatHistory.user_id == user_id)\
-                    .order_by(desc(ChatHistory.timestamp))\
-                    .limit(limit)\
-                    .all()
+        deleted_chats = db.query(ChatHistory).filter(ChatHistory.user_id == user_id).delete(synchronize_session=False)
+        logger.info(f"Deleted {deleted_chats} chat messages for user_id: {user_id}")
+        deleted_profile = db.query(UserProfile).filter(UserProfile.user_id == user_id).delete(synchronize_session=False)
+        logger.info(f"Deleted {deleted_profile} profile entries for user_id: {user_id}")
+        db.query(ConversationSummary).filter(ConversationSummary.user_id == user_id).delete(synchronize_session=False)
+        db.query(ChatArchive).filter(ChatArchive.user_id == user_id).delete(synchronize_session=False)
+        db.commit()
+        logger.info(f"Successfully cleared chat history and profile for user_id: {user_id}")
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        invalidate_user_cache(user_id)
+        db.close()
+
+# Profile writes that found the row changed since their turn loaded it
+TURN_STATS = {"conflicts": 0}
+
+def acquire_turn_lease(user_id, owner, seconds):
+    # One statement: insert the lease, or take it over if the current one has expired.
+    # Returns True when `owner` now holds it.
+    now = datetime.utcnow()
+    values = {"user_id": user_id, "owner": owner, "expires_at": now + timedelta(seconds=seconds)}
+    table = TurnLease.__table__
+    db = SessionLocal()
+    try:
+        stmt = _dialect_insert(db, TurnLease)
+        if stmt is not None:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.user_id],
+                set_={"owner": stmt.excluded.owner, "expires_at": stmt.excluded.expires_at},
+                where=table.c.expires_at < now,
+            )
+            acquired = db.execute(stmt.values(**values)).rowcount == 1
+        else:
+            acquired = db.execute(table.update().where(table.c.user_id == user_id, table.c.expires_at < now)
+                                  .values(**values)).rowcount == 1
+            if not acquired:
+                try:
+                    db.execute(table.insert().values(**values))
+                    acquired = True
+                except IntegrityError:
+                    db.rollback()
+                    return False
+        db.commit()
+        return acquired
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def release_turn_lease(user_id, owner):
+    table = TurnLease.__table__
+    db = SessionLocal()
+    try:
+        db.execute(table.delete().where(table.c.user_id == user_id, table.c.owner == owner))
+        db.commit()
+    finally:
+        db.close()
+
+def take_rate_tokens(key, burst, per_second, cost=1, now=None):
+    # Token bucket in one statement: refill by the time since the last take, capped at
+    # `burst`, and take `cost` only if that many are there. Returns (allowed, seconds until
+    # `cost` tokens will be available).
+    now = time.time() if now is None else now
+    table = RateBucket.__table__
+    # A take stamped later (a concurrent request, another worker's clock) never drains the bucket
+    elapsed = case((table.c.updated_at < now, now - table.c.updated_at), else_=0.0)
+    refilled = table.c.tokens + elapsed * per_second
+    available = case((refilled > burst, burst), else_=refilled)
+    db = SessionLocal()
+    try:
+        stmt = _dialect_insert(db, RateBucket)
+        if stmt is not None:
+            stmt = stmt.values(key=key, tokens=burst - cost, updated_at=now).on_conflict_do_update(
+                index_elements=[table.c.key],
+                set_={"tokens": available - cost, "updated_at": now},
+                where=available >= cost,
+            )
+            allowed = db.execute(stmt).rowcount == 1
+        else:
+            allowed = db.execute(table.update().where(table.c.key == key, available >= cost)
+                                 .values(tokens=available - cost, updated_at=now)).rowcount == 1
+            if not allowed:
+                try:
+                    db.execute(table.insert().values(key=key, tokens=burst - cost, updated_at=now))
+                    allowed = True
+                except IntegrityError:
+                    db.rollback()
+        if allowed:
+            db.commit()
+            return True, 0.0
+        tokens = db.execute(select(available).where(table.c.key == key)).scalar() or 0.0
+        db.rollback()
+        return False, max(cost - tokens, 0.0) / per_second
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+class ChatTurn:
+    # Unit of work for one /chat request: profile, user name and recent history are read
+    # in a single session up front, changes are buffered, and commit() writes them all
+    # in one transaction instead of one commit per field and message.
+    def __init__(self, user_id, history_limit=10):
+        self.user_id = user_id
+        self.history_limit = history_limit
+        self.profile = None
+        self.user_name = None
+        self.summary = None
+        self.history = []
+        self._profile_changes = {}
+        self._messages = []
+        self._loaded_version = None
+        self._loaded_profile = None  # the row as load() saw it, to merge with a newer one
+
+    def load(self, fresh=False, db=None):
+        # fresh=True skips the profile cache, for workers that cannot see each other's writes
+        if fresh:
+            _profile_cache.delete(self.user_id)
+        owned = db is None
+        if owned:
+            db = SessionLocal()
+        try:
+            self.profile = _load_profile(self.user_id, db)
+            user = _load_user(self.user_id, db)
+            self.user_name = user.name if user else None
+            self.summary = _load_summary(self.user_id, db)
+            self._loaded_version = self.profile.version if self.profile else None
+            self._loaded_profile = self.profile
+            if self.history_limit:
+                self.history = _recent_history(db, self.user_id, self.history_limit)
+        except Exception as e:
+            logger.error(f"Database error loading chat turn for {self.user_id}: {e}", exc_info=True)
+            db.rollback()
+        finally:
+            if owned:
+                db.close()
+        return self
+
+    def unsummarized_history(self):
+        # Loaded messages newer than the rolling summary (all of them if there is none)
+        if self.summary is None:
+            return self.history
+        return [m for m in self.history if m.get("id") is None or m["id"] > self.summary.last_message_id]
+
+    def set_profile_field(self, field, value):
+        if not hasattr(UserProfile, field):
+            logger.error(f"Field '{field}' does not exist in UserProfile for user {self.user_id}")
+            return
+        # The rest of the turn sees the new value immediately; the database on commit()
+        base = self.profile if self.profile is not None else ProfileSnapshot(user_id=self.user_id)
+        self.profile = replace(base, **{field: value})
+        self._profile_changes[field] = value
+
+    def add_message(self, role, content, key=None):
+        # `key` is the message's idempotency key (see ChatHistory.idempotency_key)
+        if not self.user_id or not role or not content:
+            logger.warning(f"Attempted to save incomplete chat message for user {self.user_id}. Role: {role}, Content: '{content}'")
+            return
+        self._messages.append((role, content, key))
+
+    def extend_history(self, messages):
+        # For several exchanges in one unit of work (/chat/batch): later prompts see the earlier
+        # ones before they are committed
+        if self.history_limit:
+            self.history = (self.history + [{"role": role, "content": content} for role, content in messages])[-self.history_limit:]
+
+    @timed("memory.commit_turn")
+    def commit(self):
+        if not self._profile_changes and not self._messages:
+            return
+        queued = history_queue.accepting()
+        if queued and not self._profile_changes:
+            self._committed(None, queued)
+            return
+        db = SessionLocal()
+        try:
+            version = self._write(db)
+            if self._messages and not queued:
+                _insert_messages(db, self._message_rows(keyed=False))
+            db.commit()
+            self._committed(version, queued)
+        except Exception as e:
+            logger.error(f"Database error committing chat turn for {self.user_id}: {e}", exc_info=True)
+            db.rollback()
+            _profile_cache.delete(self.user_id)
+        finally:
+            db.close()
+
+    def _message_rows(self, keyed):
+        # Queued rows always get a key, which is how history reads tell them from stored ones
+        now = datetime.utcnow()
+        return [{"user_id": self.user_id, "role": role, "content": content, "timestamp": now,
+                 "idempotency_key": key or (uuid.uuid4().hex if keyed else None)}
+                for role, content, key in self._messages]
+
+    def _write(self, db):
+        # Stages the buffered profile changes in `db`; the caller inserts the messages.
+        # Returns the row's version after the commit, when known
+        version = None
+        if self._profile_changes:
+            changes = {**self._profile_changes, "version": UserProfile.version + 1}
+            query = db.query(UserProfile).filter(UserProfile.user_id == self.user_id)
+            if self._loaded_version is not None:
+                # Optimistic check: another writer (a worker without the turn lock, or a
+                # lease that expired mid-turn) may have changed the row since load()
+                updated = query.filter(UserProfile.version == self._loaded_version)\
+                               .update(changes, synchronize_session=False)
+                if updated:
+                    version = self._loaded_version + 1
+                else:
+                    TURN_STATS["conflicts"] += 1
+                    updated = self._merge(query)
+            else:
+                updated = query.update(changes, synchronize_session=False)
+            if not updated:
+                db.add(UserProfile(user_id=self.user_id, version=1, **self._profile_changes))
+                version = 1
+        return version
+
+    def _merge(self, query):
+        # The row moved on since load(): apply only the fields the other writer left as this
+        # turn loaded them. Where both changed a field, the stored (newer) value stays.
+        fields = sorted(self._profile_changes)
+        while True:
+            current = query.with_entities(UserProfile.version, *(getattr(UserProfile, f) for f in fields))\
+                           .with_for_update().first()
+            if current is None:
+                return 0
+            kept = {f: v for f, v in self._profile_changes.items()
+                    if getattr(current, f) == getattr(self._loaded_profile, f)}
+            # The row lock makes this succeed first time where the database has one (PostgreSQL)
+            if query.filter(UserProfile.version == current.version)\
+                    .update({**kept, "version": current.version + 1}, synchronize_session=False):
+                break
+        dropped = sorted(set(fields) - set(kept))
+        logger.warning(f"Profile for user {self.user_id} changed during the turn; applied {sorted(kept)}"
+                       + (f", kept the newer {dropped}" if dropped else ""))
+        return 1
+
+    def _committed(self, version, queued=False):
+        if version is not None:
+            # Write-through: the turn's snapshot is the loaded row plus exactly these changes
+            self._loaded_version = version
+            self.profile = self._loaded_profile = replace(self.profile, version=version)
+            _profile_cache.set(self.user_id, self.profile)
+        elif self._profile_changes:
+            # Someone else's changes are in the row too; the next read fetches it
+            self._loaded_version = None
+            _profile_cache.delete(self.user_id)
+        if self._messages and queued:
+            history_queue.put(self._message_rows(keyed=True))
+        logger.debug(f"Committed {len(self._profile_changes)} profile fields and "
+                     f"{len(self._messages)} {'queued ' if queued else ''}messages for user {self.user_id}")
+        self._profile_changes = {}
+        self._messages = []
+
+@timed("memory.load_chat_turn")
+def load_chat_turn(user_id, history_limit=10, fresh=False):
+    return ChatTurn(user_id, history_limit).load(fresh)
+
+@timed("memory.load_chat_turns")
+def load_chat_turns(user_ids, history_limit=10, fresh=False):
+    # Several users' turns in one session and, through run_db, one thread hop
+    db = SessionLocal()
+    try:
+        return {user_id: ChatTurn(user_id, history_limit).load(fresh, db) for user_id in user_ids}
+    finally:
+        db.close()
+
+@timed("memory.commit_chat_turns")
+def commit_chat_turns(turns):
+    # Several users' turns in one transaction; the history rows go out as one executemany
+    turns = [turn for turn in turns if turn._profile_changes or turn._messages]
+    if not turns:
+        return
+    queued = history_queue.accepting()
+    if queued and not any(turn._profile_changes for turn in turns):
+        for turn in turns:
+            turn._committed(None, queued)
+        return
+    db = SessionLocal()
+    try:
+        versions = [turn._write(db) for turn in turns]
+        rows = [] if queued else [row for turn in turns for row in turn._message_rows(keyed=False)]
+        if rows:
+            _insert_messages(db, rows)
+        db.commit()
+        for turn, version in zip(turns, versions):
+            turn._committed(version, queued)
     except Exception as e:
-        logger.error(f"Database error retrieving chat history for {user_id}: {e}", exc_info=True)
-        history = []
+        logger.error(f"Database error committing {len(turns)} chat turns: {e}", exc_info=True)
+        db.rollback()
+        for turn in turns:
+            _profile_cache.delete(turn.user_id)
     finally:
         db.close()
-    return [{"role": m.role, "content": m.content} for m in history[::-1]]
 # --- End of memory.py ---
\ No newline at end of file
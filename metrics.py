@@ -0,0 +1,180 @@
+# --- metrics.py ---
+# Minimal Prometheus metrics (text exposition format 0.0.4) with no client library.
+# Counters and histograms live in process memory and are rendered by GET /metrics;
+# values that other modules already count (DB_STATS, cache and client stats) are read
+# at scrape time through collectors instead of being double counted.
+#
+# With METRICS_ENABLED=0, timed() returns functions undecorated and stage() hands back a
+# shared no-op context manager, so the hooks cost nothing on the request path.
+from contextlib import nullcontext
+from functools import wraps
+from bisect import bisect_left
+import inspect
+import os
+import threading
+import time
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
+# Seconds; spans an in-memory cache hit up to a slow completion
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry = []
+_collectors = []
+_NULL_STAGE = nullcontext()
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.name}{_label_text(self.labelnames, labels)} {value}"
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        names = self.labelnames + ("le",)
+        for labels, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                yield f"{self.name}_bucket{_label_text(names, labels + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{_label_text(self.labelnames, labels)} {series[-1]}"
+            yield f"{self.name}_count{_label_text(self.labelnames, labels)} {cumulative}"
+
+def collector(fn):
+    # fn() returns [(name, type, help, [(labels dict, value), ...]), ...], read per scrape
+    _collectors.append(fn)
+    return fn
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for fn in _collectors:
+        for name, kind, help, samples in fn():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_label_text(tuple(labels), tuple(labels.values()))} {value}")
+    return "\n".join(lines) + "\n"
+
+STAGE_SECONDS = Histogram("pension_stage_seconds", "Time spent per pipeline stage", ["stage"])
+LLM_TOKENS = Counter("pension_llm_tokens_total", "OpenAI tokens by kind", ["kind"])
+LLM_ERRORS = Counter("pension_llm_errors_total", "Failed OpenAI calls by error type", ["error"])
+PDF_RENDER_SECONDS = Histogram("pension_pdf_render_seconds", "PDF export time from submit to rendered file, cache misses only")
+HTTP_SECONDS = Histogram("pension_http_request_seconds", "Time to the last response byte",
+                         ["method", "route", "status"])
+
+class _Stage:
+    __slots__ = ("name", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        STAGE_SECONDS.observe(time.perf_counter() - self.started, self.name)
+        return False
+
+def stage(name):
+    return _Stage(name) if METRICS_ENABLED else _NULL_STAGE
+
+def observe_stage(name, seconds):
+    # For spans that do not fit a with-block, e.g. time to the first streamed token
+    if METRICS_ENABLED:
+        STAGE_SECONDS.observe(seconds, name)
+
+def timed(name):
+    # Decorator for sync and async functions; a no-op when metrics are disabled
+    def decorate(fn):
+        if not METRICS_ENABLED:
+            return fn
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    STAGE_SECONDS.observe(time.perf_counter() - started, name)
+            return async_wrapper
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                STAGE_SECONDS.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorate
+
+class MetricsMiddleware:
+    # Plain ASGI middleware (no BaseHTTPMiddleware), so streamed responses are timed to
+    # their last byte and nothing is buffered. Routes are labelled by template, not path.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+
+        async def timed_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            route = scope.get("route")
+            HTTP_SECONDS.observe(time.perf_counter() - started, scope["method"],
+                                 getattr(route, "path", "unmatched"), str(status))
+# --- End of metrics.py ---
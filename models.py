@@ -1,8 +1,10 @@
 # --- models.py ---
-from sqlalchemy import Column, Integer, String, DateTime, Text, create_engine, Boolean # Add Boolean potentially
+from sqlalchemy import Column, Integer, String, DateTime, Text, Index, LargeBinary, Float, event, Boolean # Add Boolean potentially
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy.sql import func
 from datetime import datetime
+from storage import create_db_engine, normalize_database_url, migrate
+import os
 
 Base = declarative_base()
 
@@ -17,6 +19,8 @@ class UserProfile(Base):
     risk_profile = Column(String)
     prsi_years = Column(Integer) 
     pending_action = Column(String, nullable=True) # To store state like 'offer_tips'
+    # Bumped on every profile write; ChatTurn.commit only updates the version it loaded
+    version = Column(Integer, nullable=False, default=0, server_default="0")
 
 class User(Base):
     __tablename__ = 'users'
@@ -31,16 +35,89 @@ class ChatHistory(Base):
     __tablename__ = 'chat_history'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(String, index=True)
+    user_id = Column(String)
     role = Column(String) # 'user' or 'assistant'
     content = Column(Text) # Use Text for potentially longer messages
     timestamp = Column(DateTime, default=datetime.utcnow)
+    # "<client message_id>:<role>", or a generated key for write-behind rows; a message
+    # whose key is already stored is not written again
+    idempotency_key = Column(String, nullable=True)
 
+    # Serves "WHERE user_id = ? ORDER BY timestamp DESC LIMIT n" without a sort, and
+    # plain user_id lookups through its leading column
+    __table_args__ = (
+        Index("ix_chat_history_user_id_timestamp", "user_id", "timestamp"),
+        Index("ix_chat_history_user_id_idempotency_key", "user_id", "idempotency_key", unique=True),
+    )
 
-engine = create_engine("sqlite:///memory.db", connect_args={"check_same_thread": False})
+# Messages moved out of chat_history by retention.py: each row is one zlib-compressed JSON
+# blob of a user's messages, oldest first, with the id and timestamp range it covers
+class ChatArchive(Base):
+    __tablename__ = 'chat_archive'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(String, nullable=False)
+    first_message_id = Column(Integer)
+    last_message_id = Column(Integer)
+    first_timestamp = Column(DateTime)
+    last_timestamp = Column(DateTime)
+    message_count = Column(Integer)
+    payload = Column(LargeBinary)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_chat_archive_user_id_last_message_id", "user_id", "last_message_id"),
+    )
+
+# Rolling summary of a user's older messages, kept next to their profile. Messages with
+# id <= last_message_id are folded in and no longer replayed to the model.
+class ConversationSummary(Base):
+    __tablename__ = 'conversation_summaries'
+
+    user_id = Column(String, primary_key=True)
+    summary = Column(Text)
+    last_message_id = Column(Integer)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Per-user lock on chat turns shared by every worker process (TURN_LOCK=db, see turn_lock.py).
+# A row is a held lease; an expired one may be taken over.
+class TurnLease(Base):
+    __tablename__ = 'turn_leases'
+
+    user_id = Column(String, primary_key=True)
+    owner = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+# Token buckets for RATE_LIMIT_BACKEND=db (rate_limit.py), shared by every worker process.
+# `updated_at` is epoch seconds, so the refill arithmetic stays in plain SQL on every backend.
+class RateBucket(Base):
+    __tablename__ = 'rate_buckets'
+
+    key = Column(String, primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)
+
+DATABASE_URL = normalize_database_url(os.getenv("DATABASE_URL", "sqlite:///memory.db"))
+
+# `engine` is a sync Engine on every backend; with an async driver it fronts `async_engine`
+# and must be driven through memory.run_db / memory.run_sync
+engine, async_engine = create_db_engine(DATABASE_URL)
+ASYNC_BACKEND = async_engine is not None
 SessionLocal = sessionmaker(bind=engine)
 
+# Statement and commit counters, read by the benchmarks to track round trips per request
+DB_STATS = {"queries": 0, "commits": 0}
+
+@event.listens_for(engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    DB_STATS["queries"] += 1
+
+@event.listens_for(engine, "commit")
+def _count_commit(conn):
+    DB_STATS["commits"] += 1
+
 def init_db():
     # Ensure all tables, including the new ChatHistory, are created
     Base.metadata.create_all(bind=engine)
+    migrate(engine, Base.metadata)
 # --- End of models.py ---
\ No newline at end of file
@@ -0,0 +1,253 @@
+# --- pdf_worker.py ---
+# PDF export off the event loop. WeasyPrint is CPU-bound, so reports are built and rendered
+# in a small process pool behind a bounded queue. Finished PDFs are cached on disk under a
+# key made of the user, their latest ChatHistory.id and the profile fields, so exporting
+# an unchanged conversation again is a file read.
+#
+# Worker processes only import this module, export.py and WeasyPrint, never main/models.
+#
+# Job ids start with the artifact key, and pending/failed renders leave marker files next to
+# the PDF, so with several server workers sharing PDF_CACHE_DIR any of them can answer a poll.
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from typing import Optional
+from export import render_html
+from ttl_cache import TTLCache, MISS
+from metrics import PDF_RENDER_SECONDS
+import asyncio
+import glob
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "2"))
+PDF_QUEUE_SIZE = int(os.getenv("PDF_QUEUE_SIZE", "16"))  # renders queued or running before new ones get a 503
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pension-planner-pdf"))
+PDF_CACHE_MAX_FILES = int(os.getenv("PDF_CACHE_MAX_FILES", "500"))
+PDF_JOB_TTL = float(os.getenv("PDF_JOB_TTL", "3600"))  # seconds a finished job stays pollable
+
+JOB_ID_PATTERN = re.compile(r"([0-9a-f]{16}-\d+-[0-9a-f]{16})\.[0-9a-f]{8}")
+
+class PdfQueueFull(Exception):
+    pass
+
+def _user_prefix(user_id):
+    return hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:16]
+
+def artifact_key(user_id, latest_message_id, profile, filters=None):
+    # Profile fields and export filters are part of the report, so they are part of the key
+    payload = json.dumps([profile, filters or {}], sort_keys=True, default=str)
+    content_hash = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+    return f"{_user_prefix(user_id)}-{latest_message_id or 0}-{content_hash}"
+
+def new_job_id(key):
+    return f"{key}.{uuid.uuid4().hex[:8]}"
+
+def render_report(profile, messages, path):
+    # Runs in a worker process. messages are export.ExportRow tuples, oldest first.
+    # Writes to a temp file first so readers never see a partial PDF.
+    from weasyprint import HTML
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    HTML(string=render_html(profile, messages)).write_pdf(tmp_path)
+    os.replace(tmp_path, path)
+    _prune(path)
+    return os.path.getsize(path)
+
+def preload():
+    # Runs in a worker: pays WeasyPrint's import (GTK/Pango) before the first real export
+    try:
+        import weasyprint
+    except (ImportError, OSError) as e:
+        return repr(e)
+    return None
+
+def _prune(keep_path):
+    # Older exports of the same user are superseded; beyond that keep the newest files
+    prefix = os.path.basename(keep_path).split("-", 1)[0]
+    directory = os.path.dirname(keep_path)
+    for old in glob.glob(os.path.join(directory, f"{prefix}-*.pdf")) + glob.glob(os.path.join(directory, f"{prefix}-*.failed")):
+        if old != keep_path:
+            _remove(old)
+    files = glob.glob(os.path.join(directory, "*.pdf"))
+    if len(files) > PDF_CACHE_MAX_FILES:
+        files.sort(key=lambda p: os.stat(p).st_mtime if os.path.exists(p) else 0)
+        for old in files[:len(files) - PDF_CACHE_MAX_FILES]:
+            _remove(old)
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a"):
+        pass
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass  # another worker pruned it first
+
+@dataclass
+class PdfJob:
+    job_id: str
+    user_id: str
+    key: str
+    path: str
+    status: str = "pending"  # pending | done | failed
+    error: Optional[str] = None
+    cached: bool = False
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    future: Optional[asyncio.Future] = field(default=None, repr=False)
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "cached": self.cached,
+            "error": self.error,
+            "render_seconds": round(self.finished_at - self.created_at, 3) if self.finished_at else None,
+        }
+
+class PdfRenderer:
+    def __init__(self, workers=PDF_WORKERS, queue_size=PDF_QUEUE_SIZE, cache_dir=PDF_CACHE_DIR):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.cache_dir = cache_dir
+        self._executor = None
+        self._jobs = TTLCache(10000, PDF_JOB_TTL)
+        self._inflight = {}  # artifact key -> pending PdfJob, so concurrent exports share one render
+        self.renders = 0
+        self.failures = 0
+        self.cache_hits = 0
+        self.rejected = 0
+
+    def _pool(self):
+        if self._executor is None:
+            # spawn, not fork: the parent has DB and HTTP threads that must not be copied
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def warm_up(self):
+        # Starts the worker processes and preloads WeasyPrint in them
+        pool = self._pool()
+        return [pool.submit(preload) for _ in range(self.workers)]
+
+    def artifact_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pdf")
+
+    def lookup(self, user_id, key):
+        # An in-flight or already rendered export for this exact conversation state, if any
+        job = self._inflight.get(key)
+        if job is not None:
+            return job
+        path = self.artifact_path(key)
+        if os.path.exists(path):
+            self.cache_hits += 1
+            job = PdfJob(new_job_id(key), user_id, key, path, status="done", cached=True)
+            job.finished_at = job.created_at
+            self._jobs.set(job.job_id, job)
+            return job
+        return None
+
+    def submit(self, user_id, key, profile, messages):
+        job = self.lookup(user_id, key)
+        if job is not None:
+            return job
+        if len(self._inflight) >= self.queue_size:
+            self.rejected += 1
+            raise PdfQueueFull(f"{len(self._inflight)} PDF exports already queued")
+
+        job = PdfJob(new_job_id(key), user_id, key, self.artifact_path(key))
+        _touch(f"{job.path}.pending")
+        loop = asyncio.get_running_loop()
+        try:
+            job.future = loop.run_in_executor(self._pool(), render_report, profile, messages, job.path)
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM-killed mid-render); start a fresh pool rather than failing forever
+            logger.warning("PDF worker pool broken, restarting it")
+            self._executor = None
+            job.future = loop.run_in_executor(self._pool(), render_report, profile, messages, job.path)
+        job.future.add_done_callback(lambda future: self._finished(job, future))
+        self._inflight[key] = job
+        self._jobs.set(job.job_id, job)
+        return job
+
+    def _finished(self, job, future):
+        self._inflight.pop(job.key, None)
+        job.finished_at = time.time()
+        _remove(f"{job.path}.pending")
+        if future.cancelled() or future.exception() is not None:
+            error = "cancelled" if future.cancelled() else repr(future.exception())
+            logger.error(f"PDF export failed for user {job.user_id}: {error}")
+            job.status, job.error = "failed", "Failed to generate PDF report."
+            _touch(f"{job.path}.failed")
+            self.failures += 1
+        else:
+            job.status = "done"
+            self.renders += 1
+            PDF_RENDER_SECONDS.observe(job.finished_at - job.created_at)
+
+    async def wait(self, job):
+        if job.future is not None and job.status == "pending":
+            try:
+                await asyncio.shield(job.future)
+            except Exception:
+                pass  # recorded on the job by _finished
+        return job
+
+    def get_job(self, job_id):
+        job = self._jobs.get(job_id)
+        return self._shared_job(job_id) if job is MISS else job
+
+    def _shared_job(self, job_id):
+        # A job started by another server worker, as far as the shared cache directory tells
+        match = JOB_ID_PATTERN.fullmatch(job_id)
+        if match is None:
+            return None
+        key = match.group(1)
+        path = self.artifact_path(key)
+        for status, marker in (("done", path), ("failed", f"{path}.failed"), ("pending", f"{path}.pending")):
+            try:
+                modified = os.stat(marker).st_mtime
+            except FileNotFoundError:
+                continue
+            if time.time() - modified > PDF_JOB_TTL:
+                return None
+            job = PdfJob(job_id, None, key, path, status=status, created_at=modified)
+            if status == "failed":
+                job.error = "Failed to generate PDF report."
+            return job
+        return None
+
+    def discard_user(self, user_id):
+        for path in glob.glob(os.path.join(self.cache_dir, f"{_user_prefix(user_id)}-*.pdf*")):
+            _remove(path)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queued": len(self._inflight),
+            "renders": self.renders,
+            "failures": self.failures,
+            "cache_hits": self.cache_hits,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+pdf_renderer = PdfRenderer()
+# --- End of pdf_worker.py ---
@@ -0,0 +1,60 @@
+# --- pension_calculator.py ---
+# Deterministic Irish State Pension (Contributory) estimate, using the same rules the
+# SYSTEM_PROMPT asks GPT to follow:
+#   contributions = years × 52, fraction = contributions ÷ 2,080,
+#   weekly pension = fraction × €289.30, rounded to cents and clamped to €70–€289.30.
+from decimal import Decimal, ROUND_HALF_UP
+
+WEEKS_PER_YEAR = 52
+FULL_RECORD_CONTRIBUTIONS = 2080  # 40 years of weekly contributions
+MAX_WEEKLY_RATE = Decimal("289.30")  # 2025 rate
+MIN_WEEKLY_RATE = Decimal("70.00")
+MAX_PRSI_YEARS = 60
+
+_CENT = Decimal("0.01")
+
+def _weekly_rate(prsi_years):
+    contributions = Decimal(prsi_years) * WEEKS_PER_YEAR
+    weekly = (contributions / FULL_RECORD_CONTRIBUTIONS * MAX_WEEKLY_RATE).quantize(_CENT, rounding=ROUND_HALF_UP)
+    return min(max(weekly, MIN_WEEKLY_RATE), MAX_WEEKLY_RATE)
+
+# Every valid whole-year input is precomputed, so batch lookups are plain indexing
+_WEEKLY_BY_YEARS = tuple(float(_weekly_rate(years)) for years in range(MAX_PRSI_YEARS + 1))
+
+def weekly_pension(prsi_years):
+    if isinstance(prsi_years, int) and 0 <= prsi_years <= MAX_PRSI_YEARS:
+        return _WEEKLY_BY_YEARS[prsi_years]
+    if not 0 <= prsi_years <= MAX_PRSI_YEARS:
+        raise ValueError(f"PRSI years must be between 0 and {MAX_PRSI_YEARS}, got {prsi_years}")
+    return float(_weekly_rate(prsi_years))
+
+def weekly_pensions(prsi_years_list):
+    table = _WEEKLY_BY_YEARS
+    return [
+        table[years] if isinstance(years, int) and 0 <= years <= MAX_PRSI_YEARS else weekly_pension(years)
+        for years in prsi_years_list
+    ]
+
+def calculation_steps(prsi_years):
+    contributions = prsi_years * WEEKS_PER_YEAR
+    fraction = contributions / FULL_RECORD_CONTRIBUTIONS
+    return {
+        "prsi_years": prsi_years,
+        "contributions": contributions,
+        "fraction": round(fraction, 4),
+        "weekly_pension": weekly_pension(prsi_years),
+    }
+
+def format_calculation(prsi_years):
+    # Mirrors the worked example in SYSTEM_PROMPT, including the tips offer that sets pending_action
+    steps = calculation_steps(prsi_years)
+    weekly = steps["weekly_pension"]
+    return (
+        f"For {prsi_years} years of PRSI contributions in Ireland:\n"
+        f"1. Contributions = {prsi_years} × {WEEKS_PER_YEAR} = {steps['contributions']:,}\n"
+        f"2. Fraction = {steps['contributions']:,} ÷ {FULL_RECORD_CONTRIBUTIONS:,} ≈ {steps['fraction']:.2f}\n"
+        f"3. Weekly Pension = {steps['fraction']:.2f} × €{MAX_WEEKLY_RATE} ≈ €{weekly:,.2f}\n"
+        f"You could expect €{weekly:,.2f}/week by 2025 (the weekly rate is kept between €{MIN_WEEKLY_RATE} and €{MAX_WEEKLY_RATE}). "
+        "Would you like tips to boost your pension?"
+    )
+# --- End of pension_calculator.py ---
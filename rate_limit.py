@@ -0,0 +1,133 @@
+# --- rate_limit.py ---
+# Admission control in front of the chat pipeline, to protect the OpenAI quota from bursts.
+#
+# Single-flight: a request identical to one still in flight (same user_id, message and tone,
+# typically a double-click or a frontend retry) waits for that one and gets its reply. It
+# costs no OpenAI call, writes no ChatHistory rows, and takes no rate-limit tokens.
+#
+# Token buckets per user_id and per client IP: each request takes one token; buckets hold up
+# to *_BURST tokens and refill at *_PER_MINUTE. An empty bucket means 429 with Retry-After.
+#
+#   RATE_LIMIT_BACKEND=memory   default; buckets live in this process (one worker)
+#   RATE_LIMIT_BACKEND=db       buckets are rows in rate_buckets, shared by every worker
+#                               (gunicorn.conf.py sets this when it starts several)
+#
+# A *_PER_MINUTE of 0 disables that bucket; RATE_LIMIT_ENABLED=0 disables both. Behind a
+# proxy the client IP comes from X-Forwarded-For only when the server trusts the proxy
+# (FORWARDED_ALLOW_IPS for uvicorn/gunicorn, the proxy's addresses or CIDR, never "*").
+from collections import OrderedDict
+from memory import run_db, take_rate_tokens
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+RATE_LIMIT_USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", "10"))
+RATE_LIMIT_USER_PER_MINUTE = float(os.getenv("RATE_LIMIT_USER_PER_MINUTE", "30"))
+RATE_LIMIT_IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", "60"))
+RATE_LIMIT_IP_PER_MINUTE = float(os.getenv("RATE_LIMIT_IP_PER_MINUTE", "300"))
+RATE_LIMIT_MAX_KEYS = 100_000  # in-memory buckets kept, least recently used dropped first
+
+RATE_LIMIT_STATS = {"allowed": 0, "limited_user": 0, "limited_ip": 0, "coalesced": 0, "aborted": 0}
+
+class RateLimited(Exception):
+    def __init__(self, scope, retry_after):
+        super().__init__(f"Rate limit for this {scope} exceeded, retry in {retry_after:.1f}s")
+        self.scope = scope
+        self.retry_after = retry_after
+
+class FlightAborted(Exception):
+    pass
+
+class TokenBucket:
+    def __init__(self, burst, per_minute, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.burst = burst
+        self.per_second = per_minute / 60
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [tokens, updated]
+
+    def take(self, key, cost=1, now=None):
+        # Returns (allowed, seconds until `cost` tokens will be available)
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            bucket = [self.burst, now]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.per_second)
+        allowed = tokens >= cost
+        self._buckets[key] = [tokens - cost if allowed else tokens, now]
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return allowed, 0.0 if allowed else (cost - tokens) / self.per_second
+
+    async def atake(self, key, cost=1):
+        if RATE_LIMIT_BACKEND == "db":
+            return await run_db(take_rate_tokens, key, self.burst, self.per_second, cost)
+        return self.take(key, cost)
+
+_user_buckets = TokenBucket(RATE_LIMIT_USER_BURST, RATE_LIMIT_USER_PER_MINUTE)
+_ip_buckets = TokenBucket(RATE_LIMIT_IP_BURST, RATE_LIMIT_IP_PER_MINUTE)
+
+async def check_rate_limit(user_id=None, ip=None):
+    # Raises RateLimited; the IP bucket is checked first so a flood from one address does not
+    # also drain the buckets of the users it names
+    if not RATE_LIMIT_ENABLED:
+        return
+    for scope, prefix, buckets, key in (("IP address", "ip", _ip_buckets, ip), ("user", "user", _user_buckets, user_id)):
+        if key is None or not buckets.per_second:
+            continue
+        allowed, retry_after = await buckets.atake(f"{prefix}:{key}")
+        if not allowed:
+            RATE_LIMIT_STATS[f"limited_{prefix}"] += 1
+            logger.warning(f"Rate limited {scope} {key}: retry in {retry_after:.1f}s")
+            raise RateLimited(scope, retry_after)
+    RATE_LIMIT_STATS["allowed"] += 1
+
+def client_ip(request):
+    # uvicorn has already replaced request.client with the rightmost X-Forwarded-For hop
+    # that is not a trusted proxy
+    return request.client.host if request.client else None
+
+class SingleFlight:
+    def __init__(self):
+        self._flights = {}  # key -> future of (reply, error)
+
+    def join(self, key):
+        return self._flights.get(key)
+
+    def lead(self, key):
+        future = asyncio.get_running_loop().create_future()
+        self._flights[key] = future
+        return future
+
+    def done(self, key, future, reply=None, error=None):
+        # Idempotent; the first outcome wins. A leader that was cancelled or failed without a
+        # reply leaves its followers a FlightAborted to surface.
+        if self._flights.get(key) is future:
+            del self._flights[key]
+        if future.done():
+            return
+        if reply is None and not isinstance(error, Exception):
+            RATE_LIMIT_STATS["aborted"] += 1
+            error = FlightAborted("The original request did not complete")
+        future.set_result((reply, error))
+
+    def __len__(self):
+        return len(self._flights)
+
+async def follow(future):
+    RATE_LIMIT_STATS["coalesced"] += 1
+    reply, error = await asyncio.shield(future)
+    if error is not None:
+        raise error
+    return reply
+
+chat_flights = SingleFlight()
+
+def rate_limit_stats():
+    return {"enabled": RATE_LIMIT_ENABLED, "backend": RATE_LIMIT_BACKEND, **RATE_LIMIT_STATS,
+            "in_flight": len(chat_flights), "buckets": len(_user_buckets._buckets) + len(_ip_buckets._buckets)}
+# --- End of rate_limit.py ---
@@ -0,0 +1,184 @@
+# --- retention.py ---
+# Chat history retention. Messages older than RETENTION_DAYS move out of chat_history into
+# chat_archive as zlib-compressed per-user blobs, so the hot table (and its user_id index)
+# only holds recent turns. Each user's newest RETENTION_KEEP_RECENT messages stay hot
+# whatever their age, as does anything the rolling summary has not folded in yet. Exports
+# read both tiers (memory.iter_chat_history); chat turns only ever read the hot one.
+# When anything was archived the database is then compacted: a WAL checkpoint and VACUUM on
+# SQLite, VACUUM ANALYZE of the two tables on PostgreSQL.
+#
+#   python retention.py --days 180 [--keep-recent 50] [--dry-run] [--no-vacuum]
+#
+# With RETENTION_DAYS > 0 the server also runs it at startup and every RETENTION_INTERVAL_HOURS;
+# a lease in turn_leases lets only one worker do so per interval, across restarts too.
+from sqlalchemy import delete, desc, select
+from memory import acquire_turn_lease, pack_messages, run_db, run_sync
+from models import ChatArchive, ChatHistory, ConversationSummary, SessionLocal, engine, init_db
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "0"))  # 0 disables the scheduled job
+RETENTION_KEEP_RECENT = int(os.getenv("RETENTION_KEEP_RECENT", "50"))  # per user, at least CHAT_HISTORY_LIMIT
+RETENTION_INTERVAL_HOURS = float(os.getenv("RETENTION_INTERVAL_HOURS", "24"))
+RETENTION_VACUUM = os.getenv("RETENTION_VACUUM", "1") == "1"
+ARCHIVE_BLOB_MESSAGES = int(os.getenv("ARCHIVE_BLOB_MESSAGES", "1000"))
+RETENTION_USERS_PER_BATCH = 500
+
+RETENTION_STATS = {"runs": 0, "users": 0, "archived_messages": 0, "archives": 0, "archive_bytes": 0,
+                   "last_run_seconds": None, "last_db_bytes_before": None, "last_db_bytes_after": None}
+
+def candidate_users(db, cutoff, after, size):
+    # Keyset pagination over users with at least one message older than the cutoff
+    stmt = select(ChatHistory.user_id).where(ChatHistory.timestamp < cutoff)\
+        .distinct().order_by(ChatHistory.user_id).limit(size)
+    if after is not None:
+        stmt = stmt.where(ChatHistory.user_id > after)
+    return db.execute(stmt).scalars().all()
+
+def archive_user(user_id, cutoff, keep_recent, dry_run=False):
+    # Moves the user's archivable messages in blobs of ARCHIVE_BLOB_MESSAGES; each blob is
+    # written and its rows deleted in one transaction. Returns (messages, compressed bytes).
+    db = SessionLocal()
+    archived = size = 0
+    try:
+        conditions = [ChatHistory.user_id == user_id, ChatHistory.timestamp < cutoff]
+        if keep_recent:
+            recent = select(ChatHistory.id).where(ChatHistory.user_id == user_id)\
+                .order_by(desc(ChatHistory.timestamp), desc(ChatHistory.id)).limit(keep_recent)
+            conditions.append(ChatHistory.id.notin_(recent.scalar_subquery()))
+        summarized = db.execute(select(ConversationSummary.last_message_id)
+                                .where(ConversationSummary.user_id == user_id)).scalar()
+        if summarized is not None:
+            # The summary folds messages in oldest first; anything after it is still needed raw
+            conditions.append(ChatHistory.id <= summarized)
+        stmt = select(ChatHistory.id, ChatHistory.role, ChatHistory.content, ChatHistory.timestamp)\
+            .where(*conditions).order_by(ChatHistory.timestamp, ChatHistory.id).limit(ARCHIVE_BLOB_MESSAGES)
+        after = None
+        while True:
+            # Archived rows are deleted, so only a dry run has to page past what it has seen
+            rows = db.execute(stmt if after is None else stmt.where(ChatHistory.id > after)).all()
+            if not rows:
+                break
+            payload = pack_messages(rows)
+            archived += len(rows)
+            size += len(payload)
+            if dry_run:
+                after = rows[-1].id
+                db.rollback()
+                continue
+            db.add(ChatArchive(user_id=user_id, first_message_id=rows[0].id, last_message_id=rows[-1].id,
+                               first_timestamp=rows[0].timestamp, last_timestamp=rows[-1].timestamp,
+                               message_count=len(rows), payload=payload))
+            db.execute(delete(ChatHistory).where(ChatHistory.id.in_([row.id for row in rows])))
+            db.commit()
+            RETENTION_STATS["archives"] += 1
+        return archived, size
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def database_bytes():
+    # SQLite file size including the WAL, None for server databases
+    if engine.dialect.name != "sqlite" or not engine.url.database or engine.url.database == ":memory:":
+        return None
+    return sum(os.path.getsize(path) for path in (engine.url.database, f"{engine.url.database}-wal")
+               if os.path.exists(path))
+
+def compact():
+    # Returns the freed space to the filesystem and refreshes planner statistics. VACUUM
+    # cannot run inside a transaction, hence AUTOCOMMIT; on SQLite it briefly blocks writers.
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if engine.dialect.name == "sqlite":
+            conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.exec_driver_sql("VACUUM")
+            conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        elif engine.dialect.name == "postgresql":
+            for table in (ChatHistory.__tablename__, ChatArchive.__tablename__):
+                conn.exec_driver_sql(f"VACUUM (ANALYZE) {table}")
+
+def run_retention(days=RETENTION_DAYS, keep_recent=RETENTION_KEEP_RECENT, vacuum=RETENTION_VACUUM, dry_run=False):
+    started = time.monotonic()
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    bytes_before = database_bytes()
+    users = messages = size = 0
+    db = SessionLocal()
+    try:
+        after = None
+        while True:
+            user_ids = candidate_users(db, cutoff, after, RETENTION_USERS_PER_BATCH)
+            db.rollback()  # end the read transaction so SQLite checkpoints are not held back
+            if not user_ids:
+                break
+            for user_id in user_ids:
+                archived, archived_bytes = archive_user(user_id, cutoff, keep_recent, dry_run)
+                if archived:
+                    users += 1
+                    messages += archived
+                    size += archived_bytes
+            after = user_ids[-1]
+    finally:
+        db.close()
+    # Nothing moved, nothing to reclaim: a VACUUM would rewrite the whole SQLite file for no gain
+    compacted = vacuum and not dry_run and messages > 0
+    if compacted:
+        compact()
+
+    report = {"users": users, "archived_messages": messages, "archive_bytes": size, "compacted": compacted,
+              "seconds": round(time.monotonic() - started, 3),
+              "db_bytes_before": bytes_before, "db_bytes_after": database_bytes()}
+    if not dry_run:
+        RETENTION_STATS["runs"] += 1
+        RETENTION_STATS["users"] += users
+        RETENTION_STATS["archived_messages"] += messages
+        RETENTION_STATS["archive_bytes"] += size
+        RETENTION_STATS["last_run_seconds"] = report["seconds"]
+        RETENTION_STATS["last_db_bytes_before"] = bytes_before
+        RETENTION_STATS["last_db_bytes_after"] = report["db_bytes_after"]
+    logger.info(f"Retention archived {messages} messages of {users} users older than {days} days "
+                f"into {size} compressed bytes in {report['seconds']}s")
+    return report
+
+async def retention_loop(interval_hours=RETENTION_INTERVAL_HOURS):
+    # Server-side schedule, first pass at startup. The lease is kept for most of the interval,
+    # not released, so the other workers (and a restarted server) skip this round.
+    owner = f"retention-{os.getpid()}"
+    while True:
+        try:
+            if await run_db(acquire_turn_lease, "job:retention", owner, interval_hours * 3600 * 0.9):
+                await run_db(run_retention)
+        except Exception as e:
+            logger.error(f"Scheduled retention run failed: {e}", exc_info=True)
+        await asyncio.sleep(interval_hours * 3600)
+
+def retention_stats():
+    return {"days": RETENTION_DAYS, "keep_recent": RETENTION_KEEP_RECENT, **RETENTION_STATS}
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old chat history and compact the database")
+    parser.add_argument("--days", type=float, default=RETENTION_DAYS or 180, help="archive messages older than this")
+    parser.add_argument("--keep-recent", type=int, default=RETENTION_KEEP_RECENT, help="newest messages per user kept hot")
+    parser.add_argument("--no-vacuum", action="store_true", help="skip the compaction step")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be archived without writing")
+    args = parser.parse_args()
+
+    def job():
+        init_db()
+        return run_retention(args.days, args.keep_recent, vacuum=not args.no_vacuum, dry_run=args.dry_run)
+
+    report = run_sync(job)
+    print(f"✅ {'Would archive' if args.dry_run else 'Archived'} {report['archived_messages']} messages of "
+          f"{report['users']} users into {report['archive_bytes']:,} compressed bytes in {report['seconds']}s.")
+    if report["db_bytes_before"] is not None:
+        print(f"Database file: {report['db_bytes_before']:,} -> {report['db_bytes_after']:,} bytes")
+
+if __name__ == "__main__":
+    main()
+# --- End of retention.py ---
@@ -0,0 +1,113 @@
+# --- tests/conftest.py ---
+# Shared setup for the test suite: a throwaway SQLite database (or DATABASE_URL when set,
+# e.g. DATABASE_URL=postgresql://... python -m pytest tests), no real OpenAI calls, and an
+# in-process client for main.app.
+#
+#   python -m pytest -q tests
+#
+# Engines are built at import time, so the environment is set here before anything from
+# the app is imported, and one test run covers one database backend.
+import asyncio
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_workdir = tempfile.mkdtemp(prefix="pension-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_workdir, 'test.db')}")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("PDF_CACHE_DIR", os.path.join(_workdir, "pdf"))
+# Every turn that is not answered locally reaches the stub: no completion cache, FAQ
+# answers, background summaries or warm-up. Rate-limit tests enable the limiter themselves.
+for name, value in {"LLM_CACHE_SIZE": "0", "FAQ_ENABLED": "0", "SUMMARY_EVERY_TURNS": "0",
+                    "STARTUP_WARMUP": "", "RATE_LIMIT_ENABLED": "0", "METRICS_ENABLED": "0"}.items():
+    os.environ.setdefault(name, value)
+
+TIPS_OFFER = "Would you like tips to boost your pension?"
+
+class StubCompletions:
+    # Stands in for client.chat.completions; replies "Stub reply to: <last message>"
+    def __init__(self, latency=0.0, suffix=""):
+        self.latency = latency
+        self.suffix = suffix
+        self.calls = 0
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        text = f"Stub reply to: {messages[-1]['content'][:40]} {self.suffix}".strip()
+        if stream:
+            return self._stream(text.split(" "))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+
+    async def _stream(self, words):
+        for index, word in enumerate(words):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word if index == 0 else f" {word}"))])
+
+@pytest.fixture(scope="session")
+def run():
+    # One event loop for the whole session: the app's locks and the OpenAI client's
+    # semaphore are bound to the loop they first wait on
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+@pytest.fixture(scope="session", autouse=True)
+def database(run):
+    from memory import run_db
+    from models import init_db
+
+    run(run_db(init_db))
+
+@pytest.fixture(scope="session")
+def app(run):
+    import main
+
+    lifespan = main.app.router.lifespan_context(main.app)
+    run(lifespan.__aenter__())
+    yield main.app
+    run(lifespan.__aexit__(None, None, None))
+
+@pytest.fixture
+def client(app, run):
+    # client(host) is an httpx client whose requests come from `host`; with `proxy`, the
+    # app sits behind uvicorn's proxy-header handling trusting those addresses, as deployed
+    import httpx
+    from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
+
+    clients = []
+
+    def make(host="127.0.0.1", proxy=None):
+        served = ProxyHeadersMiddleware(app, trusted_hosts=proxy) if proxy else app
+        transport = httpx.ASGITransport(app=served, client=(host, 123))
+        clients.append(httpx.AsyncClient(transport=transport, base_url="http://test", timeout=None))
+        return clients[-1]
+
+    yield make
+    for http in clients:
+        run(http.aclose())
+
+@pytest.fixture
+def stub_llm(monkeypatch):
+    import gpt_engine
+
+    completions = StubCompletions()
+    monkeypatch.setattr(gpt_engine.llm, "_client", SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+    return completions
+
+@pytest.fixture
+def user_id(request, run):
+    # A user unique to the test, removed afterwards (a PostgreSQL database outlives the run)
+    import memory
+
+    user_id = f"test-{request.node.name}"[:120]
+    run(memory.run_db(memory.forget_user, user_id))
+    yield user_id
+    run(memory.run_db(memory.forget_user, user_id))
+    memory.invalidate_user_cache(user_id)
+# --- End of tests/conftest.py ---
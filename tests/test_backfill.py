@@ -0,0 +1,33 @@
+# --- tests/test_backfill.py ---
+# The profile backfill reads a user's whole history: archived messages first, then the
+# ones still in chat_history.
+from datetime import datetime, timedelta
+
+import memory
+from memory import run_db
+
+def test_backfill_window_includes_archived_messages(run, user_id):
+    import backfill_profiles
+    import retention
+    from models import SessionLocal
+
+    turn = run(run_db(memory.load_chat_turn, user_id, 0))
+    for i, content in enumerate(["I live in Ireland", "ok", "I am 45 years old", "ok", "thanks", "ok"]):
+        turn.add_message("user" if i % 2 == 0 else "assistant", content)
+    run(run_db(turn.commit))
+    archived, _ = run(run_db(retention.archive_user, user_id, datetime.utcnow() + timedelta(days=1), 2))
+    assert archived == 4
+
+    def window():
+        db = SessionLocal()
+        try:
+            users = next(user_ids for user_ids in backfill_profiles.user_windows(db, None, 10_000) if user_id in user_ids)
+            return dict(backfill_profiles.load_window(db, users, 100))[user_id]
+        finally:
+            db.close()
+
+    messages = run(run_db(window))
+    assert messages == ["I live in Ireland", "I am 45 years old", "thanks"]
+    fields = backfill_profiles.derive_chunk([(user_id, messages)])[0][1]
+    assert (fields["region"], fields["age"]) == ("Ireland", 45)
+# --- End of tests/test_backfill.py ---
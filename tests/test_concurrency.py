@@ -0,0 +1,69 @@
+# --- tests/test_concurrency.py ---
+# Simultaneous turns for one user are serialized: every message and reply is stored, in
+# alternating order, and each "yes" acts on the offer that was current when its turn ran.
+# Runs in one process; TURN_LOCK=db takes the lease path that workers share.
+# `python benchmark.py concurrency` runs the same scenario against several worker processes.
+import asyncio
+
+import pytest
+
+import memory
+import turn_lock
+from conftest import TIPS_OFFER
+from intents import TIPS_REPLY
+
+# Distinct ways to accept: identical in-flight messages from one user would be coalesced
+AFFIRMATIVES = ["yes", "yeah", "yep", "sure", "ok", "okay", "go on", "go ahead", "yes please", "sure thanks"]
+
+def replay_conversation(messages):
+    # Walks the stored history the way the tips state machine does; returns the first
+    # inconsistency, or None when every reply fits the conversation before it
+    roles = [m["role"] for m in messages]
+    if roles != ["user", "assistant"] * (len(messages) // 2):
+        return "user and assistant messages do not alternate"
+    offered = False
+    for index in range(0, len(messages), 2):
+        question, reply = messages[index]["content"], messages[index + 1]["content"]
+        if question in AFFIRMATIVES and offered:
+            expected_ok = reply == TIPS_REPLY
+        else:
+            expected_ok = reply.startswith(f"Stub reply to: {question[:40]}")
+        if not expected_ok:
+            return f"message {index}: {question!r} answered with {reply[:50]!r}"
+        offered = TIPS_OFFER.lower() in reply.lower()
+    return None
+
+@pytest.mark.parametrize("mode", ["local", "db"])
+def test_simultaneous_turns_for_one_user_stay_consistent(run, client, stub_llm, user_id, monkeypatch, mode):
+    monkeypatch.setattr(turn_lock, "TURN_LOCK", mode)
+    stub_llm.latency = 0.02
+    stub_llm.suffix = TIPS_OFFER  # every LLM reply offers tips
+    http = client()
+    turns = len(AFFIRMATIVES)
+
+    async def send(message, streamed):
+        body = {"user_id": user_id, "message": message}
+        if streamed:
+            async with http.stream("POST", "/chat/stream", json=body) as response:
+                await response.aread()
+        else:
+            response = await http.post("/chat", json=body)
+        return response.status_code
+
+    async def scenario():
+        # Signed-in users have a profile, which is where the tips state lives
+        await http.post("/auth/google", json={"sub": user_id, "name": "Concurrency User"})
+        statuses = await asyncio.gather(*(send(f"Question {i}: how is my State Pension worked out?", i % 2)
+                                          for i in range(turns)))
+        # Every "yes" races to accept the latest offer
+        statuses += await asyncio.gather(*(send(AFFIRMATIVES[i], i % 2) for i in range(turns)))
+        return statuses
+
+    statuses = run(scenario())
+    assert set(statuses) == {200}
+    messages = run(memory.run_db(memory.get_chat_history, user_id, 100))
+    assert len(messages) == 4 * turns
+    assert replay_conversation(messages) is None
+    expected_action = "offer_tips" if TIPS_OFFER.lower() in messages[-1]["content"].lower() else None
+    assert run(memory.run_db(memory.get_user_profile, user_id, True)).pending_action == expected_action
+# --- End of tests/test_concurrency.py ---
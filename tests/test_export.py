@@ -0,0 +1,26 @@
+# --- tests/test_export.py ---
+# A PDF export whose history cannot be read fails with a 500; nothing partial is rendered
+# and cached under the conversation's key.
+import pytest
+
+import main
+import memory
+from memory import run_db
+
+@pytest.mark.parametrize("path, method", [("/export-pdf", "GET"), ("/export-pdf/jobs", "POST")])
+def test_pdf_export_fails_when_history_cannot_be_read(run, client, user_id, monkeypatch, path, method):
+    run(run_db(memory.upsert_google_user, user_id, "Export User", "export@example.com"))
+    turn = run(run_db(memory.load_chat_turn, user_id, 0))
+    turn.add_message("user", "hello")
+    run(run_db(turn.commit))
+
+    def unreadable(*args, **kwargs):
+        raise RuntimeError("database went away")
+        yield
+
+    submitted = []
+    monkeypatch.setattr(main, "iter_chat_history", unreadable)
+    monkeypatch.setattr(main.pdf_renderer, "submit", lambda *args: submitted.append(args))
+    response = run(client().request(method, path, params={"user_id": user_id}))
+    assert response.status_code == 500 and submitted == []
+# --- End of tests/test_export.py ---
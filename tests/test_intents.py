@@ -0,0 +1,76 @@
+# --- tests/test_intents.py ---
+# Router turns: calculations use the years in the message, not whatever the profile held
+# before, and only explicit requests are answered locally.
+import re
+
+import pytest
+
+from intents import route
+from memory import ChatTurn, ProfileSnapshot
+
+def loaded_turn(region="Ireland", **fields):
+    turn = ChatTurn("router-user", history_limit=0)
+    turn.profile = ProfileSnapshot(user_id="router-user", region=region, **fields)
+    return turn
+
+def years_in(reply):
+    return int(re.match(r"For (\d+) years", reply).group(1))
+
+@pytest.mark.parametrize("message, years", [("14", 14), ("14 years", 14), ("35 years.", 35)])
+def test_prsi_years_answer_replaces_stored_years(message, years):
+    turn = loaded_turn(prsi_years=10, pending_action="ask_prsi_years")
+    intent, reply = route(turn, message)
+    assert intent == "calculation" and years_in(reply) == years
+    assert turn.profile.prsi_years == years and turn._profile_changes["prsi_years"] == years
+
+@pytest.mark.parametrize("message, years", [
+    ("Calculate pension for 30 PRSI years", 30),
+    ("Please calculate my pension with 25 years of PRSI", 25),
+    ("can you calculate my state pension based on 12 years of contributions", 12),
+])
+def test_calculate_uses_years_from_the_message(message, years):
+    turn = loaded_turn(prsi_years=20)
+    intent, reply = route(turn, message)
+    assert intent == "calculation" and years_in(reply) == years
+    assert turn._profile_changes == {"prsi_years": years}
+
+def test_calculate_without_years_uses_stored_years():
+    turn = loaded_turn(prsi_years=20)
+    intent, reply = route(turn, "Can you calculate my pension?")
+    assert intent == "calculation" and years_in(reply) == 20
+    assert turn._profile_changes == {}
+
+@pytest.mark.parametrize("message", [
+    "Can you calculate my pension? I am 45 years old",
+    "calculate my pension, I'm 45 years old",
+    "calculate my pension for 45 years of age",
+    "Calculate my pension if I retire in 5 years",
+    "calculate my pension in 10 years",
+    "calculate my pension for 12 yrs",
+    "calculate my pension if I retire at 66",
+    "calculate pension for 99 years of PRSI",
+])
+def test_calculate_with_other_numbers_falls_through(message):
+    turn = loaded_turn(prsi_years=20)
+    assert route(turn, message) is None
+    assert turn._profile_changes == {}
+
+@pytest.mark.parametrize("message", [
+    "how do they calculate the pension for people who worked abroad?",
+    "Is the UK pension calculated differently?",
+    "what does calculate mean for my private pension fund",
+])
+def test_questions_about_calculation_go_to_the_llm(message):
+    assert route(loaded_turn(prsi_years=20), message) is None
+
+def test_uk_profile_is_not_calculated():
+    turn = loaded_turn("UK", prsi_years=20, pending_action="ask_prsi_years")
+    assert route(turn, "30") is None
+
+@pytest.mark.parametrize("message, anonymous_reply", [("thanks", "You're welcome!"), ("hello", "Hi!")])
+def test_thanks_and_greeting_use_the_name_only_when_known(message, anonymous_reply):
+    assert route(loaded_turn(), message)[1].startswith(anonymous_reply)
+    signed_in = loaded_turn()
+    signed_in.user_name = "Aoife"
+    assert "Aoife" in route(signed_in, message)[1]
+# --- End of tests/test_intents.py ---
@@ -0,0 +1,32 @@
+# --- tests/test_llm_cache.py ---
+# The persistent completion cache drops expired entries on its own: on a read that finds
+# one, and in a periodic sweep on writes.
+import sqlite3
+
+import llm_cache
+from llm_cache import CompletionCache
+
+def stored_keys(path):
+    with sqlite3.connect(path) as db:
+        return sorted(key for key, in db.execute("SELECT key FROM completion_cache"))
+
+def test_expired_entries_are_purged_on_write_and_read(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(llm_cache.time, "time", lambda: clock[0])
+    monkeypatch.setattr(llm_cache, "LLM_CACHE_PURGE_INTERVAL", 100)
+    path = str(tmp_path / "cache.db")
+    cache = CompletionCache(max_entries=0, ttl=60, db_path=path)
+    cache.set("old", "reply")
+    cache.set("read-late", "reply")
+
+    clock[0] += 90  # both expired, the sweep interval not yet over
+    cache.set("new", "reply")
+    assert stored_keys(path) == ["new", "old", "read-late"]
+    assert cache.get("read-late") is None
+    assert stored_keys(path) == ["new", "old"]
+
+    clock[0] += 20  # next sweep due
+    cache.set("newest", "reply")
+    assert stored_keys(path) == ["new", "newest"]
+    assert cache.stats()["purged"] == 1
+# --- End of tests/test_llm_cache.py ---
@@ -0,0 +1,65 @@
+# --- tests/test_llm_client.py ---
+# Circuit breaker trials: a half-open trial that is cancelled or closed early must not
+# leave the circuit rejecting every later call.
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from llm_client import CircuitBreaker, CircuitOpenError, ResilientLLM
+
+class HangingCompletions:
+    def __init__(self):
+        self.started = asyncio.Event()
+
+    async def create(self, messages, stream=False, **kwargs):
+        self.started.set()
+        if stream:
+            return self._stream()
+        await asyncio.sleep(3600)
+
+    async def _stream(self):
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="partial"))])
+        await asyncio.sleep(3600)
+
+def half_open_llm():
+    breaker = CircuitBreaker(failures=1, cooldown=0)
+    breaker.failure()
+    llm = ResilientLLM(api_key="sk-test", hedge=False, breaker=breaker)
+    completions = HangingCompletions()
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    return llm, completions
+
+def test_cancelled_trial_releases_half_open_circuit(run):
+    llm, completions = half_open_llm()
+
+    async def cancel_trial():
+        task = asyncio.ensure_future(llm.complete([{"role": "user", "content": "hi"}]))
+        await completions.started.wait()
+        assert not llm.breaker.allow()  # the trial is in flight
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    run(cancel_trial())
+    assert llm.breaker.state == "half-open" and not llm.breaker.trial
+    assert llm.breaker.allow()
+
+def test_stream_closed_early_releases_half_open_circuit(run):
+    llm, _ = half_open_llm()
+
+    async def read_first_chunk():
+        stream = llm.stream([{"role": "user", "content": "hi"}])
+        assert await stream.__anext__() == "partial"
+        await stream.aclose()
+
+    run(read_first_chunk())
+    assert not llm.breaker.trial and llm.breaker.allow()
+
+def test_open_circuit_rejects_calls(run):
+    breaker = CircuitBreaker(failures=1, cooldown=60)
+    breaker.failure()
+    llm = ResilientLLM(api_key="sk-test", breaker=breaker)
+    with pytest.raises(CircuitOpenError):
+        run(llm.complete([{"role": "user", "content": "hi"}]))
+# --- End of tests/test_llm_client.py ---
@@ -0,0 +1,116 @@
+# --- tests/test_rate_limit.py ---
+# Burst traffic against /chat: identical in-flight requests share one completion, and
+# distinct requests beyond a user's or an address's burst get 429 with Retry-After.
+import asyncio
+
+import pytest
+
+import memory
+import rate_limit
+from rate_limit import TokenBucket
+
+def clear_db_buckets():
+    from models import RateBucket, SessionLocal
+
+    db = SessionLocal()
+    try:
+        db.query(RateBucket).filter(RateBucket.key.like("ip:10.%") | RateBucket.key.like("user:test-%"))\
+          .delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+@pytest.fixture
+def limits(monkeypatch, run):
+    # Fresh, small buckets for each test; backend "memory" or "db". Bucket rows outlive a
+    # run on PostgreSQL, so the test's keys are cleared first.
+    run(memory.run_db(clear_db_buckets))
+
+    def configure(backend="memory", user_burst=5, ip_burst=8):
+        monkeypatch.setattr(rate_limit, "RATE_LIMIT_ENABLED", True)
+        monkeypatch.setattr(rate_limit, "RATE_LIMIT_BACKEND", backend)
+        monkeypatch.setattr(rate_limit, "_user_buckets", TokenBucket(user_burst, 30))
+        monkeypatch.setattr(rate_limit, "_ip_buckets", TokenBucket(ip_burst, 60))
+    return configure
+
+def test_token_bucket_allows_burst_then_refills():
+    bucket = TokenBucket(3, 60)  # one token a second
+    assert [bucket.take("k", now=100.0)[0] for _ in range(4)] == [True, True, True, False]
+    allowed, retry_after = bucket.take("k", now=100.0)
+    assert not allowed and retry_after == pytest.approx(1.0)
+    assert bucket.take("k", now=101.0)[0]
+
+def test_token_bucket_drops_least_recently_used_keys():
+    bucket = TokenBucket(1, 60, max_keys=2)
+    for key in ("a", "b", "c"):
+        bucket.take(key, now=0.0)
+    assert list(bucket._buckets) == ["b", "c"]
+
+@pytest.mark.parametrize("backend", ["memory", "db"])
+def test_duplicate_requests_share_one_completion(run, client, stub_llm, user_id, limits, backend):
+    limits(backend)
+    stub_llm.latency = 0.05
+    http = client(f"10.1.0.{len(backend)}")
+    body = {"user_id": user_id, "message": "How much pension will I get with 12 years?"}
+
+    async def storm():
+        return await asyncio.gather(*(http.post("/chat", json=body) for _ in range(5)),
+                                    http.post("/chat/stream", json=body))
+
+    responses = run(storm())
+    assert [r.status_code for r in responses] == [200] * 6
+    assert len({r.json()["response"] for r in responses[:5]}) == 1
+    assert responses[0].json()["response"] in responses[5].text
+    assert stub_llm.calls == 1
+    assert len(run(memory.run_db(memory.get_chat_history, user_id, 100))) == 2
+
+@pytest.mark.parametrize("backend", ["memory", "db"])
+def test_user_burst_is_limited(run, client, stub_llm, user_id, limits, backend):
+    limits(backend, user_burst=5)
+    http = client(f"10.2.0.{len(backend)}")
+
+    async def burst():
+        return await asyncio.gather(*(
+            http.post("/chat", json={"user_id": user_id, "message": f"Question number {i} about my pension"})
+            for i in range(12)))
+
+    responses = run(burst())
+    limited = [r for r in responses if r.status_code == 429]
+    assert sum(r.status_code == 200 for r in responses) == 5 and len(limited) == 7
+    # 30/min refills one token every 2 seconds, less whatever the burst itself took
+    assert all(1 <= int(r.headers["Retry-After"]) <= 2 for r in limited)
+
+@pytest.mark.parametrize("backend", ["memory", "db"])
+def test_address_burst_is_limited_across_users(run, client, stub_llm, user_id, limits, backend):
+    limits(backend, ip_burst=8)
+    http = client(f"10.3.0.{len(backend)}")
+
+    async def burst():
+        return await asyncio.gather(*(
+            http.post("/chat", json={"user_id": f"{user_id}-{i}", "message": "What is the state pension age?"})
+            for i in range(12)))
+
+    responses = run(burst())
+    assert sum(r.status_code == 200 for r in responses) == 8
+    assert all(r.headers["Retry-After"] == "1" for r in responses if r.status_code == 429)
+    for i in range(12):
+        run(memory.run_db(memory.forget_user, f"{user_id}-{i}"))
+
+def test_spoofed_forwarded_for_does_not_escape_address_limit(run, client, stub_llm, user_id, limits):
+    # Each request claims a different leftmost X-Forwarded-For entry; the proxy appends the
+    # real address, which is the rightmost hop outside the trusted proxy network
+    limits(ip_burst=3)
+    http = client("10.5.0.1", proxy="10.0.0.0/8")
+
+    async def burst():
+        return await asyncio.gather(*(
+            http.post("/chat", json={"user_id": f"{user_id}-{i}", "message": "What is the state pension age?"},
+                      headers={"X-Forwarded-For": f"198.51.100.{i}, 203.0.113.7"})
+            for i in range(6)))
+
+    responses = run(burst())
+    assert [r.status_code for r in responses].count(200) == 3
+    assert rate_limit._ip_buckets._buckets.keys() == {"ip:203.0.113.7"}
+    for i in range(6):
+        run(memory.run_db(memory.forget_user, f"{user_id}-{i}"))
+# --- End of tests/test_rate_limit.py ---
@@ -0,0 +1,36 @@
+# --- tests/test_retention.py ---
+# The server's retention schedule runs its first pass at startup, not one interval later,
+# and a pass only compacts the database when it archived something.
+import asyncio
+from datetime import datetime, timedelta
+
+import memory
+import retention
+from memory import run_db
+
+def test_retention_loop_runs_a_pass_at_startup(run, monkeypatch):
+    passes = []
+    monkeypatch.setattr(retention, "acquire_turn_lease", lambda *args: True)
+    monkeypatch.setattr(retention, "run_retention", lambda: passes.append("run"))
+
+    async def start_then_stop():
+        task = asyncio.ensure_future(retention.retention_loop(interval_hours=1))
+        await asyncio.sleep(0.2)
+        task.cancel()
+
+    run(start_then_stop())
+    assert passes == ["run"]
+def test_pass_compacts_only_after_archiving(run, user_id, monkeypatch):
+    compactions = []
+    monkeypatch.setattr(retention, "compact", lambda: compactions.append("vacuum"))
+    # Nothing is older than a year
+    assert not run(run_db(retention.run_retention, 365, 2))["compacted"]
+    assert compactions == []
+
+    turn = run(run_db(memory.load_chat_turn, user_id, 0))
+    for i in range(4):
+        turn.add_message("user" if i % 2 == 0 else "assistant", f"message {i}")
+    run(run_db(turn.commit))
+    report = run(run_db(retention.run_retention, -1, 2))  # everything counts as old
+    assert report["archived_messages"] >= 2 and report["compacted"] and compactions == ["vacuum"]
+# --- End of tests/test_retention.py ---
@@ -0,0 +1,173 @@
+# --- tests/test_storage.py ---
+# Storage conformance: run once per backend, e.g.
+#   DATABASE_URL=sqlite+aiosqlite:///t.db python -m pytest -q tests/test_storage.py
+# `python benchmark.py backends` does this for SQLite, aiosqlite and PostgreSQL.
+from datetime import datetime, timedelta
+import time
+
+import pytest
+
+import memory
+from memory import run_db
+from models import DB_STATS
+
+SCRIPTED_TURNS = [
+    "I'm based in Ireland",
+    "I am 45 years old and earn €55,000",
+    "I have 20 years of PRSI contributions",
+    "What is the state pension age?",
+    "thanks",
+]
+
+@pytest.fixture
+def history_user(user_id, run):
+    # A user with a region, a pending action and six messages, committed in one turn
+    run(run_db(memory.upsert_google_user, user_id, "Storage User", "storage@example.com"))
+    turn = run(run_db(memory.load_chat_turn, user_id))
+    turn.set_profile_field("region", "Ireland")
+    turn.set_profile_field("pending_action", "offer_tips")
+    for i in range(6):
+        turn.add_message("user" if i % 2 == 0 else "assistant", f"message {i}")
+    run(run_db(turn.commit))
+    memory.invalidate_user_cache(user_id)
+    return user_id
+
+def history(run, user_id, **filters):
+    async def collect():
+        return [row async for batch in memory.iterate_db(memory.iter_chat_history(user_id, **filters)) for row in batch]
+    return run(collect())
+
+def test_upsert_google_user_creates_user_and_profile(run, user_id):
+    run(run_db(memory.upsert_google_user, user_id, "Storage User", "storage@example.com"))
+    assert run(run_db(memory.get_user_name, user_id)) == "Storage User"
+    assert run(run_db(memory.get_user_profile, user_id)) is not None
+
+def test_chat_turn_commit_is_one_commit(run, user_id):
+    turn = run(run_db(memory.load_chat_turn, user_id))
+    turn.set_profile_field("region", "Ireland")
+    turn.add_message("user", "hello")
+    turn.add_message("assistant", "hi")
+    commits = DB_STATS["commits"]
+    run(run_db(turn.commit))
+    assert DB_STATS["commits"] - commits == 1
+
+def test_chat_turn_reload_sees_committed_state(run, history_user):
+    turn = run(run_db(memory.load_chat_turn, history_user, 4))
+    assert (turn.profile.region, turn.profile.pending_action) == ("Ireland", "offer_tips")
+    assert [m["content"] for m in turn.history] == [f"message {i}" for i in range(2, 6)]
+
+def test_save_user_profile_none_clears_field(run, history_user):
+    run(run_db(memory.save_user_profile, history_user, "pending_action", None))
+    memory.invalidate_user_cache(history_user)
+    profile = run(run_db(memory.get_user_profile, history_user))
+    assert profile.pending_action is None and profile.region == "Ireland"
+
+def test_stale_chat_turn_commit_keeps_both_changes(run, history_user):
+    first = run(run_db(memory.load_chat_turn, history_user, 0, True))
+    second = run(run_db(memory.load_chat_turn, history_user, 0, True))
+    first.set_profile_field("age", 40)
+    second.set_profile_field("income", 50000)
+    conflicts = memory.TURN_STATS["conflicts"]
+    run(run_db(first.commit))
+    run(run_db(second.commit))
+    profile = run(run_db(memory.get_user_profile, history_user, True))
+    assert memory.TURN_STATS["conflicts"] - conflicts == 1
+    assert (profile.age, profile.income) == (40, 50000)
+
+def test_stale_chat_turn_commit_keeps_newer_value_of_a_shared_field(run, history_user):
+    first = run(run_db(memory.load_chat_turn, history_user, 0, True))
+    second = run(run_db(memory.load_chat_turn, history_user, 0, True))
+    first.set_profile_field("pending_action", None)
+    second.set_profile_field("pending_action", "ask_prsi_years")
+    second.set_profile_field("age", 52)
+    run(run_db(first.commit))
+    run(run_db(second.commit))
+    profile = run(run_db(memory.get_user_profile, history_user, True))
+    assert (profile.pending_action, profile.age) == (None, 52)
+    assert profile.version == first.profile.version + 1
+
+def test_turn_lease_is_exclusive_until_released(run, user_id):
+    leases = [run(run_db(memory.acquire_turn_lease, user_id, owner, 30)) for owner in ("a", "b")]
+    run(run_db(memory.release_turn_lease, user_id, "a"))
+    leases.append(run(run_db(memory.acquire_turn_lease, user_id, "b", 30)))
+    run(run_db(memory.release_turn_lease, user_id, "b"))
+    assert leases == [True, False, True]
+
+def test_write_behind_messages_are_read_while_queued_and_stored_once(run, user_id):
+    message = {"user_id": user_id, "role": "user", "content": "queued", "idempotency_key": "k1"}
+    memory.history_queue.put([dict(message, timestamp=datetime.utcnow()) for _ in range(2)])
+    assert [m["content"] for m in run(run_db(memory.get_chat_history, user_id, 10))] == ["queued"]
+    run(run_db(memory.history_queue.flush))
+    # A re-sent key (a retried flush, a client retry) is skipped by the insert as well
+    memory.history_queue.put([dict(message, timestamp=datetime.utcnow())])
+    run(run_db(memory.history_queue.flush))
+    assert [m["content"] for m in run(run_db(memory.get_chat_history, user_id, 10))] == ["queued"]
+    assert len(memory.history_queue) == 0
+
+def test_rate_bucket_allows_burst_denies_then_refills(run, user_id):
+    bucket = f"test:{user_id}:{time.time_ns()}"
+    taken = [run(run_db(memory.take_rate_tokens, bucket, 3, 1.0, 1, 1000.0))[0] for _ in range(4)]
+    assert taken == [True, True, True, False]
+    assert run(run_db(memory.take_rate_tokens, bucket, 3, 1.0, 1, 1001.5))[0]
+    allowed, retry_after = run(run_db(memory.take_rate_tokens, bucket, 3, 1.0, 1, 1001.5))
+    assert not allowed and retry_after == pytest.approx(0.5)
+
+def test_bulk_load_and_commit_is_one_commit(run, user_id):
+    user_ids = [f"{user_id}-{i}" for i in range(2)]
+    turns = run(run_db(memory.load_chat_turns, user_ids, 4, True))
+    for bulk_id, turn in turns.items():
+        turn.set_profile_field("region", "UK")
+        turn.add_message("user", f"bulk {bulk_id}")
+    commits = DB_STATS["commits"]
+    run(run_db(memory.commit_chat_turns, list(turns.values())))
+    assert DB_STATS["commits"] - commits == 1
+    reloaded = run(run_db(memory.load_chat_turns, user_ids, 4, True))
+    for bulk_id, turn in reloaded.items():
+        assert turn.profile.region == "UK"
+        assert [m["content"] for m in turn.history] == [f"bulk {bulk_id}"]
+        run(run_db(memory.forget_user, bulk_id))
+
+def test_streamed_export_history_in_write_order(run, history_user):
+    assert [m.content for m in history(run, history_user, batch_size=4)] == [f"message {i}" for i in range(6)]
+    assert [m.content for m in history(run, history_user, last_n=2)] == ["message 4", "message 5"]
+
+def test_archived_history_exports_unchanged(run, history_user):
+    import retention
+
+    exported = [tuple(row) for row in history(run, history_user)]
+    archived, _ = run(run_db(retention.archive_user, history_user, datetime.utcnow() + timedelta(days=1), 2))
+    run(run_db(retention.compact))
+    assert archived == 4
+    assert [tuple(row) for row in history(run, history_user)] == exported
+    assert [m["content"] for m in run(run_db(memory.get_chat_history, history_user, 10))] == ["message 4", "message 5"]
+
+def test_forget_user_removes_history_and_profile(run, history_user):
+    run(run_db(memory.forget_user, history_user))
+    memory.invalidate_user_cache(history_user)
+    assert run(run_db(memory.get_user_profile, history_user)) is None
+    assert run(run_db(memory.get_chat_history, history_user)) == []
+    assert run(run_db(memory.get_latest_message_id, history_user)) is None
+
+def test_concurrent_chat_sessions_persist_every_turn(run, client, stub_llm, user_id):
+    import asyncio
+
+    http = client()
+    user_ids = [f"{user_id}-{i}" for i in range(5)]
+
+    async def session(session_user):
+        for message in SCRIPTED_TURNS:
+            response = await http.post("/chat", json={"user_id": session_user, "message": message})
+            response.raise_for_status()
+
+    async def sessions():
+        await asyncio.gather(*(session(session_user) for session_user in user_ids))
+
+    run(sessions())
+    for session_user in user_ids:
+        assert len(run(run_db(memory.get_chat_history, session_user, 100))) == 2 * len(SCRIPTED_TURNS)
+    memory.invalidate_user_cache(user_ids[0])
+    profile = run(run_db(memory.get_user_profile, user_ids[0]))
+    assert (profile.region, profile.prsi_years) == ("Ireland", 20)
+    for session_user in user_ids:
+        run(run_db(memory.forget_user, session_user))
+# --- End of tests/test_storage.py ---
@@ -0,0 +1,21 @@
+# --- tests/test_ttl_cache.py ---
+# Expired entries leave the cache on a later write, at most one scan per TTL, even when
+# nothing reads them again.
+import ttl_cache
+from ttl_cache import MISS, TTLCache
+
+def test_set_sweeps_expired_entries_once_per_ttl(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(ttl_cache.time, "monotonic", lambda: clock[0])
+    cache = TTLCache(max_entries=100, ttl=10)
+    cache.set("a", 1)
+    cache.set("short", 2, ttl=1)
+
+    clock[0] += 5  # "short" expired, the next sweep is not due yet
+    cache.set("b", 3)
+    assert len(cache) == 3
+
+    clock[0] += 6  # sweep due: only "a" and "short" have expired
+    cache.set("c", 4)
+    assert len(cache) == 2 and cache.get("b") == 3 and cache.get("a") is MISS
+# --- End of tests/test_ttl_cache.py ---
@@ -0,0 +1,63 @@
+# --- tokens.py ---
+# Token counting for prompt budgeting. Uses tiktoken (in requirements.txt) when its
+# encoding can be loaded; if it is missing or the encoding cannot be fetched, falls back to
+# ~4 characters per token, which is close enough for English text to keep payloads bounded.
+# /stats reports which one is in use as tokens.exact_tokenizer. The encoding is loaded on
+# first use, not at import.
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4  # role and separators per chat message
+REPLY_PRIMING_TOKENS = 3
+TRUNCATION_MARKER = " […] "
+
+_UNLOADED = object()
+
+class TokenCounter:
+    def __init__(self, model):
+        self.model = model
+        self._encoding = _UNLOADED
+
+    @property
+    def encoding(self):
+        if self._encoding is _UNLOADED:
+            self._encoding = None
+            try:
+                import tiktoken
+                self._encoding = tiktoken.encoding_for_model(self.model)
+            except ImportError:
+                pass
+            except Exception as e:
+                # encoding_for_model downloads the BPE file on first use; offline hosts estimate
+                logger.warning(f"tiktoken encoding for {self.model} unavailable, estimating tokens: {e}")
+        return self._encoding
+
+    @property
+    def exact(self):
+        return self.encoding is not None
+
+    def count(self, text):
+        if not text:
+            return 0
+        encoding = self.encoding
+        if encoding is not None:
+            return len(encoding.encode(text))
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+    def count_messages(self, messages):
+        return sum(self.count(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages) + REPLY_PRIMING_TOKENS
+
+    def truncate(self, text, max_tokens):
+        # Keeps the start and end of an over-long message, which carry most of its intent
+        if self.count(text) <= max_tokens:
+            return text
+        budget = max(max_tokens - self.count(TRUNCATION_MARKER), 3)
+        head, tail = budget - budget // 3, budget // 3
+        if self.encoding is not None:
+            tokens = self.encoding.encode(text)
+            return self.encoding.decode(tokens[:head]) + TRUNCATION_MARKER + self.encoding.decode(tokens[-tail:])
+        return text[:head * CHARS_PER_TOKEN] + TRUNCATION_MARKER + text[-tail * CHARS_PER_TOKEN:]
+# --- End of tokens.py ---
@@ -0,0 +1,65 @@
+# --- ttl_cache.py ---
+# Bounded, thread-safe LRU with per-entry expiry. Shared by the completion cache and the
+# profile/user snapshot cache in memory.py.
+from collections import OrderedDict
+import threading
+import time
+
+MISS = object()  # Returned by get() so that None can be cached as a value
+
+class TTLCache:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._lock = threading.Lock()
+        self._next_purge = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+            self.misses += 1
+            return MISS
+
+    def set(self, key, value, ttl=None):
+        if self.max_entries <= 0:
+            return
+        now = time.monotonic()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            # Entries nobody reads again would otherwise wait for LRU eviction; one scan per TTL
+            if now >= self._next_purge:
+                self._next_purge = now + max(self.ttl, 1.0)
+                self._purge(now)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def purge_expired(self):
+        with self._lock:
+            self._purge(time.monotonic())
+
+    def _purge(self, now):
+        for key in [k for k, (expires_at, _) in self._entries.items() if expires_at <= now]:
+            del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+# --- End of ttl_cache.py ---
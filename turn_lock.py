@@ -0,0 +1,122 @@
+# --- turn_lock.py ---
+# Per-user serialization of chat turns. A turn reads the profile and recent history, may
+# wait seconds on the LLM, then writes; two overlapping turns for one user would both act
+# on the same state (e.g. both accept a single tips offer) and interleave their history.
+#
+#   TURN_LOCK=local   default; a per-user asyncio.Lock, enough for one worker process
+#   TURN_LOCK=db      additionally holds a lease row in turn_leases, shared by all worker
+#                     processes (gunicorn.conf.py sets this when it starts several)
+#   TURN_LOCK=off     no serialization; only for measuring what the lock costs
+#
+# Leases expire after TURN_LEASE_SECONDS, so a crashed worker blocks a user for at most
+# that long; ChatTurn.commit's version check catches a turn that outlives its lease.
+from llm_client import LLM_DEADLINE
+from memory import TURN_STATS, acquire_turn_lease, release_turn_lease, run_db
+import asyncio
+import logging
+import os
+import random
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+TURN_LOCK = os.getenv("TURN_LOCK", "local").lower()
+TURN_LOCK_TIMEOUT = float(os.getenv("TURN_LOCK_TIMEOUT", "30"))  # seconds to wait for the user's previous turn
+TURN_LEASE_SECONDS = float(os.getenv("TURN_LEASE_SECONDS", str(LLM_DEADLINE * 2)))
+LEASE_POLL_MIN = 0.01  # seconds between lease attempts, doubled up to LEASE_POLL_MAX
+LEASE_POLL_MAX = 0.25
+
+# Other worker processes write the same users, so cached profiles may be stale
+MULTI_WORKER = TURN_LOCK == "db"
+
+TURN_LOCK_STATS = {"acquired": 0, "waited": 0, "timeouts": 0, "lease_polls": 0}
+
+_OWNER = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+_locks = {}  # user_id -> [asyncio.Lock, turns holding or waiting for it]
+
+class TurnBusy(Exception):
+    pass
+
+class TurnLock:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._entry = None
+        self._leased = False
+
+    async def acquire(self):
+        if TURN_LOCK == "off":
+            return self
+        ends_at = time.monotonic() + TURN_LOCK_TIMEOUT
+        entry = _locks.setdefault(self.user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        waited = entry[0].locked()
+        try:
+            await asyncio.wait_for(entry[0].acquire(), TURN_LOCK_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._forget(entry)
+            TURN_LOCK_STATS["timeouts"] += 1
+            raise TurnBusy(f"Previous turn for user {self.user_id} still running after {TURN_LOCK_TIMEOUT}s")
+        except BaseException:
+            self._forget(entry)
+            raise
+        self._entry = entry
+        try:
+            if TURN_LOCK == "db":
+                waited = await self._acquire_lease(ends_at) or waited
+        except BaseException:
+            await self.release()
+            raise
+        TURN_LOCK_STATS["acquired"] += 1
+        if waited:
+            TURN_LOCK_STATS["waited"] += 1
+        return self
+
+    async def _acquire_lease(self, ends_at):
+        # Only one turn per process gets here for a user, so the process id is the owner
+        pause = LEASE_POLL_MIN
+        polls = 0
+        while not await run_db(acquire_turn_lease, self.user_id, _OWNER, TURN_LEASE_SECONDS):
+            polls += 1
+            TURN_LOCK_STATS["lease_polls"] += 1
+            if time.monotonic() + pause >= ends_at:
+                TURN_LOCK_STATS["timeouts"] += 1
+                raise TurnBusy(f"Turn lease for user {self.user_id} held elsewhere for {TURN_LOCK_TIMEOUT}s")
+            await asyncio.sleep(random.uniform(pause / 2, pause))
+            pause = min(pause * 2, LEASE_POLL_MAX)
+        self._leased = True
+        return polls > 0
+
+    async def release(self):
+        entry, self._entry = self._entry, None
+        if entry is None:
+            return
+        try:
+            if self._leased:
+                self._leased = False
+                try:
+                    await run_db(release_turn_lease, self.user_id, _OWNER)
+                except Exception as e:
+                    logger.warning(f"Could not release turn lease for user {self.user_id}, "
+                                   f"it expires in {TURN_LEASE_SECONDS}s: {e}")
+        finally:
+            entry[0].release()
+            self._forget(entry)
+
+    def _forget(self, entry):
+        entry[1] -= 1
+        if entry[1] == 0 and _locks.get(self.user_id) is entry:
+            del _locks[self.user_id]
+
+    async def __aenter__(self):
+        return await self.acquire()
+
+    async def __aexit__(self, *exc):
+        await self.release()
+
+def turn_lock(user_id):
+    return TurnLock(user_id)
+
+def turn_lock_stats():
+    return {"mode": TURN_LOCK, **TURN_LOCK_STATS, "conflicts": TURN_STATS["conflicts"], "users_locked": len(_locks)}
+# --- End of turn_lock.py ---